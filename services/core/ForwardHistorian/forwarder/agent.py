@@ -54,14 +54,18 @@
 #}}}
 from __future__ import absolute_import, print_function
 
+import base64
 import datetime
 import errno
+import itertools
 import logging
 import os, os.path
 from pprint import pprint
 import sqlite3
 import sys
 import uuid
+import zlib
+from collections import OrderedDict
 
 import gevent
 from zmq.utils import jsonapi
@@ -79,6 +83,9 @@ from volttron.platform.messaging import topics, headers as headers_mod
 utils.setup_logging()
 _log = logging.getLogger(__name__)
 
+# Sessions whose sequence numbers are remembered by a receiver.
+MAX_SESSIONS = 64
+
 
 
 def historian(config_path, **kwargs):
@@ -87,9 +94,40 @@ def historian(config_path, **kwargs):
     
     destination_vip = config.get('destination-vip')
     identity = config.get('identity', kwargs.pop('identity', None))
-            
+    # Identity of the forwarder receiving batches on the destination.
+    # Without one data is published straight to the destination's pubsub.
+    destination_identity = config.get('destination-identity')
+    # Records per forwarded batch, batches awaiting acknowledgement at once,
+    # seconds to wait for an acknowledgement and resends before the records
+    # are left in the backup cache to be replayed.
+    batch_size = max(int(config.get('batch-size', 500)), 1)
+    window = max(int(config.get('window', 4)), 1)
+    ack_timeout = config.get('ack-timeout', 30)
+    retries = max(int(config.get('retries', 1)), 0)
+    compress = config.get('compress', True)
+
+    def encode_batch(records):
+        payload = jsonapi.dumps(records)
+        if not compress:
+            return 'json', payload
+        return 'zlib', base64.b64encode(zlib.compress(payload))
+
+    def decode_batch(encoding, payload):
+        if encoding == 'zlib':
+            payload = zlib.decompress(base64.b64decode(payload))
+        elif encoding != 'json':
+            raise ValueError('unknown batch encoding: {}'.format(encoding))
+        return jsonapi.loads(payload)
+
     class ForwardHistorian(BaseHistorian):
         '''This historian forwards data to another platform.
+
+        With a destination-identity configured, records are sent in
+        sequence numbered, optionally compressed, batches to the forwarder
+        with that identity on the destination, which acknowledges each
+        batch once it has been published there.  Up to window batches are
+        awaiting acknowledgement at once and only acknowledged records
+        are removed from the backup cache; the rest are replayed later.
         '''
 
         @Core.receiver("onstart")
@@ -98,6 +136,8 @@ def historian(config_path, **kwargs):
             print('Starting address: {} identity: {}'.format(self.core.address, self.core.identity))
             #TODO: Check that destination exists
             self.topic_map = {}
+            # session -> [highest settled sequence, received above it]
+            self._received = OrderedDict()
 
             
 
@@ -108,6 +148,10 @@ def historian(config_path, **kwargs):
         def publish_to_historian(self, to_publish_list):
             _log.debug("publish_to_historian number of items: {}"
                        .format(len(to_publish_list)))
+
+            if destination_identity is not None:
+                self._forward(to_publish_list)
+                return
             
             # load a topic map if there isn't one yet.
 #             try:
@@ -172,6 +216,105 @@ def historian(config_path, **kwargs):
                 else: 
                     self.report_all_handled()
 
+        def _forward(self, to_publish_list):
+            records = []
+            items = []
+            for x in to_publish_list:
+                topic = x['topic']
+                if topic.startswith('datalogger'):
+                    self.report_handled(x)
+                    continue
+                meta = x['meta']
+                records.append([topic, str(x['timestamp']), x['value'],
+                                meta.get('units', 'percent'), meta['type'],
+                                meta['tz']])
+                items.append(x)
+
+            batches = [(items[i:i + batch_size], records[i:i + batch_size])
+                       for i in range(0, len(records), batch_size)]
+            # (seq, items, records, result, attempts) of the batches sent
+            # and not yet acknowledged, oldest first.
+            pending = []
+            failed = False
+            while pending or (batches and not failed):
+                while batches and not failed and len(pending) < window:
+                    batch_items, batch_records = batches.pop(0)
+                    seq = next(self._sequence)
+                    pending.append([seq, batch_items, batch_records,
+                                    self._send(seq, batch_records, pending),
+                                    0])
+                seq, batch_items, batch_records, result, attempts = pending[0]
+                try:
+                    result.get(timeout=ack_timeout)
+                except gevent.Timeout:
+                    _log.warn('No acknowledgement of batch {}'.format(seq))
+                except Exception as exc:
+                    _log.error('Batch {} was rejected: {}'.format(seq, exc))
+                else:
+                    pending.pop(0)
+                    self.report_handled(batch_items)
+                    continue
+                if attempts < retries and not failed:
+                    pending[0][3] = self._send(seq, batch_records, pending)
+                    pending[0][4] += 1
+                    continue
+                # Stop sending; what is in flight is still collected and
+                # the rest is replayed from the backup cache.
+                pending.pop(0)
+                failed = True
+
+        def _send(self, seq, records, pending):
+            # Everything before the oldest batch in flight has been
+            # acknowledged or given up on, so the receiver can forget it.
+            settled = (pending[0][0] if pending else seq) - 1
+            encoding, payload = encode_batch(records)
+            return self._target_platform.vip.rpc.call(
+                destination_identity, 'receive_batch', self._session,
+                seq, settled, encoding, payload)
+
+        @RPC.export
+        def receive_batch(self, session, seq, settled, encoding, payload):
+            '''Publish a batch forwarded by another platform, returning
+            once it has been published.  Batches already received in the
+            session are acknowledged without being published again.
+            '''
+            state = self._received.pop(session, None) or [0, set()]
+            self._received[session] = state
+            if len(self._received) > MAX_SESSIONS:
+                self._received.popitem(last=False)
+            if settled > state[0]:
+                state[0] = settled
+                state[1] = set(s for s in state[1] if s > settled)
+            if seq <= state[0] or seq in state[1]:
+                _log.debug('Duplicate batch {} from {}'.format(seq, session))
+                return seq
+
+            # Readings of a topic are published in separate messages, in
+            # order, as a message holds one reading per topic.
+            messages = []
+            counts = {}
+            for topic, ts, value, units, data_type, tz in decode_batch(
+                    encoding, payload):
+                index = counts.get(topic, 0)
+                counts[topic] = index + 1
+                if index == len(messages):
+                    messages.append({})
+                messages[index][topic] = {'Readings': [ts, value],
+                                          'Units': units,
+                                          'data_type': data_type,
+                                          'tz': tz}
+            # Marked first so a resend arriving meanwhile is not published.
+            state[1].add(seq)
+            try:
+                for datalog in messages:
+                    self.vip.pubsub.publish(peer='pubsub',
+                                            topic='datalogger/devices',
+                                            message=datalog).get(timeout=30)
+            except:
+                state[1].discard(seq)
+                raise
+            return seq
+
         def query_topic_list(self):
             if len(self.topic_map) > 0:
                 return self.topic_map.keys()
@@ -187,6 +330,10 @@ def historian(config_path, **kwargs):
 
         def historian_setup(self):
             _log.debug("Setting up")
+            # Sequence numbers restart in each session; unacknowledged
+            # records are resent from the backup cache in new batches.
+            self._session = str(uuid.uuid4())
+            self._sequence = itertools.count(1)
             agent = Agent(identity="target",address=destination_vip)
             event = gevent.event.Event()
             agent.core.onstart.connect(lambda *a, **kw: event.set(), event)
@@ -195,7 +342,9 @@ def historian(config_path, **kwargs):
             self._target_platform = agent
 
     ForwardHistorian.__name__ = 'ForwardHistorian'
-    return ForwardHistorian(**kwargs)
+    if destination_identity is not None:
+        kwargs.setdefault('submit_size_limit', batch_size * window)
+    return ForwardHistorian(identity=identity, **kwargs)
 
 
 
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+from collections import OrderedDict
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import gevent
+from gevent.event import AsyncResult
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from forwarder import agent
+
+
+class Namespace(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Destination(object):
+    '''Receiving forwarder reached through the target platform's RPC.
+
+    Batches are answered by calling the receiving agent unless they are
+    listed in drop, which are left unanswered the given number of times.
+    '''
+
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self.sent = []
+        self.drop = {}
+        self.rpc = Namespace(call=self.call)
+
+    def call(self, peer, method, session, seq, settled, encoding, payload):
+        self.sent.append((seq, settled))
+        result = AsyncResult()
+        if self.drop.get(seq):
+            self.drop[seq] -= 1
+            return result
+        try:
+            result.set(getattr(self.receiver, method)(
+                session, seq, settled, encoding, payload))
+        except Exception as exc:
+            result.set_exception(exc)
+        return result
+
+
+class ForwarderTests(unittest.TestCase):
+    '''Tests of batched forwarding, run without an agent or platform.'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self._init = agent.BaseHistorian.__init__
+        agent.BaseHistorian.__init__ = lambda self, **kwargs: None
+
+    def tearDown(self):
+        agent.BaseHistorian.__init__ = self._init
+        shutil.rmtree(self.directory)
+
+    def forwarder(self, **config):
+        config.update({'destination-vip': 'tcp://127.0.0.1:22916',
+                       'destination-identity': 'receiver',
+                       'ack-timeout': 0.01})
+        path = os.path.join(self.directory, 'config')
+        with open(path, 'w') as config_file:
+            json.dump(config, config_file)
+        forwarder = agent.historian(path)
+        forwarder._received = OrderedDict()
+        forwarder._session = 'session'
+        forwarder._sequence = iter(range(1, 1000))
+        forwarder.handled = []
+        forwarder.report_handled = forwarder.handled.append
+        forwarder.published = []
+
+        def publish(peer, topic, message):
+            forwarder.published.append(message)
+            result = AsyncResult()
+            result.set(None)
+            return result
+        forwarder.vip = Namespace(pubsub=Namespace(publish=publish))
+        return forwarder
+
+    def pair(self, **config):
+        sender, receiver = self.forwarder(**config), self.forwarder()
+        sender._target_platform = Namespace(vip=Destination(receiver))
+        return sender, receiver
+
+    def records(self, count, topics=1):
+        return [{'_id': n * topics + t, 'topic': 'devices/point%d' % t,
+                 'timestamp': 'ts%d' % n, 'value': n,
+                 'meta': {'type': 'int', 'tz': 'UTC'}}
+                for n in range(count) for t in range(topics)]
+
+    def test_batches(self):
+        for compress in (True, False):
+            sender, receiver = self.pair(**{'batch-size': 2,
+                                            'compress': compress})
+            records = self.records(5)
+            sender.publish_to_historian(records)
+            self.assertEqual(sender._target_platform.vip.sent,
+                             [(1, 0), (2, 0), (3, 0)])
+            self.assertEqual(sender.handled,
+                             [records[0:2], records[2:4], records[4:5]])
+            self.assertEqual(
+                [message['devices/point0']['Readings']
+                 for message in receiver.published],
+                [['ts%d' % n, n] for n in range(5)])
+            self.assertEqual(receiver.published[0]['devices/point0']['Units'],
+                             'percent')
+
+    def test_topics_grouped_per_message(self):
+        sender, receiver = self.pair()
+        sender.publish_to_historian(self.records(2, topics=3))
+        self.assertEqual([sorted(message) for message in receiver.published],
+                         [['devices/point%d' % t for t in range(3)]] * 2)
+
+    def test_datalogger_not_forwarded(self):
+        sender, receiver = self.pair()
+        record = dict(self.records(1)[0], topic='datalogger/x')
+        sender.publish_to_historian([record])
+        self.assertEqual(sender.handled, [record])
+        self.assertEqual(receiver.published, [])
+
+    def test_window(self):
+        sender, _ = self.pair(**{'batch-size': 1, 'window': 2})
+        destination = sender._target_platform.vip
+        destination.drop = {1: 1}
+        sender.publish_to_historian(self.records(4))
+        # Batch 2 is sent while 1 is unanswered and 3 once 1 is resent.
+        self.assertEqual(destination.sent,
+                         [(1, 0), (2, 0), (1, 0), (3, 1), (4, 2)])
+        self.assertEqual(len(sender.handled), 4)
+
+    def test_gives_up_after_retries(self):
+        sender, _ = self.pair(**{'batch-size': 1, 'window': 1,
+                                 'retries': 1})
+        destination = sender._target_platform.vip
+        destination.drop = {2: 2}
+        records = self.records(4)
+        sender.publish_to_historian(records)
+        self.assertEqual([seq for seq, _ in destination.sent], [1, 2, 2])
+        # Only acknowledged records leave the backup cache.
+        self.assertEqual(sender.handled, [records[0:1]])
+
+    def test_duplicates_published_once(self):
+        _, receiver = self.pair()
+        records = [['devices/point0', 'ts', 1, 'percent', 'int', 'UTC']]
+        payload = json.dumps(records)
+        self.assertEqual(receiver.receive_batch('a', 1, 0, 'json', payload), 1)
+        self.assertEqual(receiver.receive_batch('a', 1, 0, 'json', payload), 1)
+        self.assertEqual(receiver.receive_batch('b', 1, 0, 'json', payload), 1)
+        self.assertEqual(len(receiver.published), 2)
+        # Settled batches are forgotten but still not published again.
+        receiver.receive_batch('a', 2, 1, 'json', payload)
+        self.assertEqual(receiver._received['a'], [1, {2}])
+        receiver.receive_batch('a', 1, 1, 'json', payload)
+        self.assertEqual(len(receiver.published), 3)
+
+    def test_failed_publish_not_marked_received(self):
+        _, receiver = self.pair()
+        payload = json.dumps([['devices/point0', 'ts', 1, 'percent', 'int',
+                               'UTC']])
+
+        def fail(peer, topic, message):
+            raise gevent.Timeout()
+        receiver.vip.pubsub.publish = fail
+        self.assertRaises(gevent.Timeout, receiver.receive_batch,
+                          'a', 1, 0, 'json', payload)
+        self.assertEqual(receiver._received['a'], [0, set()])
+
+    def test_unknown_encoding(self):
+        _, receiver = self.pair()
+        self.assertRaises(ValueError, receiver.receive_batch,
+                          'a', 1, 0, 'bz2', '')
+
+    def test_sessions_bounded(self):
+        _, receiver = self.pair()
+        payload = json.dumps([])
+        for session in range(agent.MAX_SESSIONS + 5):
+            receiver.receive_batch(str(session), 1, 0, 'json', payload)
+        self.assertEqual(len(receiver._received), agent.MAX_SESSIONS)
+        self.assertNotIn('0', receiver._received)
+
+
+if __name__ == '__main__':
+    unittest.main()
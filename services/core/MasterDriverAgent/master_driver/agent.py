@@ -60,6 +60,7 @@ import gevent
 from volttron.platform.vip.agent import Agent, Core, RPC
 from volttron.platform.agent import utils
 from driver import DriverAgent
+from scrape_scheduler import ScrapeScheduler
 import resource
 
 from driver_locks import configure_socket_lock, configure_publish_lock
@@ -126,13 +127,21 @@ def master_driver_agent(config_path, **kwargs):
     kwargs.pop('identity', None)
     driver_config_list = get_config('driver_config_list')
 
+    # How device scrapes are spread across their interval (even, hash or
+    # none) and the most random delay, in seconds, added to each scrape.
+    scrape_scheduler = ScrapeScheduler(
+        allocation=get_config('scrape_slot_allocation', 'even'),
+        jitter=get_config('scrape_jitter', 0.0))
+
     class MasterDriverAgent(Agent):
         def __init__(self, **kwargs):
             super(MasterDriverAgent, self).__init__(**kwargs)
             self.instances = {}
+            self.scrape_scheduler = scrape_scheduler
             
         @Core.receiver('onstart')
         def starting(self, sender, **kwargs):
+            self.scrape_scheduler.start()
             env = os.environ.copy()
             env.pop('AGENT_UUID', None)
             for config_name in driver_config_list:
@@ -146,6 +155,10 @@ def master_driver_agent(config_path, **kwargs):
             _log.debug("Driver hooked up for "+topic)
             topic = topic.strip('/')
             self.instances[topic] = driver
+
+        def schedule_scrapes(self, driver, interval, offset=None):
+            self.scrape_scheduler.add(driver.device_name.strip('/'),
+                                      driver.periodic_read, interval, offset)
             
         @RPC.export
         def get_point(self, path, point_name):
@@ -155,6 +168,12 @@ def master_driver_agent(config_path, **kwargs):
         def set_point(self, path, point_name, value):
             return self.instances[path].set_point(point_name, value)
         
+        @RPC.export
+        def get_scrape_stats(self):
+            """Scrape counts, overruns, and latency and delay from the
+            scheduled slot in seconds, by device."""
+            return self.scrape_scheduler.stats()
+
         @RPC.export
         def heart_beat(self):
             _log.debug("sending heartbeat")
@@ -105,11 +105,13 @@ class DriverAgent(BasicAgent):
         self.registry_config_name = None
         self.setup_device()
         
-        interval = self.config.get("interval", 60)
-        self.core.periodic(interval, self.periodic_read, wait=None)
-            
         self.all_path_depth, self.all_path_breadth = self.get_paths_for_point(DRIVER_TOPIC_ALL)
 
+        # Scrapes are spread across the interval by the master driver.
+        interval = self.config.get("interval", 60)
+        self.parent.schedule_scrapes(self, interval,
+                                     self.config.get("scrape_offset"))
+
 
     def setup_device(self):
         #First call to setup_device won't have anything to unsubscribe to.
@@ -182,43 +184,37 @@ class DriverAgent(BasicAgent):
         }
             
 
+        items = []
         for point, value in results.iteritems():
             topics = self.get_paths_for_point(point)
+            message = [value, self.meta_data[point]]
             for topic in topics:
-                message = [value, self.meta_data[point]] 
-                self._publish_wrapper(topic, 
-                                      headers=headers, 
-                                      message=message)
+                items.append((topic, headers, message))
          
         message = [results, self.meta_data] 
-        self._publish_wrapper(self.all_path_depth, 
-                              headers=headers, 
-                              message=message)
-         
-        self._publish_wrapper(self.all_path_breadth, 
-                              headers=headers, 
-                              message=message)
+        items.append((self.all_path_depth, headers, message))
+        items.append((self.all_path_breadth, headers, message))
         
+        self._publish_batch_wrapper(items)
         
-    def _publish_wrapper(self, topic, headers, message):
+    def _publish_batch_wrapper(self, items):
         while True:
             try:
                 with publish_lock():
-                    self.vip.pubsub.publish('pubsub', 
-                                        topic, 
-                                        headers=headers, 
-                                        message=message).get(timeout=10.0)
+                    self.vip.pubsub.publish_batch('pubsub', 
+                                                  items).get(timeout=10.0)
                                         
             except Again:
-                _log.warn("publish delayed: " + topic + " pubsub is busy")
+                _log.warn("publish delayed: " + self.device_name + 
+                          " pubsub is busy")
                 gevent.sleep(random.random())
             except VIPError as ex:
-                _log.warn("driver failed to publish " + topic + ": " + str(ex))
+                _log.warn("driver failed to publish " + self.device_name + 
+                          ": " + str(ex))
                 break
             else:
                 break
-            
-    
+        
     def heart_beat(self):
         if self.heart_beat_point is None:
             return
@@ -57,6 +57,10 @@ from gevent.lock import BoundedSemaphore, DummySemaphore
 from contextlib import contextmanager
 
 _socket_lock = None
+# Greenlets blocked waiting for a socket_lock slot.
+_socket_waiters = 0
+# Callables closing an idle socket to free its slot.
+_socket_reclaimers = []
 
 def configure_socket_lock(max_connections=0):
     global _socket_lock
@@ -72,12 +76,51 @@ def socket_lock():
     global _socket_lock
     if _socket_lock is None:
         raise RuntimeError("socket_lock not configured!")
-    _socket_lock.acquire()
+    acquire_socket()
     try:        
         yield 
     finally:
         _socket_lock.release()
-        
+
+def acquire_socket(blocking=True):
+    '''Take a slot of socket_lock for a socket held open beyond a with
+    block, returning False if blocking is false and none is free.'''
+    global _socket_lock, _socket_waiters
+    if _socket_lock is None:
+        raise RuntimeError("socket_lock not configured!")
+    if _socket_lock.acquire(False):
+        return True
+    if not blocking:
+        return False
+    # Sockets kept open while idle may hold every slot; close them
+    # rather than wait for a release that may never come.
+    for reclaim in _socket_reclaimers:
+        while reclaim():
+            if _socket_lock.acquire(False):
+                return True
+    _socket_waiters += 1
+    try:
+        return _socket_lock.acquire()
+    finally:
+        _socket_waiters -= 1
+
+def add_socket_reclaimer(reclaim):
+    '''Register reclaim to be called when no socket_lock slot is free.
+    It should close one idle socket, releasing its slot, and return
+    True, or return False if it holds none.'''
+    _socket_reclaimers.append(reclaim)
+
+def socket_waiters():
+    '''Return the number of greenlets waiting for a socket_lock slot, so
+    holders of idle sockets know to close them.'''
+    return _socket_waiters
+
+def release_socket():
+    global _socket_lock
+    if _socket_lock is None:
+        raise RuntimeError("socket_lock not configured!")
+    _socket_lock.release()
+
 _publish_lock = None
 
 def configure_publish_lock(max_connections=0):
@@ -64,18 +64,18 @@ from master_driver.interfaces import BaseInterface, BaseRegister
 
 import struct
 import logging
+import select
+import socket
+import time
 from csv import DictReader
 from StringIO import StringIO
 import os.path
 
-from contextlib import contextmanager, closing
-from master_driver.driver_locks import socket_lock
-
-@contextmanager
-def modbus_client(address, port):
-    with socket_lock():
-        with closing(SyncModbusClient(address, port)) as client:
-            yield client
+from contextlib import contextmanager
+import gevent
+from gevent.lock import BoundedSemaphore, DummySemaphore
+from master_driver.driver_locks import (acquire_socket, add_socket_reclaimer,
+                                        release_socket, socket_waiters)
 
 modbus_logger = logging.getLogger("pymodbus")
 modbus_logger.setLevel(logging.WARNING)
@@ -83,6 +83,159 @@ modbus_logger.setLevel(logging.WARNING)
 utils.setup_logging()
 _log = logging.getLogger(__name__)
 
+# Seconds an unused connection is kept open, and the first and longest
+# waits before connecting again to a gateway that could not be reached.
+IDLE_TIMEOUT = 60.0
+RECONNECT_BACKOFF = 1.0
+MAX_RECONNECT_BACKOFF = 60.0
+
+
+class _Gateway(object):
+    def __init__(self, max_connections, idle_timeout):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        if max_connections < 1:
+            self.slots = DummySemaphore()
+        else:
+            self.slots = BoundedSemaphore(max_connections)
+        # (time released, client), least recently used first.
+        self.idle = []
+        self.backoff = 0.0
+        self.retry_at = 0.0
+
+
+class ModbusConnectionPool(object):
+    '''Open Modbus TCP connections kept per (address, port), so every
+    slave behind a gateway uses the same few sockets.
+
+    A connection is used by one device at a time and at most
+    max_connections are open to a gateway.  Idle connections are closed
+    after idle_timeout seconds, by a greenlet running while there are
+    any, or sooner when another socket needs their socket_lock slot, and
+    are checked before being reused.  Connection failures and errors
+    during use close the connection; after a failed connect the gateway
+    is not tried again until a backoff, doubling up to
+    MAX_RECONNECT_BACKOFF, has passed.
+    '''
+
+    def __init__(self):
+        self._gateways = {}
+        self._reaper = None
+        add_socket_reclaimer(self._close_oldest_idle)
+
+    def configure(self, address, port, max_connections=0,
+                  idle_timeout=IDLE_TIMEOUT):
+        key = (address, port)
+        gateway = self._gateways.get(key)
+        if gateway is None:
+            self._gateways[key] = _Gateway(max_connections, idle_timeout)
+        else:
+            for name, value in (('max_connections', max_connections),
+                                ('idle_timeout', idle_timeout)):
+                if getattr(gateway, name) != value:
+                    _log.warn("Ignoring {} {} for {}:{}, already configured "
+                              "as {}".format(name, value, address, port,
+                                             getattr(gateway, name)))
+
+    @contextmanager
+    def connection(self, address, port):
+        key = (address, port)
+        gateway = self._gateways.get(key)
+        if gateway is None:
+            self.configure(address, port)
+            gateway = self._gateways[key]
+        with gateway.slots:
+            client = self._checkout(key, gateway)
+            try:
+                yield client
+            except:
+                self._close(client)
+                raise
+            if socket_waiters():
+                # Idle connections hold socket_lock slots; hand this one to
+                # a waiting greenlet rather than keep it.
+                self._close(client)
+            else:
+                gateway.idle.append((time.time(), client))
+                if self._reaper is None:
+                    self._reaper = gevent.spawn(self._reap)
+
+    def _checkout(self, key, gateway):
+        while gateway.idle:
+            _, client = gateway.idle.pop()
+            if self._healthy(client):
+                return client
+            self._close(client)
+
+        if time.time() < gateway.retry_at:
+            raise ConnectionException("{}:{} unreachable, waiting {}s to "
+                                      "reconnect".format(key[0], key[1],
+                                                         gateway.backoff))
+        acquire_socket()
+        client = SyncModbusClient(*key)
+        if not client.connect():
+            self._close(client)
+            gateway.backoff = min(gateway.backoff * 2 or RECONNECT_BACKOFF,
+                                  MAX_RECONNECT_BACKOFF)
+            gateway.retry_at = time.time() + gateway.backoff
+            raise ConnectionException("Failed to connect to {}:{}"
+                                      .format(*key))
+        gateway.backoff = 0.0
+        return client
+
+    def _close_oldest_idle(self):
+        oldest = None
+        for gateway in self._gateways.itervalues():
+            if gateway.idle and (oldest is None or
+                                 gateway.idle[0][0] < oldest.idle[0][0]):
+                oldest = gateway
+        if oldest is None:
+            return False
+        self._close(oldest.idle.pop(0)[1])
+        return True
+
+    def _reap(self):
+        '''Close connections idle for longer than their timeout until
+        none are left.'''
+        try:
+            while True:
+                now = time.time()
+                wake = None
+                for gateway in self._gateways.itervalues():
+                    idle = gateway.idle
+                    while idle and now - idle[0][0] >= gateway.idle_timeout:
+                        self._close(idle.pop(0)[1])
+                    if idle:
+                        expires = idle[0][0] + gateway.idle_timeout
+                        wake = expires if wake is None else min(wake, expires)
+                if wake is None:
+                    return
+                gevent.sleep(max(wake - now, 0.1))
+        finally:
+            self._reaper = None
+
+    def _healthy(self, client):
+        if client.socket is None:
+            return False
+        # Nothing is sent unasked on an idle connection, so anything to
+        # read means it was closed or is out of step.
+        try:
+            readable, _, _ = select.select([client.socket], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+    def _close(self, client):
+        try:
+            client.close()
+        finally:
+            release_socket()
+
+_pool = ModbusConnectionPool()
+
+def modbus_client(address, port):
+    return _pool.connection(address, port)
+
 MODBUS_REGISTER_SIZE = 2
 MODBUS_READ_MAX = 100
 PYMODBUS_REGISTER_STRUCT = struct.Struct('>H')
@@ -194,6 +347,9 @@ class Interface(BaseInterface):
         self.slave_id=config_dict.get("slave_id", 0)
         self.ip_address = config_dict["device_address"]
         self.port = config_dict.get("port", Defaults.Port)
+        _pool.configure(self.ip_address, self.port,
+                        config_dict.get("max_connections", 0),
+                        config_dict.get("idle_timeout", IDLE_TIMEOUT))
         self.parse_config(registry_config_str) 
         
     def build_ranges_map(self):
@@ -222,20 +378,20 @@ class Interface(BaseInterface):
         
     def get_point(self, point_name):    
         register = self.get_register_by_name(point_name)
-        with modbus_client(self.ip_address, self.port) as client:
-            try:
+        try:
+            with modbus_client(self.ip_address, self.port) as client:
                 result = register.get_state(client)
-            except (ConnectionException, ModbusIOException, ModbusInterfaceException):
-                result = None
+        except (ConnectionException, ModbusIOException, ModbusInterfaceException):
+            result = None
         return result
     
     def set_point(self, point_name, value):    
         register = self.get_register_by_name(point_name)
-        with modbus_client(self.ip_address, self.port) as client:
-            try:
+        try:
+            with modbus_client(self.ip_address, self.port) as client:
                 result = register.set_state(client, value)
-            except (ConnectionException, ModbusIOException, ModbusInterfaceException):
-                result = None
+        except (ConnectionException, ModbusIOException, ModbusInterfaceException):
+            result = None
         return result
     
     def scrape_byte_registers(self, client, read_only):
@@ -289,19 +445,19 @@ class Interface(BaseInterface):
         
     def scrape_all(self):
         result_dict={}
-        with modbus_client(self.ip_address, self.port) as client:
-            try:
+        try:
+            with modbus_client(self.ip_address, self.port) as client:
                 
                 result_dict.update(self.scrape_byte_registers(client, True))
                 result_dict.update(self.scrape_byte_registers(client, False))
                 
                 result_dict.update(self.scrape_bit_registers(client, True))
                 result_dict.update(self.scrape_bit_registers(client, False))
-            except (ConnectionException, ModbusIOException, ModbusInterfaceException) as e:
-                _log.error ("Failed to scrape device at " + 
-                           self.ip_address + ":" + str(self.port) + " " + 
-                           "ID: " + str(self.slave_id) + str(e))
-                return None
+        except (ConnectionException, ModbusIOException, ModbusInterfaceException) as e:
+            _log.error ("Failed to scrape device at " + 
+                       self.ip_address + ":" + str(self.port) + " " + 
+                       "ID: " + str(self.slave_id) + str(e))
+            return None
         
         return result_dict
     
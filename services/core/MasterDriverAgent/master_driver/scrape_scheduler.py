@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+#
+
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization
+# that has cooperated in the development of these materials, makes
+# any warranty, express or implied, or assumes any legal liability
+# or responsibility for the accuracy, completeness, or usefulness or
+# any information, apparatus, product, software, or process disclosed,
+# or represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does
+# not necessarily constitute or imply its endorsement, recommendation,
+# or favoring by the United States Government or any agency thereof,
+# or Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+
+#}}}
+
+import heapq
+import logging
+import math
+import random
+import time
+import zlib
+
+import gevent
+from gevent.event import Event
+
+from volttron.platform.agent import utils
+
+utils.setup_logging()
+_log = logging.getLogger(__name__)
+
+SLOT_ALLOCATIONS = ('even', 'hash', 'none')
+
+
+class _Device(object):
+    def __init__(self, name, scrape, interval, offset):
+        self.name = name
+        self.scrape = scrape
+        self.interval = interval
+        # Fixed offset from the configuration, None to be allocated.
+        self.fixed_offset = offset
+        self.offset = offset or 0.0
+        self.generation = 0
+        self.slot = None
+        self.greenlet = None
+        self.scrapes = 0
+        self.overruns = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_latency = None
+        self.last_delay = None
+
+    def stats(self):
+        return {'interval': self.interval,
+                'offset': self.offset,
+                'scrapes': self.scrapes,
+                'overruns': self.overruns,
+                'last_latency': self.last_latency,
+                'average_latency': (self.total_latency / self.scrapes
+                                    if self.scrapes else None),
+                'max_latency': self.max_latency,
+                'last_delay': self.last_delay}
+
+
+class ScrapeScheduler(object):
+    '''Scrapes every device once per interval from a single greenlet.
+
+    Devices sharing an interval are given slots spread across it, so they
+    are not all scraped at the same instant.  Slots are offsets into the
+    interval, aligned to the clock:
+
+        even - devices are spaced evenly, in order of name, and move when
+               devices are added.
+        hash - each device's offset comes from a hash of its name, so it
+               stays put as devices are added.
+        none - every device is scraped at the start of the interval.
+
+    Each device is also scraped once as soon as it is added.  A device
+    configured with an offset keeps it.  Up to jitter seconds are
+    added at random to each scrape.  A device still being scraped when its
+    next slot comes around skips that slot, which is counted as an
+    overrun.
+    '''
+
+    def __init__(self, allocation='even', jitter=0.0):
+        if allocation not in SLOT_ALLOCATIONS:
+            raise ValueError('scrape slot allocation must be one of: ' +
+                             ', '.join(SLOT_ALLOCATIONS))
+        self.allocation = allocation
+        self.jitter = max(float(jitter), 0.0)
+        self._devices = {}
+        # (time, generation, name), stale when the generation has moved on.
+        self._queue = []
+        # Intervals whose devices changed, allocated again by the greenlet
+        # so that devices starting together cause one allocation.
+        self._changed = set()
+        # Names of devices added since, to be scraped right away.
+        self._added = set()
+        self._wakeup = Event()
+        self._greenlet = None
+
+    def start(self):
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+
+    def add(self, name, scrape, interval, offset=None):
+        '''Scrape a device by calling scrape every interval seconds.'''
+        interval = float(interval)
+        if interval <= 0:
+            raise ValueError('scrape interval must be positive')
+        if offset is not None:
+            offset = float(offset) % interval
+        self._devices[name] = _Device(name, scrape, interval, offset)
+        self._changed.add(interval)
+        self._added.add(name)
+        self._wakeup.set()
+
+    def remove(self, name):
+        device = self._devices.pop(name, None)
+        if device is not None:
+            self._changed.add(device.interval)
+            self._wakeup.set()
+
+    def stats(self):
+        return dict((name, device.stats())
+                    for name, device in self._devices.iteritems())
+
+    def _allocate(self, interval):
+        devices = sorted((device for device in self._devices.itervalues()
+                          if device.interval == interval and
+                          device.fixed_offset is None),
+                         key=lambda device: device.name)
+        for index, device in enumerate(devices):
+            if self.allocation == 'even':
+                device.offset = interval * index / len(devices)
+            elif self.allocation == 'hash':
+                name = device.name
+                if isinstance(name, unicode):
+                    name = name.encode('utf-8')
+                fraction = (zlib.crc32(name) & 0xffffffff) / 2.0**32
+                device.offset = interval * fraction
+            else:
+                device.offset = 0.0
+        now = time.time()
+        for device in self._devices.itervalues():
+            if device.interval == interval:
+                self._schedule(device, self._next_slot(device, now))
+        if len(self._queue) > 2 * len(self._devices):
+            self._queue = [entry for entry in self._queue
+                           if self._current(entry)]
+            heapq.heapify(self._queue)
+
+    def _current(self, entry):
+        device = self._devices.get(entry[2])
+        return device is not None and device.generation == entry[1]
+
+    def _next_slot(self, device, after):
+        '''The first slot of the device at or after the given time.'''
+        periods = math.ceil((after - device.offset) / device.interval)
+        return periods * device.interval + device.offset
+
+    def _schedule(self, device, slot):
+        device.generation += 1
+        device.slot = slot
+        when = slot
+        if self.jitter:
+            when += random.uniform(0, self.jitter)
+        heapq.heappush(self._queue, (when, device.generation, device.name))
+
+    def _run(self):
+        while True:
+            try:
+                timeout = self._step()
+            except Exception:
+                _log.exception('scrape scheduling failed')
+                timeout = 1.0
+            self._wakeup.wait(timeout)
+
+    def _step(self):
+        '''Start the scrapes that are due, returning the seconds until the
+        next one or None if no devices are scheduled.'''
+        self._wakeup.clear()
+        while self._changed:
+            self._allocate(self._changed.pop())
+        now = time.time()
+        while self._added:
+            device = self._devices.get(self._added.pop())
+            if device is not None and device.greenlet is None:
+                device.greenlet = gevent.spawn(self._scrape, device, now)
+        while self._queue:
+            entry = self._queue[0]
+            if not self._current(entry):
+                heapq.heappop(self._queue)
+            elif entry[0] <= now:
+                heapq.heappop(self._queue)
+                self._fire(self._devices[entry[2]], now)
+            else:
+                break
+        return self._queue[0][0] - now if self._queue else None
+
+    def _fire(self, device, now):
+        slot = device.slot
+        if device.greenlet is not None and not device.greenlet.ready():
+            device.overruns += 1
+            _log.warn('scrape of {} overran its interval, skipping a scrape'
+                      .format(device.name))
+        else:
+            device.greenlet = gevent.spawn(self._scrape, device, slot)
+        # Slots missed while behind are skipped rather than run back to
+        # back.
+        self._schedule(device, self._next_slot(device,
+                                               max(now, slot + 1e-6)))
+
+    def _scrape(self, device, slot):
+        start = time.time()
+        try:
+            device.scrape()
+        except Exception:
+            _log.exception('scrape of {} failed'.format(device.name))
+        latency = time.time() - start
+        device.scrapes += 1
+        device.last_delay = start - slot
+        device.last_latency = latency
+        device.total_latency += latency
+        device.max_latency = max(device.max_latency, latency)
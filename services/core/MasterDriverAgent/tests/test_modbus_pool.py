@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+import os
+import socket
+import sys
+import unittest
+
+import gevent
+from gevent.lock import BoundedSemaphore
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from master_driver import driver_locks
+from master_driver.driver_locks import socket_lock
+from master_driver.interfaces import modbus
+
+
+class FakeClient(object):
+    '''Stands in for ModbusTcpClient, with one end of a socket pair as its
+    connection and the other kept as the gateway's.'''
+    refuse = False
+
+    def __init__(self, host, port):
+        self.socket = self.peer = None
+
+    def connect(self):
+        if self.refuse:
+            return False
+        self.socket, self.peer = socket.socketpair()
+        return True
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.peer.close()
+        self.socket = None
+
+
+class PoolTests(unittest.TestCase):
+    def setUp(self):
+        self._saved = (modbus.SyncModbusClient, driver_locks._socket_lock,
+                       driver_locks._socket_reclaimers[:])
+        modbus.SyncModbusClient = FakeClient
+        FakeClient.refuse = False
+        driver_locks._socket_lock = BoundedSemaphore(2)
+        driver_locks._socket_reclaimers[:] = []
+        self.pool = modbus.ModbusConnectionPool()
+
+    def tearDown(self):
+        for gateway in self.pool._gateways.itervalues():
+            while gateway.idle:
+                self.pool._close(gateway.idle.pop()[1])
+        (modbus.SyncModbusClient, driver_locks._socket_lock,
+         driver_locks._socket_reclaimers[:]) = self._saved
+
+    def idle(self, port):
+        return len(self.pool._gateways[('127.0.0.1', port)].idle)
+
+    def test_reuses_idle_connection(self):
+        with self.pool.connection('127.0.0.1', 502) as first:
+            pass
+        with self.pool.connection('127.0.0.1', 502) as second:
+            self.assertIs(first, second)
+        self.assertEqual(self.idle(502), 1)
+
+    def test_closed_connection_not_reused(self):
+        with self.pool.connection('127.0.0.1', 502) as first:
+            pass
+        first.peer.close()
+        with self.pool.connection('127.0.0.1', 502) as second:
+            self.assertIsNot(first, second)
+        self.assertIsNone(first.socket)
+
+    def test_error_closes_connection(self):
+        with self.assertRaises(ValueError):
+            with self.pool.connection('127.0.0.1', 502) as client:
+                raise ValueError()
+        self.assertIsNone(client.socket)
+        self.assertEqual(self.idle(502), 0)
+        self.assertEqual(driver_locks._socket_lock.counter, 2)
+
+    def test_max_connections(self):
+        self.pool.configure('127.0.0.1', 502, max_connections=1)
+        clients = []
+
+        def use():
+            with self.pool.connection('127.0.0.1', 502) as client:
+                clients.append(client)
+                gevent.sleep(0.01)
+
+        gevent.joinall([gevent.spawn(use) for _ in range(3)])
+        self.assertEqual(len(set(clients)), 1)
+
+    def test_backoff_after_failed_connect(self):
+        FakeClient.refuse = True
+        for message in ('Failed to connect', 'unreachable'):
+            with self.assertRaisesRegexp(modbus.ConnectionException,
+                                         message):
+                with self.pool.connection('127.0.0.1', 502):
+                    pass
+        gateway = self.pool._gateways[('127.0.0.1', 502)]
+        self.assertEqual(gateway.backoff, modbus.RECONNECT_BACKOFF)
+        self.assertEqual(driver_locks._socket_lock.counter, 2)
+
+    def test_idle_timeout_reaped_without_traffic(self):
+        self.pool.configure('127.0.0.1', 502, idle_timeout=0.1)
+        with self.pool.connection('127.0.0.1', 502):
+            pass
+        self.assertEqual(driver_locks._socket_lock.counter, 1)
+        gevent.sleep(0.3)
+        self.assertEqual(self.idle(502), 0)
+        self.assertEqual(driver_locks._socket_lock.counter, 2)
+        self.assertIsNone(self.pool._reaper)
+
+    def test_idle_sockets_released_to_other_drivers(self):
+        for port in (502, 503):
+            with self.pool.connection('127.0.0.1', port):
+                pass
+        self.assertEqual(driver_locks._socket_lock.counter, 0)
+        with gevent.Timeout(1):
+            with socket_lock():
+                self.assertEqual(self.idle(502) + self.idle(503), 1)
+        # The oldest idle connection is the one given up.
+        self.assertEqual(self.idle(502), 0)
+
+    def test_idle_socket_released_to_other_gateway(self):
+        with self.pool.connection('127.0.0.1', 502):
+            pass
+        with self.pool.connection('127.0.0.1', 503):
+            pass
+        with gevent.Timeout(1):
+            with self.pool.connection('127.0.0.1', 504):
+                pass
+        self.assertEqual(self.idle(502), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+import os
+import sys
+import unittest
+
+import gevent
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from master_driver.scrape_scheduler import ScrapeScheduler
+
+
+class AllocationTests(unittest.TestCase):
+    def offsets(self, scheduler):
+        scheduler._step()
+        return dict((name, stats['offset'])
+                    for name, stats in scheduler.stats().iteritems())
+
+    def test_unknown_allocation(self):
+        self.assertRaises(ValueError, ScrapeScheduler, 'random')
+
+    def test_interval_must_be_positive(self):
+        self.assertRaises(ValueError, ScrapeScheduler().add,
+                          'dev', lambda: None, 0)
+
+    def test_even(self):
+        scheduler = ScrapeScheduler('even')
+        for name in ('c', 'a', 'b', 'd'):
+            scheduler.add(name, lambda: None, 8)
+        self.assertEqual(self.offsets(scheduler),
+                         {'a': 0.0, 'b': 2.0, 'c': 4.0, 'd': 6.0})
+
+    def test_hash_stable_as_devices_added(self):
+        scheduler = ScrapeScheduler('hash')
+        scheduler.add(u'campus/caf\xe9', lambda: None, 60)
+        before = self.offsets(scheduler)[u'campus/caf\xe9']
+        for index in range(5):
+            scheduler.add('device{}'.format(index), lambda: None, 60)
+        offsets = self.offsets(scheduler)
+        self.assertEqual(offsets[u'campus/caf\xe9'], before)
+        self.assertTrue(all(0 <= offset < 60 for offset in offsets.values()))
+        self.assertEqual(len(set(offsets.values())), 6)
+
+    def test_none(self):
+        scheduler = ScrapeScheduler('none')
+        for name in ('a', 'b'):
+            scheduler.add(name, lambda: None, 8)
+        self.assertEqual(self.offsets(scheduler), {'a': 0.0, 'b': 0.0})
+
+    def test_fixed_offset_kept(self):
+        scheduler = ScrapeScheduler('even')
+        scheduler.add('a', lambda: None, 8)
+        scheduler.add('b', lambda: None, 8, offset=11)
+        scheduler.add('c', lambda: None, 8)
+        self.assertEqual(self.offsets(scheduler),
+                         {'a': 0.0, 'b': 3.0, 'c': 4.0})
+
+    def test_intervals_allocated_separately(self):
+        scheduler = ScrapeScheduler('even')
+        for name in ('a', 'b'):
+            scheduler.add(name, lambda: None, 8)
+        scheduler.add('c', lambda: None, 6)
+        self.assertEqual(self.offsets(scheduler),
+                         {'a': 0.0, 'b': 4.0, 'c': 0.0})
+
+    def test_next_slot(self):
+        scheduler = ScrapeScheduler('even')
+        for name in ('a', 'b'):
+            scheduler.add(name, lambda: None, 8)
+        scheduler._step()
+        device = scheduler._devices['b']
+        self.assertEqual(scheduler._next_slot(device, 100.0), 100.0)
+        self.assertEqual(scheduler._next_slot(device, 100.5), 108.0)
+        self.assertEqual(scheduler._next_slot(device, 93.0), 100.0)
+
+    def test_removed_device_dropped_from_queue(self):
+        scheduler = ScrapeScheduler('even')
+        for index in range(3):
+            scheduler.add(str(index), lambda: None, 3600)
+        scheduler._step()
+        for index in range(3):
+            scheduler.remove(str(index))
+        self.assertIsNone(scheduler._step())
+        self.assertEqual(scheduler._queue, [])
+
+
+class RunTests(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = ScrapeScheduler('even')
+        self.scheduler.start()
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def test_scraped_when_added(self):
+        scrapes = []
+        self.scheduler.add('dev', lambda: scrapes.append(1), 3600)
+        gevent.sleep(0.01)
+        self.assertEqual(scrapes, [1])
+
+    def test_scraped_each_interval(self):
+        scrapes = []
+        self.scheduler.add('dev', lambda: scrapes.append(1), 0.1)
+        gevent.sleep(0.35)
+        # Once when added, then once per slot.
+        self.assertIn(len(scrapes), (4, 5))
+
+    def test_overrun_skips_slot(self):
+        self.scheduler.add('slow', lambda: gevent.sleep(0.25), 0.1)
+        gevent.sleep(0.5)
+        stats = self.scheduler.stats()['slow']
+        self.assertGreater(stats['overruns'], 0)
+        self.assertLessEqual(stats['scrapes'], 2)
+        self.assertGreaterEqual(stats['max_latency'], 0.25)
+
+    def test_failed_scrape_counted(self):
+        def fail():
+            raise RuntimeError('unreachable')
+        self.scheduler.add('dev', fail, 10)
+        gevent.sleep(0.01)
+        self.assertEqual(self.scheduler.stats()['dev']['scrapes'], 1)
+
+    def test_keeps_running_after_error(self):
+        allocate = self.scheduler._allocate
+
+        def fail(interval):
+            raise RuntimeError('allocation failed')
+        self.scheduler._allocate = fail
+        self.scheduler.add('a', lambda: None, 10)
+        gevent.sleep(0.01)
+        self.scheduler._allocate = allocate
+        scrapes = []
+        self.scheduler.add('b', lambda: scrapes.append(1), 10)
+        gevent.sleep(0.01)
+        self.assertFalse(self.scheduler._greenlet.dead)
+        self.assertEqual(scrapes, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
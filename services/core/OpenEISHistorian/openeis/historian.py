@@ -65,11 +65,10 @@ import uuid
 
 import gevent
 import requests
-from requests import ConnectionError
 from zmq.utils import jsonapi
 
 from volttron.platform.vip.agent import *
-from volttron.platform.agent.base_historian import BaseHistorian
+from volttron.platform.agent.base_historian import BaseHistorian, Uploader
 from volttron.platform.agent import utils
 from volttron.platform.messaging import topics, headers as headers_mod
 from twisted.spread.pb import respond
@@ -104,6 +103,31 @@ def historian(config_path, **kwargs):
     datasets = config.get("dataset_definitions")
     assert datasets
     assert len(datasets) > 0
+
+    # topic -> [(dataset_id, openeis_sensor), ...] for every mapped point.
+    topic_index = {}
+    # topic -> names of the datasets mapping it.
+    topic_datasets = {}
+    ignoring = set()
+    for dsk, dsv in datasets.items():
+        ds_id = dsv["dataset_id"]
+        for point in dsv['points']:
+            for topic, openeis_sensor in point.items():
+                topic_index.setdefault(topic, []).append((ds_id,
+                                                          openeis_sensor))
+                topic_datasets.setdefault(topic, set()).add(dsk)
+        if dsv.get('ignore_unmapped_points', 0):
+            ignoring.add(dsk)
+    # A dataset with ignore_unmapped_points set reports the items it does
+    # not map as handled, so only topics mapped by all of those datasets
+    # are kept until uploaded.
+    ignored_topics = set(topic for topic, names in topic_datasets.items()
+                         if ignoring - names)
+    ignore_unmapped = bool(ignoring)
+
+    # Readings per upload request and number of requests in flight at once.
+    chunk_size = max(int(config.get('upload_chunk_size', 5000)), 1)
+    upload_workers = max(int(config.get('upload_workers', 4)), 1)
     
     # This allows us to switch the identity based upon the param in the config
     # file.
@@ -142,53 +166,62 @@ def historian(config_path, **kwargs):
             
             #pprint(to_publish_list)
             dataset_uri = uri + "/api/datasets/append"
-            
-            # Build a paylooad for each of the points in each of the dataset
-            # definitions.
-            for dsk, dsv in datasets.items():
-                ds_id = dsv["dataset_id"]
-                ds_points = dsv['points'] #[unicode(p) for p in dsv['points']]
-                ignore_unmapped = dsv.get('ignore_unmapped_points', 0) 
-                
-                point_map = {}
-                try_publish = []
-                for to_pub in to_publish_list:
-                    for point in ds_points:                      
-                        if to_pub['topic'] in point.keys():
-                            try_publish.append(to_pub)
-                            # gets the value of the sensor for publishing.
-                            openeis_sensor = point[to_pub['topic']]
-                            if not openeis_sensor in point_map:
-                                point_map[openeis_sensor] = []
-                                
-                            point_map[openeis_sensor].append([to_pub['timestamp'],
-                                                               to_pub['value']])
-                        else:
-                            if ignore_unmapped:
-                                self.report_handled(to_pub)
-                            else:
-                                err = 'Point {topic} was not found in point map.' \
-                                    .format(**to_pub)
-                                _log.error(err)
-                                
-                    #pprint(point_map)
-                        
-                if len(point_map) > 0:
+
+            # Build the point map of every dataset in one pass over the
+            # items, chunked so no upload carries more than chunk_size
+            # readings.
+            # dataset_id -> [(readings, point_map, items), ...]
+            chunks = {}
+            # index of item -> number of uploads it is part of
+            uploads = {}
+            for index, to_pub in enumerate(to_publish_list):
+                mapped = topic_index.get(to_pub['topic'])
+                if mapped is None:
+                    if ignore_unmapped:
+                        self.report_handled(to_pub)
+                    else:
+                        err = 'Point {topic} was not found in point map.' \
+                            .format(**to_pub)
+                        _log.error(err)
+                    continue
+                ignored = to_pub['topic'] in ignored_topics
+                if ignored:
+                    self.report_handled(to_pub)
+
+                for ds_id, openeis_sensor in mapped:
+                    ds_chunks = chunks.setdefault(ds_id, [])
+                    if not ds_chunks or ds_chunks[-1][0] >= chunk_size:
+                        ds_chunks.append([0, {}, set()])
+                    chunk = ds_chunks[-1]
+                    # gets the value of the sensor for publishing.
+                    chunk[1].setdefault(openeis_sensor, []).append(
+                        [to_pub['timestamp'], to_pub['value']])
+                    chunk[0] += 1
+                    if not ignored and index not in chunk[2]:
+                        chunk[2].add(index)
+                        uploads[index] = uploads.get(index, 0) + 1
+
+            payloads = []
+            for ds_id, ds_chunks in chunks.items():
+                for _, point_map, indexes in ds_chunks:
                     payload = { 'dataset_id': ds_id,
                                'point_map': point_map}
-                    payload = jsonapi.dumps(payload, 
+                    payload = jsonapi.dumps(payload,
                                             default=datetime.datetime.isoformat)
-                    try:
-                        #resp = requests.post(login_uri, auth=auth)
-                        resp = requests.put(dataset_uri, verify=False, headers=headers, 
-                                            data=payload)
-                        if resp.status_code == requests.codes.ok:                       
-                            self.report_handled(try_publish)
-                    except ConnectionError:
-                        _log.error('Unable to connect to openeis at {}'.format(uri))
-                        return
-                        
-                        
+                    payloads.append((indexes, payload))
+
+            # An item is handled once every upload it is part of succeeded.
+            results = self._uploader.map(
+                lambda payload: self._upload(dataset_uri, payload),
+                [p for _, p in payloads])
+            for (indexes, _), ok in zip(payloads, results):
+                if not ok:
+                    continue
+                for index in indexes:
+                    uploads[index] -= 1
+                    if not uploads[index]:
+                        self.report_handled(to_publish_list[index])
+
             '''
             Transform the to_publish_list into a dictionary like the following
             
@@ -202,13 +235,23 @@ def historian(config_path, **kwargs):
             }
             '''           
 
+        def _upload(self, dataset_uri, payload):
+            try:
+                #resp = requests.post(login_uri, auth=auth)
+                resp = self._uploader.session.put(
+                    dataset_uri, verify=False, headers=headers, data=payload)
+            except requests.RequestException as e:
+                _log.error('Unable to upload to openeis at {}: {}'.format(
+                    uri, e))
+                return False
+            return resp.status_code == requests.codes.ok
+
         def query_historian(self, topic, start=None, end=None, skip=0,
                             count=None, order="FIRST_TO_LAST"):
             raise Exception('Please use Openeis for the query interface.')
             
         def historian_setup(self):
-            # TODO Setup connection to openeis.
-            pass
+            self._uploader = Uploader(upload_workers)
 
     OpenEISHistorian.__name__ = 'OpenEISHistorian'
     return OpenEISHistorian(**kwargs)
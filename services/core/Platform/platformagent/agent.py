@@ -316,8 +316,17 @@ def platform_agent(config_path, **kwargs):
                     else:
                         uuid = params['uuid']
 
-                    status = self.vip.rpc.call('control', method, uuid).get()
-                    if method == 'stop_agent' or status == None:
+                    if method == 'stop_agent':
+                        # Pipeline the status query behind the stop so both
+                        # run in order in a single round trip.
+                        stopped, status = self.vip.rpc.call_many('control', [
+                            ('stop_agent', (uuid,), None),
+                            ('agent_status', (uuid,), None)])
+                        stopped.get()
+                        status = status.get()
+                    else:
+                        status = self.vip.rpc.call('control', method, uuid).get()
+                    if status == None:
                         # Note we recurse here to get the agent status.
                         result = self.route_request(id, 'agent_status', uuid)
                     else:
@@ -5,8 +5,18 @@ CREATE TABLE data (ts timestamp NOT NULL,
                                  UNIQUE(ts, topic_id));
             
 CREATE INDEX data_idx ON data (ts ASC);
+CREATE INDEX data_topic_ts_idx ON data (topic_id, ts);
 
 CREATE TABLE topics (topic_id INTEGER NOT NULL AUTO_INCREMENT, 
                                  topic_name varchar(512) NOT NULL,
 								 PRIMARY KEY (topic_id),
                                  UNIQUE(topic_name));
+
+CREATE TABLE rollup (topic_id INTEGER NOT NULL,
+                                 resolution INTEGER NOT NULL,
+                                 ts BIGINT NOT NULL,
+                                 value_count BIGINT NOT NULL,
+                                 value_sum DOUBLE NOT NULL,
+                                 value_min DOUBLE NOT NULL,
+                                 value_max DOUBLE NOT NULL,
+                                 PRIMARY KEY (topic_id, resolution, ts));
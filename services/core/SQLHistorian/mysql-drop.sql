@@ -1,3 +1,4 @@
 DROP INDEX data_idx ON data;
 DROP TABLE `data`;
 DROP TABLE topics;
+DROP TABLE rollup;
@@ -1,5 +1,7 @@
 from __future__ import absolute_import, print_function
 from abc import abstractmethod
+import calendar
+from datetime import datetime
 import importlib
 import logging
 
@@ -10,7 +12,51 @@ from volttron.platform.agent import utils
 utils.setup_logging()
 _log = logging.getLogger(__name__)
 
+ROLLUP_AGGREGATES = {
+    'avg': 'SUM(rollup.value_sum) / SUM(rollup.value_count)',
+    'min': 'MIN(rollup.value_min)',
+    'max': 'MAX(rollup.value_max)',
+    'sum': 'SUM(rollup.value_sum)',
+    'count': 'SUM(rollup.value_count)',
+}
+
+
+def epoch(ts):
+    '''Return integer seconds since the epoch of a naive UTC or aware
+    datetime.'''
+    return calendar.timegm(ts.utctimetuple())
+
+
+def numeric_value(value):
+    '''Return value as aggregated: numbers as floats and anything else as
+    0, matching the CAST of the stored JSON used by the raw aggregates.'''
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return float(value)
+    return 0.0
+
+
 class DbDriver(object):
+    '''Base class of the SQL historian database drivers.
+
+    A single writer connection is kept open across batches and is only
+    closed, to be reopened on next use, when an operation on it fails.
+    Reads use a connection from connect() for each query.
+
+    Drivers set placeholder to the parameter marker of their DB-API
+    module and supply the epoch, bucket and numeric SQL expressions used
+    by query_multi and the statements merging rows into the rollup table.
+
+    The rollup table holds the count, sum, min and max of each topic over
+    buckets of a number of seconds, its resolution, keyed by the epoch
+    second the bucket starts at.
+
+    Drivers whose database accepts concurrent transactions set
+    concurrent_writes, allowing several drivers, one per publishing
+    thread, to write at once.
+    '''
+
+    placeholder = '?'
+    concurrent_writes = False
     
     def __init__(self, dbapimodule, **kwargs):
         _log.debug("Constructing Driver for "+ dbapimodule)
@@ -33,7 +79,7 @@ class DbDriver(object):
     def __check_connection(self):
         can_connect = False
         
-        conn = self.__dbmodule.connect(**self.__connect_params)
+        conn = self.connect()
         
         if conn:
             can_connect = True        
@@ -45,14 +91,39 @@ class DbDriver(object):
         
         return can_connect
 
+    def connect(self):
+        '''Return a new connection to the database.'''
+        return self.__dbmodule.connect(**self.__connect_params)
+
     def __connect(self, return_val=False):
         
         if return_val:
-            return self.__dbmodule.connect(**self.__connect_params)
+            return self.connect()
         
         if self.__connection == None:
-            self.__connection = self.__dbmodule.connect(**self.__connect_params)        
-            
+            self.__connection = self.connect()
+
+    def __disconnect(self):
+        '''Close the writer connection so the next write reconnects.'''
+        if self.__connection is not None:
+            try:
+                self.__connection.close()
+            except Exception:
+                pass
+        self.__cursor = None
+        self.__connection = None
+
+    def __writer(self):
+        try:
+            self.__connect()
+        except Exception:
+            _log.exception('unable to connect to the database')
+            self.__disconnect()
+            return None
+        if self.__cursor is None:
+            self.__cursor = self.__connection.cursor()
+        return self.__cursor
+
     @abstractmethod
     def get_topic_map(self):
         '''
@@ -70,89 +141,441 @@ class DbDriver(object):
     
     def insert_data(self, ts, topic_id, data):
         
-        self.__connect()
+        return self.insert_data_many([(ts, topic_id, data)])
+
+    def insert_data_many(self, rows):
+        '''Insert (ts, topic_id, value) rows with a single executemany.'''
+        dumps = jsonapi.dumps
+        return self.write_many(self.insert_data_query(),
+                               [(ts, topic_id, dumps(data))
+                                for ts, topic_id, data in rows])
 
-        if self.__connection is None:
+    def write(self, query, args=None):
+        '''Execute query on the writer connection.'''
+        cursor = self.__writer()
+        if cursor is None:
             return False
-        
-        if self.__cursor == None:
-            self.__cursor = self.__connection.cursor()
-        
-        self.__cursor.execute(self.insert_data_query(), (ts,topic_id,jsonapi.dumps(data)))
+        try:
+            if args is None:
+                cursor.execute(query)
+            else:
+                cursor.execute(query, args)
+        except Exception:
+            self.__disconnect()
+            raise
+        return True
+
+    def write_many(self, query, params):
+        '''Execute query for each of params on the writer connection.'''
+        cursor = self.__writer()
+        if cursor is None:
+            return False
+        try:
+            cursor.executemany(query, params)
+        except Exception:
+            self.__disconnect()
+            raise
         return True
 
     def insert_topic(self, topic):
         
-        self.__connect()
-        
-        if self.__connection is None:
+        cursor = self.__writer()
+        if cursor is None:
             return False
         
-        if self.__cursor == None:
-            self.__cursor = self.__connection.cursor()
-        
-        self.__cursor.execute(self.insert_topic_query(), (topic,))
+        try:
+            cursor.execute(self.insert_topic_query(), (topic,))
+        except Exception:
+            self.__disconnect()
+            raise
         
-        row = [self.__cursor.lastrowid]
+        row = [cursor.lastrowid]
 
         return row
     
     def commit(self):
-        try:
-            retValue = False
-            if self.__connection is not None:
+        retValue = False
+        if self.__connection is not None:
+            try:
                 self.__connection.commit()
                 retValue = True
-            else:
-                _log.warn('connection was null during commit phase.')
-        finally:
-            if self.__connection is not None:
-                try:
-                    self.__connection.close()
-                except:
-                    pass
-                                                            
-            self.__cursor = None
-            self.__connection = None
+            except Exception:
+                _log.exception('commit failed; reconnecting on next write')
+                self.__disconnect()
+        else:
+            _log.warn('connection was null during commit phase.')
         return retValue
+
     def rollback(self):
-        try:
-            retValue = False
-            if self.__connection is not None:
+        retValue = False
+        if self.__connection is not None:
+            try:
                 self.__connection.rollback()
                 retValue = True
-            else:
-                _log.warn('connection was null during rollback phase.')
-        finally:
-            if self.__connection is not None:
-                try:
-                    self.__connection.close()
-                except:
-                    pass
-                                                            
-            self.__cursor = None
-            self.__connection = None
+            except Exception:
+                _log.exception('rollback failed; reconnecting on next write')
+                self.__disconnect()
+        else:
+            _log.warn('connection was null during rollback phase.')
         return retValue
     
-    def select(self, query, args):
+    def select(self, query, args=None):
         conn = self.__connect(True)
-        cursor = conn.cursor()
-        if args is not None:
-            cursor.execute(query, args)
-        else:
-            cursor.execute(query)
-        rows = cursor.fetchall()
-        conn.close()
+        try:
+            cursor = conn.cursor()
+            if args is not None:
+                cursor.execute(query, args)
+            else:
+                cursor.execute(query)
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
         return rows
     
     
     @abstractmethod                        
     def query(self, topic, start=None, end=None, skip=0,
-                            count=None, order="FIRST_TO_LAST"):
+                            count=None, order="FIRST_TO_LAST", topic_id=None):
         """This function should return the results of a query in the form:
         {"values": [(timestamp1, value1), (timestamp2, value2), ...],
          "metadata": {"key1": value1, "key2": value2, ...}}
 
          metadata is not required (The caller will normalize this to {} for you)
+
+         If topic_id is given it is used in place of looking up topic.
         """
-        pass
\ No newline at end of file
+        pass
+
+    def epoch_clause(self, column):
+        '''Return an expression of column as integer seconds since the epoch.'''
+        raise NotImplementedError()
+
+    def bucket_clause(self, column, interval):
+        '''Return an expression of the start of the interval second bucket
+        containing column, in seconds since the epoch.'''
+        return 'FLOOR({} / {}) * {}'.format(
+            self.epoch_clause(column), int(interval), int(interval))
+
+    def numeric_clause(self, column):
+        '''Return an expression of the stored JSON value as a number.'''
+        raise NotImplementedError()
+
+    def rollup_queries(self):
+        '''Return the statements merging (topic_id, resolution, ts, count,
+        sum, min, max) rows into the rollup table.'''
+        raise NotImplementedError()
+
+    def stored_rows(self, rows):
+        '''Return the set of (topic_id, ts) of (ts, topic_id, value) rows
+        already in the data table, read on the writer connection.
+
+        New values usually follow those stored, so the stored rows of the
+        batch's time range are counted first and only rows of topics
+        having some are looked up.
+        '''
+        if not rows:
+            return set()
+        p = self.placeholder
+        topic_ids = sorted(set(topic_id for _, topic_id, _ in rows))
+        first = min(ts for ts, _, _ in rows)
+        last = max(ts for ts, _, _ in rows)
+        cursor = self.__writer()
+        if cursor is None:
+            return set()
+        try:
+            found = set()
+            # Keep well under the bound parameter limit of SQLite.
+            for index in xrange(0, len(topic_ids), 500):
+                group = topic_ids[index:index + 500]
+                cursor.execute('''SELECT topic_id, COUNT(*) FROM data
+                                  WHERE topic_id IN ({})
+                                  AND ts >= {p} AND ts <= {p}
+                                  GROUP BY topic_id'''.format(
+                                      ', '.join([p] * len(group)), p=p),
+                               group + [first, last])
+                found.update(topic_id for topic_id, _ in cursor.fetchall())
+            stored = set()
+            for ts, topic_id, _ in rows:
+                if topic_id not in found:
+                    continue
+                cursor.execute('''SELECT COUNT(*) FROM data
+                                  WHERE topic_id = {p} AND ts = {p}'''.format(
+                                      p=p), (topic_id, ts))
+                if cursor.fetchone()[0]:
+                    stored.add((topic_id, ts))
+        except Exception:
+            self.__disconnect()
+            raise
+        return stored
+
+    def update_rollups(self, rows, resolutions, replaced=()):
+        '''Merge (ts, topic_id, value) rows into the rollups of each of
+        resolutions on the writer connection, to be committed with them.
+
+        replaced holds the (topic_id, ts) of rows that overwrote stored
+        values, as returned by stored_rows before they were written.
+        Buckets holding those, or values repeated within rows, are
+        recomputed from the stored data instead so that no value is
+        counted twice.
+        '''
+        if not rows or not resolutions:
+            return True
+        buckets = {}
+        rebuild = set()
+        seen = set()
+        for ts, topic_id, value in rows:
+            seconds = epoch(ts)
+            keys = [(topic_id, resolution, seconds - seconds % resolution)
+                    for resolution in resolutions]
+            if (topic_id, ts) in replaced or (topic_id, ts) in seen:
+                rebuild.update(keys)
+                continue
+            seen.add((topic_id, ts))
+            value = numeric_value(value)
+            for key in keys:
+                bucket = buckets.get(key)
+                if bucket is None:
+                    buckets[key] = [1, value, value, value]
+                    continue
+                bucket[0] += 1
+                bucket[1] += value
+                if value < bucket[2]:
+                    bucket[2] = value
+                if value > bucket[3]:
+                    bucket[3] = value
+        params = [key + tuple(merged) for key, merged in buckets.iteritems()
+                  if key not in rebuild]
+        if params:
+            for query in self.rollup_queries():
+                if not self.write_many(query, params):
+                    return False
+        return not rebuild or self.rebuild_rollups(rebuild)
+
+    def rebuild_rollups(self, buckets):
+        '''Recompute the (topic_id, resolution, start) rollup buckets from
+        the data on the writer connection.'''
+        utc = datetime.utcfromtimestamp
+        p = self.placeholder
+        value = self.numeric_clause('data.value_string')
+        query = '''REPLACE INTO rollup (topic_id, resolution, ts,
+                       value_count, value_sum, value_min, value_max)
+                   SELECT data.topic_id, {p}, {p},
+                       COUNT(*), SUM({value}), MIN({value}), MAX({value})
+                   FROM data
+                   WHERE data.topic_id = {p}
+                   AND data.ts >= {p} AND data.ts < {p}
+                   GROUP BY data.topic_id'''.format(p=p, value=value)
+        return self.write_many(query, [
+            (resolution, start, topic_id, utc(start), utc(start + resolution))
+            for topic_id, resolution, start in buckets])
+
+    def build_rollups(self, resolutions):
+        '''Compute rollups of resolutions not yet in the rollup table from
+        all of the data already stored.
+
+        Rollups of other resolutions are dropped since they are no longer
+        maintained.  Returns the resolutions available, with any changes
+        committed.
+        '''
+        query = 'DELETE FROM rollup'
+        if resolutions:
+            query += ' WHERE resolution NOT IN ({})'.format(
+                ', '.join(str(int(r)) for r in resolutions))
+        try:
+            if not self.write(query) or not self.commit():
+                return []
+        except Exception as e:
+            # Tables are not created by the agent for mysql, so the rollup
+            # table only exists where it was added for them.
+            if resolutions:
+                _log.error('Rollups are disabled; unable to use the rollup '
+                           'table: {}'.format(e))
+            else:
+                _log.debug('No rollup table to clear: {}'.format(e))
+            return []
+
+        built = []
+        for resolution in resolutions:
+            rows = self.select('SELECT 1 FROM rollup WHERE resolution = {} '
+                               'LIMIT 1'.format(self.placeholder),
+                               [resolution])
+            if rows:
+                built.append(resolution)
+                continue
+            _log.info('Building {} second rollups from existing data; this '
+                      'may take a while.'.format(resolution))
+            if not self.build_rollup(resolution) or not self.commit():
+                break
+            built.append(resolution)
+        return built
+
+    def build_rollup(self, resolution):
+        '''Insert the rollups of resolution of the stored data, without
+        committing them.'''
+        stamp = self.epoch_clause('data.ts')
+        stamp = '({0} - {0} % {1})'.format(stamp, int(resolution))
+        value = self.numeric_clause('data.value_string')
+        query = '''INSERT INTO rollup (topic_id, resolution, ts,
+                       value_count, value_sum, value_min, value_max)
+                   SELECT data.topic_id, {resolution}, {stamp},
+                       COUNT(*), SUM({value}), MIN({value}), MAX({value})
+                   FROM data
+                   GROUP BY data.topic_id, {stamp}'''.format(
+            resolution=int(resolution), stamp=stamp, value=value)
+        return self.write(query)
+
+    def rollup_resolution(self, resolutions, start=None, end=None, agg=None,
+                          interval=None):
+        '''Return the coarsest of resolutions able to answer a query_multi
+        exactly, or None if the raw data must be used.'''
+        if agg not in ROLLUP_AGGREGATES:
+            return None
+        bounds = [ts for ts in (start, end) if ts is not None]
+        if any(ts.microsecond for ts in bounds):
+            return None
+        bounds = [epoch(ts) for ts in bounds]
+        for resolution in sorted(resolutions, reverse=True):
+            if interval is not None and interval % resolution:
+                continue
+            if any(seconds % resolution for seconds in bounds):
+                continue
+            return resolution
+        return None
+
+    def query_multi(self, topic_ids, start=None, end=None, agg=None,
+                    interval=None, resolutions=()):
+        '''Query many topics in one statement, optionally aggregated.
+
+        topic_ids maps topic names to ids, with None for unknown topics.
+        agg and interval are as described for the query_multi RPC of
+        BaseQueryHistorianAgent, as is the result.  Aggregates are read
+        from the coarsest of the maintained rollup resolutions that
+        divides interval and the range bounds, if any.
+        '''
+        results = dict((topic, {'timestamps': [], 'values': []})
+                       for topic in topic_ids)
+        names = dict((topic_id, topic)
+                     for topic, topic_id in topic_ids.iteritems()
+                     if topic_id is not None)
+        if not names:
+            return results
+
+        resolution = self.rollup_resolution(resolutions, start, end, agg,
+                                            interval)
+        if resolution is not None:
+            return self._query_rollups(results, names, resolution, start,
+                                       end, agg, interval)
+
+        p = self.placeholder
+        where_clauses = ['data.topic_id IN ({})'.format(
+            ', '.join([p] * len(names)))]
+        args = list(names)
+        if start is not None:
+            where_clauses.append('data.ts >= ' + p)
+            args.append(start)
+        if end is not None:
+            where_clauses.append('data.ts < ' + p)
+            args.append(end)
+        where = ' AND '.join(where_clauses)
+
+        if agg is None:
+            query = '''SELECT data.topic_id, data.ts, data.value_string
+                       FROM data
+                       WHERE {where}
+                       ORDER BY data.topic_id, data.ts'''.format(where=where)
+        else:
+            if interval is None:
+                bucket = None
+                group_by = 'data.topic_id'
+            else:
+                bucket = self.bucket_clause('data.ts', interval)
+                group_by = 'data.topic_id, stamp'
+            if agg == 'last':
+                # The value of the latest sample of each bucket is found
+                # by joining back on (topic_id, ts), which is unique.
+                query = '''SELECT data.topic_id, {outer}, data.value_string
+                           FROM data,
+                                (SELECT data.topic_id AS topic_id,
+                                        {stamp} AS stamp,
+                                        MAX(data.ts) AS ts
+                                 FROM data
+                                 WHERE {where}
+                                 GROUP BY {group_by}) AS latest
+                           WHERE data.topic_id = latest.topic_id
+                                 AND data.ts = latest.ts
+                           ORDER BY data.topic_id, data.ts'''
+                stamp = bucket or '0'
+                outer = ('latest.stamp' if bucket else
+                         self.epoch_clause('latest.ts'))
+                query = query.format(outer=outer, stamp=stamp, where=where,
+                                     group_by=group_by)
+            else:
+                query = '''SELECT data.topic_id, {stamp} AS stamp, {value}
+                           FROM data
+                           WHERE {where}
+                           GROUP BY {group_by}
+                           ORDER BY {group_by}'''
+                stamp = bucket or self.epoch_clause('MIN(data.ts)')
+                if agg == 'count':
+                    value = 'COUNT(*)'
+                else:
+                    value = '{}({})'.format(
+                        agg.upper(), self.numeric_clause('data.value_string'))
+                query = query.format(stamp=stamp, value=value, where=where,
+                                     group_by=group_by)
+
+        _log.debug("Real Query: " + query)
+        _log.debug("args: "+str(args))
+
+        loads = jsonapi.loads
+        utc = datetime.utcfromtimestamp
+        for row in self.select(query, args):
+            result = results[names[row[0]]]
+            if agg is None:
+                result['timestamps'].append(row[1].isoformat())
+            else:
+                result['timestamps'].append(utc(int(row[1])).isoformat())
+            if agg is None or agg == 'last':
+                result['values'].append(loads(row[2]))
+            else:
+                result['values'].append(row[2])
+        return results
+
+    def _query_rollups(self, results, names, resolution, start, end, agg,
+                       interval):
+        p = self.placeholder
+        where_clauses = ['rollup.topic_id IN ({})'.format(
+                             ', '.join([p] * len(names))),
+                         'rollup.resolution = ' + p]
+        args = list(names) + [resolution]
+        if start is not None:
+            where_clauses.append('rollup.ts >= ' + p)
+            args.append(epoch(start))
+        if end is not None:
+            where_clauses.append('rollup.ts < ' + p)
+            args.append(epoch(end))
+
+        if interval is None:
+            stamp = 'MIN(rollup.ts)'
+            group_by = 'rollup.topic_id'
+        else:
+            stamp = '(rollup.ts - rollup.ts % {})'.format(int(interval))
+            group_by = 'rollup.topic_id, stamp'
+        query = '''SELECT rollup.topic_id, {stamp} AS stamp, {value}
+                   FROM rollup
+                   WHERE {where}
+                   GROUP BY {group_by}
+                   ORDER BY {group_by}'''.format(
+            stamp=stamp, value=ROLLUP_AGGREGATES[agg],
+            where=' AND '.join(where_clauses), group_by=group_by)
+        _log.debug("Real Query: " + query)
+        _log.debug("args: "+str(args))
+
+        # Sums of integer columns may come back as decimals.
+        convert = int if agg == 'count' else float
+        utc = datetime.utcfromtimestamp
+        for topic_id, stamp, value in self.select(query, args):
+            result = results[names[topic_id]]
+            result['timestamps'].append(utc(int(stamp)).isoformat())
+            result['values'].append(convert(value))
+        return results
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+
+'''Compressed encoding of chunks of (timestamp, value) samples.
+
+Timestamps, in integer microseconds since the epoch, are stored as the
+delta of their deltas.  Float values are stored as the XOR with the
+previous value, integers and booleans as the difference from it, both in
+the manner of Facebook's Gorilla time series database.  Other values are
+stored as a compressed JSON list.  Chunks of a single sample type can be
+appended to without re-encoding.
+'''
+
+import calendar
+from datetime import datetime, timedelta
+from operator import itemgetter
+import struct
+import zlib
+
+from zmq.utils import jsonapi
+
+
+__all__ = ['ChunkEncoder', 'decode_chunk', 'from_micros', 'to_micros']
+
+
+_EPOCH = datetime(1970, 1, 1)
+
+# Integers are zigzag encoded and stored as a 0 bit for zero or a prefix
+# selecting the number of bits that follow.
+_INT_PREFIXES = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12),
+                 (0b11110, 5, 32), (0b11111, 5, 64))
+_INT_BITS = {1: 7, 2: 9, 3: 12, 4: 32, 5: 64}
+
+# Largest integer magnitude stored by difference rather than as JSON.
+_INT_LIMIT = 1 << 61
+
+_FLOAT = 'f'
+_INT = 'i'
+_BOOL = 'b'
+_JSON = 'j'
+
+_HEADER = struct.Struct('>cI')
+
+
+def to_micros(ts):
+    '''Return microseconds since the epoch of a naive UTC or aware datetime.'''
+    return calendar.timegm(ts.utctimetuple()) * 1000000 + ts.microsecond
+
+
+def from_micros(micros):
+    '''Return the naive UTC datetime of microseconds since the epoch.'''
+    return _EPOCH + timedelta(microseconds=micros)
+
+
+def _kind(value):
+    if isinstance(value, bool):
+        return _BOOL
+    if isinstance(value, (int, long)) and -_INT_LIMIT < value < _INT_LIMIT:
+        return _INT
+    if isinstance(value, float):
+        return _FLOAT
+    return _JSON
+
+
+def _float_bits(value):
+    return struct.unpack('>Q', struct.pack('>d', value))[0]
+
+
+def _bits_float(bits):
+    return struct.unpack('>d', struct.pack('>Q', bits))[0]
+
+
+class _BitWriter(object):
+    __slots__ = ('data', 'free')
+
+    def __init__(self):
+        self.data = bytearray()
+        self.free = 0
+
+    def write(self, value, nbits):
+        '''Write the low nbits of value, most significant first.'''
+        data = self.data
+        while nbits:
+            if not self.free:
+                data.append(0)
+                self.free = 8
+            take = min(self.free, nbits)
+            nbits -= take
+            self.free -= take
+            data[-1] |= ((value >> nbits) & ((1 << take) - 1)) << self.free
+
+    def write_int(self, value):
+        if not value:
+            self.write(0, 1)
+            return
+        value = value << 1 if value > 0 else (-value << 1) - 1
+        for prefix, prefix_bits, nbits in _INT_PREFIXES:
+            if value >> nbits == 0:
+                self.write(prefix, prefix_bits)
+                self.write(value, nbits)
+                return
+        raise ValueError('integer out of range')
+
+
+class _BitReader(object):
+    __slots__ = ('data', 'pos')
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, nbits):
+        data = self.data
+        value = 0
+        while nbits:
+            avail = 8 - (self.pos & 7)
+            take = min(avail, nbits)
+            value = (value << take) | (
+                (data[self.pos >> 3] >> (avail - take)) & ((1 << take) - 1))
+            self.pos += take
+            nbits -= take
+        return value
+
+    def read_int(self):
+        if not self.read(1):
+            return 0
+        ones = 1
+        while ones < 5 and self.read(1):
+            ones += 1
+        value = self.read(_INT_BITS[ones])
+        return -((value + 1) >> 1) if value & 1 else value >> 1
+
+
+class ChunkEncoder(object):
+    '''Encoder of the samples of a chunk in increasing timestamp order.'''
+
+    def __init__(self):
+        self.count = 0
+        self.last = None
+        self._kind = None
+        self._times = _BitWriter()
+        self._values = _BitWriter()
+        self._delta = 0
+        self._previous = None
+        self._leading = None
+        self._trailing = None
+        self._json = None
+
+    @classmethod
+    def from_samples(cls, samples):
+        '''Return an encoder of (micros, value) samples sorted by time.'''
+        encoder = cls()
+        kinds = set(_kind(value) for micros, value in samples)
+        if len(kinds) > 1:
+            encoder._kind = _JSON
+            encoder._json = []
+        for micros, value in samples:
+            encoder.append(micros, value)
+        return encoder
+
+    def append(self, micros, value):
+        '''Append a sample, returning False if it is not later than the
+        last or its type does not fit the chunk.'''
+        kind = _kind(value)
+        if self._kind is None:
+            self._kind = kind
+            if kind == _JSON:
+                self._json = []
+        elif self._kind != _JSON and kind != self._kind:
+            return False
+        if self.last is not None and micros <= self.last:
+            return False
+
+        times = self._times
+        if self.last is None:
+            times.write_int(micros)
+        else:
+            delta = micros - self.last
+            times.write_int(delta - self._delta)
+            self._delta = delta
+        self.last = micros
+
+        if self._kind == _FLOAT:
+            self._append_float(value)
+        elif self._kind == _JSON:
+            self._json.append(value)
+        else:
+            value = int(value)
+            if self._previous is None:
+                self._values.write_int(value)
+            else:
+                self._values.write_int(value - self._previous)
+            self._previous = value
+        self.count += 1
+        return True
+
+    def _append_float(self, value):
+        bits = _float_bits(value)
+        writer = self._values
+        if self._previous is None:
+            writer.write(bits, 64)
+            self._previous = bits
+            return
+        xor = bits ^ self._previous
+        self._previous = bits
+        if not xor:
+            writer.write(0, 1)
+            return
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if (self._leading is not None and leading >= self._leading and
+                trailing >= self._trailing):
+            writer.write(0b10, 2)
+            writer.write(xor >> self._trailing,
+                         64 - self._leading - self._trailing)
+            return
+        meaningful = 64 - leading - trailing
+        writer.write(0b11, 2)
+        writer.write(leading, 5)
+        writer.write(meaningful - 1, 6)
+        writer.write(xor >> trailing, meaningful)
+        self._leading = leading
+        self._trailing = trailing
+
+    def extend(self, samples):
+        '''Add (micros, value) samples, returning the encoder holding the
+        result.  That is a new encoder, with later samples replacing
+        earlier ones of the same time, when they could not be appended.'''
+        samples = sorted(samples, key=itemgetter(0))
+        for index, (micros, value) in enumerate(samples):
+            if not self.append(micros, value):
+                merged = dict(self.samples())
+                merged.update(samples[index:])
+                return ChunkEncoder.from_samples(
+                    sorted(merged.iteritems(), key=itemgetter(0)))
+        return self
+
+    def samples(self):
+        return decode_chunk(self.blob(), self.count)
+
+    def blob(self):
+        '''Return the encoded chunk.'''
+        if self._kind == _JSON:
+            values = zlib.compress(jsonapi.dumps(self._json))
+        else:
+            values = bytes(self._values.data)
+        times = bytes(self._times.data)
+        return _HEADER.pack(self._kind or _JSON, len(times)) + times + values
+
+
+def decode_chunk(blob, count):
+    '''Return the list of (micros, value) samples of an encoded chunk.'''
+    blob = bytearray(blob)
+    kind, length = _HEADER.unpack(bytes(blob[:_HEADER.size]))
+    times = _BitReader(blob[_HEADER.size:_HEADER.size + length])
+    values = blob[_HEADER.size + length:]
+
+    stamps = []
+    micros = delta = 0
+    for index in xrange(count):
+        if index == 0:
+            micros = times.read_int()
+        else:
+            delta += times.read_int()
+            micros += delta
+        stamps.append(micros)
+
+    if kind == _JSON:
+        return zip(stamps, jsonapi.loads(zlib.decompress(bytes(values))))
+
+    reader = _BitReader(values)
+    decoded = []
+    if kind == _FLOAT:
+        bits = leading = trailing = 0
+        for index in xrange(count):
+            if index == 0:
+                bits = reader.read(64)
+            elif reader.read(1):
+                if reader.read(1):
+                    leading = reader.read(5)
+                    meaningful = reader.read(6) + 1
+                    trailing = 64 - leading - meaningful
+                else:
+                    meaningful = 64 - leading - trailing
+                bits ^= reader.read(meaningful) << trailing
+            decoded.append(_bits_float(bits))
+    else:
+        value = 0
+        for index in xrange(count):
+            value += reader.read_int()
+            decoded.append(value)
+        if kind == _BOOL:
+            decoded = [bool(flag) for flag in decoded]
+    return zip(stamps, decoded)
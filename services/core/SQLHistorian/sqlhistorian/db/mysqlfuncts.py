@@ -58,8 +58,10 @@
 import errno
 import logging
 import os
+import threading
 
 #from mysql import connector
+from mysql.connector import errors, pooling
 from zmq.utils import jsonapi
 
 from basedb import DbDriver
@@ -68,29 +70,95 @@ from volttron.platform.agent import utils
 utils.setup_logging()
 _log = logging.getLogger(__name__)
 
+# Connection pools shared by drivers with the same connection parameters,
+# such as the reader and writer of a historian.
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(params, pool_size):
+    key = tuple(sorted(params.items()))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = pooling.MySQLConnectionPool(pool_size=pool_size, **params)
+            _pools[key] = pool
+    return pool
+
+
 class MySqlFuncts(DbDriver):
 
-    def __init__(self, **kwargs):
+    placeholder = '%s'
+    concurrent_writes = True
+
+    def __init__(self, pool_size=4, **kwargs):
         #kwargs['dbapimodule'] = 'mysql.connector'
+        try:
+            self._pool = _get_pool(kwargs, pool_size) if pool_size else None
+        except errors.Error as e:
+            _log.exception(e)
+            raise AttributeError("Couldn't connect using specified "
+                                 "configuration credentials")
         super(MySqlFuncts, self).__init__('mysql.connector', **kwargs)
+        self._check_indexes()
+
+    def _check_indexes(self):
+        '''Warn when the data table lacks the (topic_id, ts) index.
+
+        Tables are not created by the agent for mysql, so neither is the
+        index; building it on a large table should be scheduled by the
+        administrator.
+        '''
+        try:
+            rows = self.select('''SELECT 1 FROM information_schema.statistics
+                                  WHERE table_schema = DATABASE()
+                                  AND table_name = 'data'
+                                  AND index_name = 'data_topic_ts_idx' ''')
+        except errors.Error as e:
+            _log.debug('unable to inspect indexes: {}'.format(e))
+            return
+        if not rows:
+            _log.warning('data table has no (topic_id, ts) index; single '
+                         'topic queries will be slow.  Create it with: '
+                         'CREATE INDEX data_topic_ts_idx ON data (topic_id, ts)')
+
+    def connect(self):
+        '''Return a pooled connection; closing it returns it to the pool.'''
+        if self._pool is not None:
+            try:
+                return self._pool.get_connection()
+            except errors.PoolError:
+                _log.debug('connection pool exhausted; connecting directly')
+        return super(MySqlFuncts, self).connect()
         
     def query(self, topic, start=None, end=None, skip=0,
-                            count=None, order="FIRST_TO_LAST"):
+                            count=None, order="FIRST_TO_LAST", topic_id=None):
         """This function should return the results of a query in the form:
         {"values": [(timestamp1, value1), (timestamp2, value2), ...],
          "metadata": {"key1": value1, "key2": value2, ...}}
 
          metadata is not required (The caller will normalize this to {} for you)
         """
-        query = '''SELECT data.ts, data.value_string
-                   FROM data, topics
-                   {where}
-                   {order_by}
-                   {limit}
-                   {offset}'''
+        if topic_id is None:
+            query = '''SELECT data.ts, data.value_string
+                       FROM data, topics
+                       {where}
+                       {order_by}
+                       {limit}
+                       {offset}'''
+
+            where_clauses = ["WHERE topics.topic_name = %s", "topics.topic_id = data.topic_id"]
+            args = [topic]
+        else:
+            query = '''SELECT data.ts, data.value_string
+                       FROM data
+                       {where}
+                       {order_by}
+                       {limit}
+                       {offset}'''
 
-        where_clauses = ["WHERE topics.topic_name = %s", "topics.topic_id = data.topic_id"]
-        args = [topic]
+            where_clauses = ["WHERE data.topic_id = %s"]
+            args = [topic_id]
 
         if start is not None:
             where_clauses.append("data.ts > %s")
@@ -130,7 +198,7 @@ class MySqlFuncts(DbDriver):
         _log.debug("Real Query: " + real_query)
         _log.debug("args: "+str(args))
 
-        rows = self.select(real_query)
+        rows = self.select(real_query, args)
         
         if rows:
             values = [(ts.isoformat(), jsonapi.loads(value)) for ts, value in rows]
@@ -139,6 +207,23 @@ class MySqlFuncts(DbDriver):
         
         return {'values':values}
     
+    def epoch_clause(self, column):
+        # Unlike UNIX_TIMESTAMP this ignores the session time zone, as do
+        # the naive timestamps stored by the historian.
+        return "TIMESTAMPDIFF(SECOND, '1970-01-01 00:00:00', {})".format(
+            column)
+
+    def numeric_clause(self, column):
+        return '({} + 0.0)'.format(column)
+
+    def rollup_queries(self):
+        return ['''INSERT INTO rollup VALUES (%s, %s, %s, %s, %s, %s, %s)
+                   ON DUPLICATE KEY UPDATE
+                       value_count = value_count + VALUES(value_count),
+                       value_sum = value_sum + VALUES(value_sum),
+                       value_min = LEAST(value_min, VALUES(value_min)),
+                       value_max = GREATEST(value_max, VALUES(value_max))''']
+
     def insert_data_query(self):
         return '''REPLACE INTO data values(%s, %s, %s)'''
         
@@ -55,22 +55,44 @@
 # under Contract DE-AC05-76RL01830
 #}}}
 
+from bisect import bisect_left
+from collections import defaultdict, OrderedDict
+from datetime import datetime
 import errno
+from itertools import groupby, islice
 import logging
+from operator import itemgetter
 import os
 import sqlite3
+import threading
 
 from zmq.utils import jsonapi
 
-from basedb import DbDriver
+from basedb import DbDriver, numeric_value
+from chunks import ChunkEncoder, decode_chunk, from_micros, to_micros
 from volttron.platform.agent import utils
 
 utils.setup_logging()
 _log = logging.getLogger(__name__)
 
+ENGINES = ('rows', 'chunks')
+
+
 class SqlLiteFuncts(DbDriver):
+    '''Driver for sqlite3 databases.
+
+    With the rows engine every value is a row of the data table.  The
+    chunks engine instead stores the values of each topic in compressed
+    chunks of chunk_seconds, one row of the chunks table each.  The
+    current chunks of up to chunk_cache_size topics are kept in memory to
+    be appended to.  Rows already in the data table are still read.
+    '''
 
-    def __init__(self, database, **kwargs):
+    def __init__(self, database, engine='rows', chunk_seconds=3600,
+                 chunk_cache_size=100000, **kwargs):
+        if engine not in ENGINES:
+            raise ValueError('engine must be one of {}'.format(
+                ', '.join(ENGINES)))
 
         if database == ':memory:':
             self.__database = database
@@ -101,10 +123,66 @@ class SqlLiteFuncts(DbDriver):
         cursor.execute('''CREATE INDEX IF NOT EXISTS data_idx
                                 ON data (ts ASC)''')
 
+        # Single topic range queries need an index led by topic_id.
+        # Databases created before it existed are migrated here.
+        cursor.execute('''SELECT name FROM sqlite_master
+                          WHERE type='index' AND name='data_topic_ts_idx' ''')
+        if cursor.fetchone() is None:
+            _log.info('Creating (topic_id, ts) index on {}; this may take a '
+                      'while for large databases.'.format(self.__database))
+            cursor.execute('''CREATE INDEX data_topic_ts_idx
+                                    ON data (topic_id, ts)''')
+
         cursor.execute('''CREATE TABLE IF NOT EXISTS topics
                                 (topic_id INTEGER PRIMARY KEY,
                                  topic_name TEXT NOT NULL,
                                  UNIQUE(topic_name))''')
+
+        cursor.execute('''CREATE TABLE IF NOT EXISTS rollup
+                                (topic_id INTEGER NOT NULL,
+                                 resolution INTEGER NOT NULL,
+                                 ts INTEGER NOT NULL,
+                                 value_count INTEGER NOT NULL,
+                                 value_sum REAL NOT NULL,
+                                 value_min REAL NOT NULL,
+                                 value_max REAL NOT NULL,
+                                 PRIMARY KEY (topic_id, resolution, ts))''')
+
+        if engine == 'chunks':
+            cursor.execute('''CREATE TABLE IF NOT EXISTS chunks
+                                    (topic_id INTEGER NOT NULL,
+                                     start INTEGER NOT NULL,
+                                     count INTEGER NOT NULL,
+                                     data BLOB NOT NULL,
+                                     PRIMARY KEY (topic_id, start))''')
+            # Chunks are located by their start so their length is fixed
+            # when the first is written.
+            cursor.execute('''CREATE TABLE IF NOT EXISTS chunk_settings
+                                    (name TEXT PRIMARY KEY,
+                                     value INTEGER NOT NULL)''')
+            cursor.execute('''INSERT OR IGNORE INTO chunk_settings
+                              VALUES ('chunk_seconds', ?)''',
+                           (int(chunk_seconds),))
+            cursor.execute('''SELECT value FROM chunk_settings
+                              WHERE name = 'chunk_seconds' ''')
+            stored = cursor.fetchone()[0]
+            if stored != int(chunk_seconds):
+                _log.warning('Using the chunk_seconds of {} the database was '
+                             'created with.'.format(stored))
+            chunk_seconds = stored
+            cursor.execute('SELECT 1 FROM data LIMIT 1')
+            self.__has_rows = cursor.fetchone() is not None
+        else:
+            self.__has_rows = True
+        self.__engine = engine
+        self.__chunk_seconds = chunk_seconds
+        self.__chunk_cache_size = chunk_cache_size
+        # The encoder of the latest chunk written of each topic.
+        self.__chunks = OrderedDict()
+        # The encoders of the chunks written since the last commit.
+        self.__written = {}
+        # The (topic_id, ts) of the values those replaced.
+        self.__replaced = set()
         conn.commit()
         conn.close()
         
@@ -120,26 +198,54 @@ class SqlLiteFuncts(DbDriver):
         
         print (kwargs)    
         super(SqlLiteFuncts, self).__init__('sqlite3', **kwargs)
-        
+        self.__local = threading.local()
+
+    def __reader(self):
+        '''Return the read connection of the calling thread.'''
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.__database,
+                detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+            self.__local.connection = connection
+        return connection
 
 
     def query(self, topic, start=None, end=None, skip=0,
-                            count=None, order="FIRST_TO_LAST"):
+                            count=None, order="FIRST_TO_LAST", topic_id=None):
         """This function should return the results of a query in the form:
         {"values": [(timestamp1, value1), (timestamp2, value2), ...],
          "metadata": {"key1": value1, "key2": value2, ...}}
 
          metadata is not required (The caller will normalize this to {} for you)
         """
-        query = '''SELECT data.ts, data.value_string
-                   FROM data, topics
-                   {where}
-                   {order_by}
-                   {limit}
-                   {offset}'''
+        if self.__engine == 'chunks':
+            return self.__query_chunks(topic, start, end, skip, count, order,
+                                       topic_id)
+        return self.__query_rows(topic, start, end, skip, count, order,
+                                 topic_id)
 
-        where_clauses = ["WHERE topics.topic_name = ?", "topics.topic_id = data.topic_id"]
-        args = [topic]
+    def __query_rows(self, topic, start, end, skip, count, order, topic_id):
+        if topic_id is None:
+            query = '''SELECT data.ts, data.value_string
+                       FROM data, topics
+                       {where}
+                       {order_by}
+                       {limit}
+                       {offset}'''
+
+            where_clauses = ["WHERE topics.topic_name = ?", "topics.topic_id = data.topic_id"]
+            args = [topic]
+        else:
+            query = '''SELECT data.ts, data.value_string
+                       FROM data
+                       {where}
+                       {order_by}
+                       {limit}
+                       {offset}'''
+
+            where_clauses = ["WHERE data.topic_id = ?"]
+            args = [topic_id]
 
         if start is not None:
             where_clauses.append("data.ts > ?")
@@ -178,13 +284,273 @@ class SqlLiteFuncts(DbDriver):
         _log.debug("Real Query: " + real_query)
         _log.debug("args: "+str(args))
 
-        c = sqlite3.connect(self.__database, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-        rows = c.execute(real_query,args)
+        rows = self.__reader().execute(real_query,args)
 
-        values = [(ts.isoformat(), jsonapi.loads(value)) for ts, value in rows]
-        _log.debug("QueryResults: " + str(values))
+        loads = jsonapi.loads
+        values = [(ts.isoformat(), loads(value)) for ts, value in rows]
         return {'values':values}
 
+    def __query_chunks(self, topic, start, end, skip, count, order,
+                       topic_id):
+        if topic_id is None:
+            row = self.__reader().execute(
+                'SELECT topic_id FROM topics WHERE topic_name = ?',
+                (topic,)).fetchone()
+            if row is None:
+                return {'values': []}
+            topic_id = row[0]
+        stop = None if count is None or count < 0 else skip + count
+        descending = order == 'LAST_TO_FIRST'
+
+        values = [(from_micros(micros).isoformat(), value)
+                  for micros, value in islice(
+                      self.__samples(topic_id, start, end, descending),
+                      0, stop)]
+        if self.__has_rows:
+            values.extend(self.__query_rows(
+                topic, start, end, 0, -1 if stop is None else stop, order,
+                topic_id)['values'])
+            values.sort(key=itemgetter(0), reverse=descending)
+        return {'values': values[skip:stop]}
+
+    def __samples(self, topic_id, start, end, descending=False,
+                  inclusive=False):
+        '''Yield the (micros, value) samples of topic_id after start, or
+        from it if inclusive, and before end.'''
+        span = self.__chunk_seconds
+        where_clauses = ['topic_id = ?']
+        args = [topic_id]
+        first = last = None
+        if start is not None:
+            first = to_micros(start)
+            where_clauses.append('start >= ?')
+            args.append(first // 1000000 // span * span)
+        if end is not None:
+            last = to_micros(end)
+            where_clauses.append('start <= ?')
+            args.append(last // 1000000)
+        rows = self.__reader().execute(
+            '''SELECT count, data FROM chunks
+               WHERE {}
+               ORDER BY start {}'''.format(' AND '.join(where_clauses),
+                                          'DESC' if descending else 'ASC'),
+            args)
+        for count, data in rows:
+            samples = decode_chunk(data, count)
+            if descending:
+                samples.reverse()
+            for micros, value in samples:
+                if first is not None and (
+                        micros < first or micros == first and not inclusive):
+                    continue
+                if last is not None and micros >= last:
+                    continue
+                yield micros, value
+
+    def insert_data_many(self, rows):
+        if self.__engine != 'chunks':
+            return super(SqlLiteFuncts, self).insert_data_many(rows)
+        span = self.__chunk_seconds
+        groups = defaultdict(list)
+        for ts, topic_id, value in rows:
+            micros = to_micros(ts)
+            groups[(topic_id, micros // 1000000 // span * span)].append(
+                (micros, value))
+        params = []
+        written = self.__written = {}
+        replaced = set()
+        chunks = self.__chunks
+        for key, samples in groups.iteritems():
+            chunk = self.__open_chunk(key)
+            last = chunk.last
+            encoder = written[key] = chunk.extend(samples)
+            # Late or repeated values make extend return a new encoder,
+            # which must replace the cached one to be appended to next.
+            if encoder is not chunk:
+                if key[0] in chunks:
+                    chunks[key[0]] = (key[1], encoder)
+                # Samples appended before that are all after last.
+                stored = set(micros for micros, _ in chunk.samples()
+                             if last is not None and micros <= last)
+                replaced.update((key[0], micros) for micros, _ in samples
+                                if micros in stored)
+            params.append(key + (encoder.count,
+                                 sqlite3.Binary(encoder.blob())))
+        self.__replaced = set((topic_id, ts) for ts, topic_id, _ in rows
+                              if (topic_id, to_micros(ts)) in replaced)
+        if not self.write_many(
+                'INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)', params):
+            self.__chunks.clear()
+            written.clear()
+            self.__replaced.clear()
+            return False
+        return True
+
+    def __open_chunk(self, key):
+        '''Return the encoder of the chunk of a (topic_id, start) key.'''
+        topic_id, start = key
+        chunks = self.__chunks
+        entry = chunks.pop(topic_id, None)
+        if entry is not None and entry[0] == start:
+            encoder = entry[1]
+        else:
+            row = self.__reader().execute(
+                'SELECT count, data FROM chunks WHERE topic_id = ? AND start = ?',
+                key).fetchone()
+            if row is None:
+                encoder = ChunkEncoder()
+            else:
+                encoder = ChunkEncoder.from_samples(decode_chunk(row[1], row[0]))
+        chunks[topic_id] = (start, encoder)
+        if len(chunks) > self.__chunk_cache_size:
+            chunks.popitem(last=False)
+        return encoder
+
+    def rollback(self):
+        # Cached chunks may hold values that were not committed.
+        self.__chunks.clear()
+        self.__written.clear()
+        self.__replaced.clear()
+        return super(SqlLiteFuncts, self).rollback()
+
+    def stored_rows(self, rows):
+        if self.__engine != 'chunks':
+            return super(SqlLiteFuncts, self).stored_rows(rows)
+        # Values replaced in chunks are found as they are written.
+        return set()
+
+    def update_rollups(self, rows, resolutions, replaced=()):
+        if self.__engine == 'chunks':
+            replaced = self.__replaced
+        return super(SqlLiteFuncts, self).update_rollups(rows, resolutions,
+                                                         replaced)
+
+    def rebuild_rollups(self, buckets):
+        if self.__engine != 'chunks':
+            return super(SqlLiteFuncts, self).rebuild_rollups(buckets)
+        topic_buckets = defaultdict(set)
+        for topic_id, resolution, start in buckets:
+            topic_buckets[topic_id].add((resolution, start))
+        params = []
+        for topic_id, starts in topic_buckets.iteritems():
+            params.extend(self.__rollups(topic_id, starts))
+        return self.write_many(
+            'INSERT OR REPLACE INTO rollup VALUES (?, ?, ?, ?, ?, ?, ?)',
+            params)
+
+    def __rollups(self, topic_id, buckets):
+        '''Return the rollup rows of the (resolution, start) buckets of
+        topic_id computed from all of its values, including those in
+        chunks written but not yet committed.'''
+        span = self.__chunk_seconds
+        reader = self.__reader()
+        starts = set()
+        for resolution, start in buckets:
+            starts.update(xrange(start // span * span, start + resolution,
+                                 span))
+        samples = []
+        for start in starts:
+            encoder = self.__written.get((topic_id, start))
+            if encoder is not None:
+                samples.extend(encoder.samples())
+                continue
+            row = reader.execute(
+                'SELECT count, data FROM chunks WHERE topic_id = ? AND start = ?',
+                (topic_id, start)).fetchone()
+            if row is not None:
+                samples.extend(decode_chunk(row[1], row[0]))
+        if self.__has_rows:
+            first = min(start for _, start in buckets)
+            last = max(start + resolution for resolution, start in buckets)
+            loads = jsonapi.loads
+            samples.extend(
+                (to_micros(ts), loads(value)) for ts, value in reader.execute(
+                    '''SELECT ts, value_string FROM data
+                       WHERE topic_id = ? AND ts >= ? AND ts < ?''',
+                    (topic_id, datetime.utcfromtimestamp(first),
+                     datetime.utcfromtimestamp(last))))
+        samples.sort(key=itemgetter(0))
+        times = [micros for micros, _ in samples]
+        rollups = []
+        for resolution, start in buckets:
+            values = [numeric_value(value) for _, value in samples[
+                bisect_left(times, start * 1000000):
+                bisect_left(times, (start + resolution) * 1000000)]]
+            if values:
+                rollups.append((topic_id, resolution, start, len(values),
+                                sum(values), min(values), max(values)))
+        return rollups
+
+    def build_rollup(self, resolution):
+        if not super(SqlLiteFuncts, self).build_rollup(resolution):
+            return False
+        if self.__engine != 'chunks':
+            return True
+        # Chunks written by earlier batches are committed by now.
+        self.__written = {}
+        rows = self.__reader().execute(
+            'SELECT topic_id, count, data FROM chunks ORDER BY topic_id')
+        for topic_id, chunks in groupby(rows, itemgetter(0)):
+            buckets = set()
+            for _, count, data in chunks:
+                for micros, _ in decode_chunk(data, count):
+                    seconds = micros // 1000000
+                    buckets.add((resolution, seconds - seconds % resolution))
+            if not self.write_many(
+                    'INSERT OR REPLACE INTO rollup VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    self.__rollups(topic_id, buckets)):
+                return False
+        return True
+
+    def query_multi(self, topic_ids, start=None, end=None, agg=None,
+                    interval=None, resolutions=()):
+        if (self.__engine != 'chunks' or self.rollup_resolution(
+                resolutions, start, end, agg, interval) is not None):
+            return super(SqlLiteFuncts, self).query_multi(
+                topic_ids, start, end, agg, interval, resolutions)
+
+        if self.__has_rows:
+            rows = super(SqlLiteFuncts, self).query_multi(topic_ids, start,
+                                                          end)
+        results = {}
+        for topic, topic_id in topic_ids.iteritems():
+            result = results[topic] = {'timestamps': [], 'values': []}
+            if topic_id is None:
+                continue
+            samples = self.__samples(topic_id, start, end, inclusive=True)
+            if self.__has_rows:
+                samples = list(samples)
+                stored = rows[topic]
+                samples.extend((to_micros(datetime_from_iso(ts)), value)
+                               for ts, value in zip(stored['timestamps'],
+                                                    stored['values']))
+                samples.sort(key=itemgetter(0))
+            _aggregate(result, samples, agg, interval)
+        return results
+
+    def epoch_clause(self, column):
+        return "CAST(strftime('%s', {}) AS INTEGER)".format(column)
+
+    def bucket_clause(self, column, interval):
+        # Integer division already floors the non-negative epoch.
+        return '({} / {}) * {}'.format(
+            self.epoch_clause(column), int(interval), int(interval))
+
+    def numeric_clause(self, column):
+        return 'CAST({} AS REAL)'.format(column)
+
+    def rollup_queries(self):
+        # Both statements take the same parameters, numbered so the
+        # insert can leave out the ones the update adds.
+        return ['''INSERT OR IGNORE INTO rollup
+                   VALUES (?1, ?2, ?3, 0, 0, ?6, ?7)''',
+                '''UPDATE rollup
+                   SET value_count = value_count + ?4,
+                       value_sum = value_sum + ?5,
+                       value_min = MIN(value_min, ?6),
+                       value_max = MAX(value_max, ?7)
+                   WHERE topic_id = ?1 AND resolution = ?2 AND ts = ?3''']
+
     def insert_data_query(self):
         return '''INSERT OR REPLACE INTO data values(?, ?, ?)'''
     
@@ -194,4 +560,47 @@ class SqlLiteFuncts(DbDriver):
     def get_topic_map(self):
         q = "SELECT topic_id, topic_name FROM topics"
         rows = self.select(q, None)
-        return dict([(n, t) for t, n in rows])
\ No newline at end of file
+        return dict([(n, t) for t, n in rows])
+
+
+def datetime_from_iso(value):
+    '''Return the naive datetime of an isoformat() string.'''
+    if '.' in value:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+def _aggregate(result, samples, agg, interval):
+    '''Fill result from (micros, value) samples as query_multi does.'''
+    timestamps = result['timestamps']
+    values = result['values']
+    if agg is None:
+        for micros, value in samples:
+            timestamps.append(from_micros(micros).isoformat())
+            values.append(value)
+        return
+    if interval is None:
+        key = lambda sample: None
+    else:
+        key = lambda sample: (sample[0] // 1000000 -
+                              sample[0] // 1000000 % interval)
+    for bucket, group in groupby(samples, key):
+        group = list(group)
+        if bucket is None:
+            sample = group[-1] if agg == 'last' else group[0]
+            bucket = sample[0] // 1000000
+        timestamps.append(from_micros(bucket * 1000000).isoformat())
+        if agg == 'last':
+            values.append(group[-1][1])
+        elif agg == 'count':
+            values.append(len(group))
+        else:
+            numbers = [numeric_value(value) for micros, value in group]
+            if agg == 'avg':
+                values.append(sum(numbers) / len(numbers))
+            elif agg == 'sum':
+                values.append(sum(numbers))
+            elif agg == 'min':
+                values.append(min(numbers))
+            else:
+                values.append(max(numbers))
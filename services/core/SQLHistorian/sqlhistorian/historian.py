@@ -61,6 +61,7 @@ import logging
 import os, os.path
 from pprint import pprint
 import sys
+import threading
 import uuid
 
 import gevent
@@ -92,6 +93,11 @@ def historian(config_path, **kwargs):
     params = connection.get('params', None)
     assert params is not None
     identity = config.get('identity', kwargs.pop('identity', None))
+    # Resolutions, in seconds, of the rollups to maintain.
+    rollup_resolutions = sorted(set(int(r)
+                                    for r in config.get('rollups', [])))
+    if any(r < 1 for r in rollup_resolutions):
+        raise ValueError('rollups must be positive numbers of seconds')
 
     
     mod_name = databaseType+"functs"
@@ -99,8 +105,8 @@ def historian(config_path, **kwargs):
     loaded_mod = __import__(mod_name_path, fromlist=[mod_name])
     
     for name, cls in inspect.getmembers(loaded_mod):
-        # assume class is not the root dbdriver
-        if inspect.isclass(cls) and name != 'DbDriver':
+        # assume the driver is the class defined by the module
+        if inspect.isclass(cls) and cls.__module__ == loaded_mod.__name__:
             DbFuncts = cls
             break
     try:
@@ -115,6 +121,37 @@ def historian(config_path, **kwargs):
         of the BaseHistorianAgent.
         '''
 
+        # Rollup resolutions maintained and used for queries, which are
+        # set once any missing rollups have been built.
+        rollups = ()
+
+        @property
+        def writer(self):
+            '''The database driver writing from the calling thread.
+
+            Each publishing thread has its own, with its own connection.
+            '''
+            writer = getattr(self._writers, 'writer', None)
+            if writer is None:
+                writer = self._writers.writer = DbFuncts(
+                    **connection['params'])
+            return writer
+
+        def _insert_topic(self, topic):
+            '''Return the id of topic, adding it if it is new.'''
+            with self._topic_lock:
+                topic_id = self.topic_map.get(topic)
+                if topic_id is None:
+                    _log.debug('Inserting topic: {}'.format(topic))
+                    writer = self.writer
+                    topic_id = writer.insert_topic(topic)[0]
+                    # Commit the topic before another publishing thread
+                    # can find it in the map.
+                    writer.commit()
+                    self.topic_map[topic] = topic_id
+                    _log.debug('TopicId: {} => {}'.format(topic_id, topic))
+            return topic_id
+
         @Core.receiver("onstart")
         def starting(self, sender, **kwargs):
             
@@ -164,7 +201,7 @@ def historian(config_path, **kwargs):
                 self.topic_map = self.reader.get_topic_map()
 
             try:
-                real_published = []
+                rows = []
                 for x in to_publish_list:
                     ts = x['timestamp']
                     topic = x['topic']
@@ -174,16 +211,18 @@ def historian(config_path, **kwargs):
                     topic_id = self.topic_map.get(topic, None)
     
                     if topic_id is None:
-                        _log.debug('Inserting topic: {}'.format(topic))
-                        row  = self.writer.insert_topic(topic)
-                        topic_id = row[0]
-                        self.topic_map[topic] = topic_id
-                        _log.debug('TopicId: {} => {}'.format(topic_id, topic))
+                        topic_id = self._insert_topic(topic)
                     
-                    if self.writer.insert_data(ts,topic_id, value):
-                        #_log.debug('item was inserted')
-                        real_published.append(x)
-                if len(real_published) > 0:            
+                    rows.append((ts, topic_id, value))
+                # The whole batch, at most submit_size_limit rows, is
+                # written with a single executemany and committed along
+                # with the rollups it updates.  Rollups are only
+                # recomputed where values were written again.
+                replaced = (self.writer.stored_rows(rows) if self.rollups
+                            else set())
+                if (rows and self.writer.insert_data_many(rows) and
+                        self.writer.update_rollups(rows, self.rollups,
+                                                   replaced)):
                     if self.writer.commit():
                         _log.debug('published {} data values'.format(len(to_publish_list)))
                         self.report_all_handled()
@@ -214,16 +253,44 @@ def historian(config_path, **kwargs):
              metadata is not required (The caller will normalize this to {} for you)
             """
             return self.reader.query(topic, start=start, end=end, skip=skip,
-                                     count=count, order=order)
+                                     count=count, order=order,
+                                     topic_id=self.topic_map.get(topic))
+
+        def query_historian_multi(self, topic_names, start=None, end=None,
+                                  agg=None, interval=None):
+            topic_ids = dict((topic, self.topic_map.get(topic))
+                             for topic in topic_names)
+            return self.reader.query_multi(topic_ids, start=start, end=end,
+                                           agg=agg, interval=interval,
+                                           resolutions=self.rollups)
 
         def historian_setup(self):
+            self._writers = threading.local()
+            self._topic_lock = threading.Lock()
             try:
-                self.writer = DbFuncts(**connection['params'])
+                writer = self.writer
             except AttributeError as exc:
                 print(exc)
                 self.core.stop()
+                return
+            self.rollups = tuple(writer.build_rollups(rollup_resolutions))
 
     SQLHistorian.__name__ = 'SQLHistorian'
+    if 'submit_size_limit' in config:
+        kwargs['submit_size_limit'] = config['submit_size_limit']
+    for name in ('query_cache_size', 'query_cache_values',
+                 'backup_commit_interval',
+                 'backup_synchronous', 'backup_storage_limit_gb',
+                 'backup_overflow_policy', 'publish_workers'):
+        if name in config:
+            kwargs[name] = config[name]
+    if (int(kwargs.get('publish_workers', 1)) > 1 and
+            not DbFuncts.concurrent_writes):
+        # SQLite allows one writer at a time and the chunks engine keeps
+        # the chunks being appended to in its driver.
+        _log.warning('{} does not support concurrent writes; publishing '
+                     'from a single thread.'.format(DbFuncts.__name__))
+        kwargs['publish_workers'] = 1
     return SQLHistorian(identity=identity, **kwargs)
 
 
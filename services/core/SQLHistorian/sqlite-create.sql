@@ -5,7 +5,17 @@ CREATE TABLE IF NOT EXISTS data (ts timestamp NOT NULL,
                                  UNIQUE(ts, topic_id));
             
 CREATE INDEX IF NOT EXISTS data_idx ON data (ts ASC);
+CREATE INDEX IF NOT EXISTS data_topic_ts_idx ON data (topic_id, ts);
 
 CREATE TABLE IF NOT EXISTS topics (topic_id INTEGER PRIMARY KEY, 
                                  topic_name TEXT NOT NULL,
                                  UNIQUE(topic_name));
+
+CREATE TABLE IF NOT EXISTS rollup (topic_id INTEGER NOT NULL,
+                                 resolution INTEGER NOT NULL,
+                                 ts INTEGER NOT NULL,
+                                 value_count INTEGER NOT NULL,
+                                 value_sum REAL NOT NULL,
+                                 value_min REAL NOT NULL,
+                                 value_max REAL NOT NULL,
+                                 PRIMARY KEY (topic_id, resolution, ts));
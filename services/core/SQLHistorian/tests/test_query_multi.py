@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+from datetime import datetime, timedelta
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'sqlhistorian', 'db'))
+
+from sqlitefuncts import SqlLiteFuncts
+
+START = datetime(2015, 1, 1)
+
+
+def minute(n):
+    return START + timedelta(minutes=n)
+
+
+class QueryMultiTests(unittest.TestCase):
+    '''query_multi over raw values stored with the rows engine.'''
+
+    engine = 'rows'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.driver = SqlLiteFuncts(
+            database=os.path.join(self.directory, 'historian.sqlite'),
+            engine=self.engine)
+        self.topics = {}
+        for name in ('a', 'b'):
+            self.topics[name] = self.driver.insert_topic(name)[0]
+        self.topics['missing'] = None
+        rows = [(minute(n), self.topics['a'], float(n)) for n in range(6)]
+        rows.append((minute(1), self.topics['b'], 10))
+        rows.append((minute(4), self.topics['b'], 20))
+        self.assertTrue(self.driver.insert_data_many(rows))
+        self.assertTrue(self.driver.commit())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def query(self, **kwargs):
+        return self.driver.query_multi(self.topics, **kwargs)
+
+    def test_raw(self):
+        results = self.query(start=minute(1), end=minute(4))
+        self.assertEqual(results['a'], {
+            'timestamps': [minute(n).isoformat() for n in (1, 2, 3)],
+            'values': [1.0, 2.0, 3.0]})
+        self.assertEqual(results['b']['values'], [10])
+        self.assertEqual(results['missing'],
+                         {'timestamps': [], 'values': []})
+
+    def test_aggregate(self):
+        for agg, a, b in (('avg', 2.5, 15), ('min', 0, 10), ('max', 5, 20),
+                          ('sum', 15, 30), ('count', 6, 2),
+                          ('last', 5.0, 20)):
+            results = self.query(agg=agg)
+            self.assertEqual(results['a']['values'], [a], agg)
+            self.assertEqual(results['b']['values'], [b], agg)
+
+    def test_interval(self):
+        results = self.query(agg='sum', interval=180)
+        self.assertEqual(results['a'], {
+            'timestamps': [minute(0).isoformat(), minute(3).isoformat()],
+            'values': [3, 12]})
+        results = self.query(agg='last', interval=180)
+        self.assertEqual(results['b']['values'], [10, 20])
+
+
+class ChunkQueryMultiTests(QueryMultiTests):
+    '''query_multi over values stored with the chunks engine.'''
+
+    engine = 'chunks'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+from datetime import datetime, timedelta
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'sqlhistorian', 'db'))
+
+from sqlitefuncts import SqlLiteFuncts
+
+START = datetime(2015, 1, 1)
+RESOLUTIONS = (900, 3600)
+
+
+def minute(n):
+    return START + timedelta(minutes=n)
+
+
+class RollupTests(unittest.TestCase):
+    '''Rollups maintained as batches are written with the rows engine.'''
+
+    engine = 'rows'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.driver = SqlLiteFuncts(
+            database=os.path.join(self.directory, 'historian.sqlite'),
+            engine=self.engine)
+        self.topic_id = self.driver.insert_topic('device/point')[0]
+        self.driver.commit()
+        self.assertEqual(self.driver.build_rollups(RESOLUTIONS),
+                         list(RESOLUTIONS))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def insert(self, *samples):
+        rows = [(minute(n), self.topic_id, value) for n, value in samples]
+        replaced = self.driver.stored_rows(rows)
+        self.assertTrue(self.driver.insert_data_many(rows))
+        self.assertTrue(self.driver.update_rollups(rows, RESOLUTIONS,
+                                                   replaced))
+        self.assertTrue(self.driver.commit())
+        return replaced
+
+    def assertRollups(self):
+        topics = {'device/point': self.topic_id}
+        end = START + timedelta(days=1)
+        for agg in ('count', 'sum', 'min', 'max'):
+            for interval in RESOLUTIONS:
+                self.assertEqual(
+                    self.driver.query_multi(topics, START, end, agg,
+                                            interval, RESOLUTIONS),
+                    self.driver.query_multi(topics, START, end, agg,
+                                            interval))
+
+    def test_incremental(self):
+        self.assertEqual(self.insert((0, 1.0), (1, 2.0), (20, 4.0)), set())
+        self.assertEqual(self.insert((2, 3.0), (70, 5.0)), set())
+        self.assertRollups()
+
+    def test_written_again(self):
+        self.insert((0, 1.0), (1, 2.0), (20, 4.0))
+        replaced = self.insert((1, 2.0), (2, 3.0))
+        if self.engine == 'rows':
+            self.assertEqual(replaced, set([(self.topic_id, minute(1))]))
+        self.insert((0, 7.0), (61, 1.0))
+        self.assertRollups()
+        topics = {'device/point': self.topic_id}
+        self.assertEqual(
+            self.driver.query_multi(topics, START, START + timedelta(hours=1),
+                                    'count', 3600, RESOLUTIONS),
+            {'device/point': {'timestamps': [START.isoformat()],
+                              'values': [4]}})
+
+    def test_repeated_in_batch(self):
+        self.insert((0, 1.0), (1, 2.0), (1, 2.0), (30, 3.0))
+        self.assertRollups()
+
+    def test_rebuild(self):
+        self.insert((0, 1.0), (1, 2.0), (20, 4.0), (70, 5.0))
+        self.insert((1, 3.0))
+        before = sorted(self.driver.select('SELECT * FROM rollup'))
+        self.driver.build_rollups([])
+        self.driver.build_rollups(RESOLUTIONS)
+        self.assertEqual(sorted(self.driver.select('SELECT * FROM rollup')),
+                         before)
+
+
+class ChunkRollupTests(RollupTests):
+    '''Rollups maintained as batches are written with the chunks engine.'''
+
+    engine = 'chunks'
+
+
+if __name__ == '__main__':
+    unittest.main()
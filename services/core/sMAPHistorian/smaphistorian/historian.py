@@ -56,17 +56,18 @@
 
 import calendar
 import datetime
+import gzip
 import logging
 import requests
 import sys
 import uuid
 import time
+from cStringIO import StringIO
 
 import pytz
 from pytz import timezone
 
-from volttron.platform.agent.base_historian import (BaseHistorianAgent,
-                                                    BaseQueryHistorianAgent)
+from volttron.platform.agent.base_historian import BaseHistorian, Uploader
 from volttron.platform.agent import utils, matching
 from volttron.platform.messaging import topics, headers as headers_mod
 from zmq.utils import jsonapi
@@ -93,8 +94,13 @@ def SMAPHistorianAgent(config_path, **kwargs):
     _backend_url = '{}/backend'.format(_config['archiver_url'])
     _add_url = '{backend_url}/add/{key}'.format(backend_url=_backend_url,
                                                 key=_config.get('key'))
+    # Readings per upload request, number of requests in flight at once and
+    # whether request bodies are gzipped.
+    _chunk_size = max(int(_config.get('upload_chunk_size', 1000)), 1)
+    _upload_workers = max(int(_config.get('upload_workers', 4)), 1)
+    _compress = _config.get('compress_uploads', True)
 
-    class Agent(BaseHistorianAgent, BaseQueryHistorianAgent):
+    class Agent(BaseHistorian):
         '''This is a simple example of a historian agent that writes data
         to an sMAP historian. It is designed to test some of the functionality
         of the BaseHistorianAgent.
@@ -117,16 +123,19 @@ def SMAPHistorianAgent(config_path, **kwargs):
                        'type' - ex: 'float'
                        'tz' - ex: 'America/Los_Angeles'
             '''
-            success = []
-            failure = []
-
+            # (items, {topic: entry}) per upload, filled in batch order so
+            # that a topic's readings stay in time order across chunks.
+            chunks = []
+            items = []
             publish = {}
+            readings = 0
 
             # add items to global topic and uuid lists if they don't exist
             for item in to_publish_list:
                 
                 if 'topic' not in item.keys():
                     _log.error('topic or uuid not found in {}'.format(item))
+                    self.report_handled(item)
                     continue
 
                 topic = item['topic']
@@ -158,8 +167,13 @@ def SMAPHistorianAgent(config_path, **kwargs):
                 if item_uuid is None:
                     item_uuid = str(uuid.uuid4())
                     # just in case of duplicate
-                    while item_uuid in self._topic_to_uuid.values():
+                    while item_uuid in self._uuids:
                         item_uuid = str(uuid.uuid4())
+                    # Claim the uuid now so later readings of the topic,
+                    # in this batch or a retry of it, reuse the stream.
+                    self._topic_to_uuid[topic] = item_uuid
+                    self._uuids.add(item_uuid)
+                    self._new_topics.add(topic)
 
 
                 # protect data if SourceName already present
@@ -199,46 +213,84 @@ def SMAPHistorianAgent(config_path, **kwargs):
             #    mytz = timezone(meta['tz'])
             #    mydt = utc.astimezone(mytz)
 #                 meta.pop('tz',None)
-                publish[topic] = \
-                {'Metadata': meta,
-                 'Properties': {'Timezone': meta['tz'],
-                                'UnitofMeasure': meta['units'],
-                                'ReadingType': meta['type']
-                               },
-                 'Readings': [[calendar.timegm(mydt.utctimetuple())*1000, item['value']]],
-                 'uuid': item_uuid
-                }
-                
-            response = requests.post(_add_url, data=jsonapi.dumps(publish),verify=False)
-            
-            if response.ok:
-                for topic in publish.keys():
-                    if topic not in self._topic_to_uuid.keys():
-                        _log.info('Adding new topic: {}'.format(topic))
-                        self._topic_to_uuid[topic] = publish[topic]['uuid']
-
-                self.report_all_handled()
-            else:
+                reading = [calendar.timegm(mydt.utctimetuple())*1000,
+                           item['value']]
+                entry = publish.get(topic)
+                if entry is None:
+                    entry = publish[topic] = {'Readings': [],
+                                              'uuid': item_uuid}
+                # The latest metadata seen for a topic wins.
+                entry['Metadata'] = meta
+                entry['Properties'] = {'Timezone': meta['tz'],
+                                       'UnitofMeasure': meta['units'],
+                                       'ReadingType': meta['type']}
+                entry['Readings'].append(reading)
+                items.append(item)
+                readings += 1
+                if readings >= _chunk_size:
+                    chunks.append((items, publish))
+                    items = []
+                    publish = {}
+                    readings = 0
+
+            if items:
+                chunks.append((items, publish))
+
+            # Each chunk is acknowledged on its own so a failed upload only
+            # holds back the readings it carried.
+            results = self._uploader.map(
+                self._upload, [chunk[1] for chunk in chunks])
+            for (items, publish), ok in zip(chunks, results):
+                if ok:
+                    for topic in publish:
+                        if topic in self._new_topics:
+                            _log.info('Adding new topic: {}'.format(topic))
+                            self._new_topics.discard(topic)
+                    self.report_handled(items)
+
+        def _upload(self, publish):
+            body = jsonapi.dumps(publish)
+            headers = {'Content-Type': 'application/json'}
+            if _compress:
+                buf = StringIO()
+                with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                    f.write(body)
+                body = buf.getvalue()
+                headers['Content-Encoding'] = 'gzip'
+            try:
+                response = self._uploader.session.post(
+                    _add_url, data=body, headers=headers, verify=False)
+            except requests.RequestException as exc:
+                _log.error('Unable to reach server for {} topics: {}'
+                           .format(len(publish), exc))
+                return False
+
+            if not response.ok:
                 _log.error('Invalid response from server for {}'
                            .format(jsonapi.dumps(publish)))
+            return response.ok
 
         def historian_setup(self):
             # reset paths in case we ever use this to dynamically switch
             # Archivers
             self._topic_to_uuid = {}
+            self._uuids = set()
+            self._new_topics = set()
+            self._uploader = Uploader(_upload_workers)
             # Fetch existing paths
             source = _config["source"]
             archiver_url = _config["archiver_url"]
             payload = ('select uuid where Metadata/SourceName="{source}"'
                        .format(source=source))
 
-            resp = requests.post("{url}/backend/api/query?key={key}"
+            resp = self._uploader.session.post("{url}/backend/api/query?key={key}"
                                  .format(url=archiver_url, key=_config['key']), data=payload,verify=False)
 
             # get dictionary of response
             response = jsonapi.loads(resp.text)
             for path in response:
                 self._topic_to_uuid[path["Path"]] = path["uuid"]
+                self._uuids.add(path["uuid"])
 
     Agent.__name__ = 'SMAPHistorianAgent'
     return Agent(**kwargs)
@@ -74,6 +74,7 @@ requirements = [
     'BACpypes>=0.10,<2',
     'gevent>=0.13,<2',
     'monotonic',
+    'msgpack-python>=0.4,<1',
     'pymodbus>=1.2,<2',
     'setuptools',
     'simplejson>=3.3,<4',
@@ -57,18 +57,21 @@
 
 from __future__ import absolute_import, print_function
 from abc import abstractmethod
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict, Sequence
 from dateutil.parser import parse
 from datetime import datetime, timedelta
+from itertools import izip
 import logging
 from pprint import pprint
 from Queue import Queue, Empty
 import re
 import sqlite3
-from threading import Thread
+from threading import Lock, Thread, local as thread_local
+import time
 
 import gevent
 import pytz
+import requests
 from zmq.utils import jsonapi
 
 from volttron.platform.agent.utils import process_timestamp
@@ -79,8 +82,112 @@ from volttron.platform.messaging import topics, headers as headers_mod
 _log = logging.getLogger(__name__)
 
 ACTUATOR_TOPIC_PREFIX_PARTS = len(topics.ACTUATOR_VALUE.split('/'))
+QUERY_AGGREGATES = ('avg', 'min', 'max', 'sum', 'count', 'last')
+BACKUP_OVERFLOW_POLICIES = ('drop-oldest', 'downsample-oldest')
+# Free pages returned to the file system after each cleanup; a bound on
+# the work done per publish cycle.
+BACKUP_VACUUM_PAGES = 1024
+# Seconds over which the backup drain rate is measured.
+BACKUP_RATE_WINDOW = 60
 ALL_REX = re.compile('.*/all$')
 
+
+class ScrapeRecord(object):
+    '''All point values of a single device scrape, stored column-wise.
+
+    A record replaces one queue item per point with a shared source,
+    timestamp and topic prefix plus parallel lists of point names and
+    values.  Iterating a record yields the equivalent per-point items.
+    '''
+
+    __slots__ = ('source', 'timestamp', 'prefix', 'names', 'values', 'meta')
+
+    def __init__(self, source, timestamp, prefix, names, values, meta=None):
+        self.source = source
+        self.timestamp = timestamp
+        self.prefix = prefix
+        self.names = names
+        self.values = values
+        self.meta = meta or {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        prefix = self.prefix + '/'
+        for name, value in izip(self.names, self.values):
+            yield {'source': self.source,
+                   'topic': prefix + name,
+                   'readings': [(self.timestamp, value)],
+                   'meta': self.meta.get(name, {})}
+
+
+class PublishList(Sequence):
+    '''Lazy per-point view of values read from the backup database.
+
+    Rows are kept as read and converted to the dictionaries expected by
+    publish_to_historian only when accessed.  Historians able to handle
+    whole batches may use columns() instead.
+    '''
+
+    def __init__(self, rows, topics, meta_data):
+        self._rows = rows
+        self._topics = topics
+        self._meta_data = meta_data
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _item(self, row):
+        _id, timestamp, source, topic_id, value = row
+        return {'_id': _id,
+                'timestamp': timestamp.replace(tzinfo=pytz.UTC),
+                'source': source,
+                'topic': self._topics[topic_id],
+                'value': jsonapi.loads(value),
+                'meta': self._meta_data[(source, topic_id)].copy()}
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._item(row) for row in self._rows[index]]
+        return self._item(self._rows[index])
+
+    def __iter__(self):
+        return (self._item(row) for row in self._rows)
+
+    def ids(self):
+        return [row[0] for row in self._rows]
+
+    def last(self):
+        '''Return the (ts, id) of the last row of the batch.'''
+        row = self._rows[-1]
+        return row[1], row[0]
+
+    def topics(self):
+        '''Return the set of topics in the batch.'''
+        topics = self._topics
+        return set(topics[row[3]] for row in self._rows)
+
+    def columns(self):
+        '''Return a dictionary of parallel lists of the batch values.'''
+        topics = self._topics
+        rows = self._rows
+        return {'_id': [row[0] for row in rows],
+                'timestamp': [row[1].replace(tzinfo=pytz.UTC)
+                              for row in rows],
+                'source': [row[2] for row in rows],
+                'topic': [topics[row[3]] for row in rows],
+                'value': [jsonapi.loads(row[4]) for row in rows]}
+
+
+class _PublishResult(object):
+    __slots__ = ('batch', 'handled')
+
+    def __init__(self, batch, handled):
+        self.batch = batch
+        self.handled = handled
+
+
 class BaseHistorianAgent(Agent):
     '''This is the base agent for historian Agents.
     It automatically subscribes to all device publish topics.
@@ -102,23 +209,72 @@ class BaseHistorianAgent(Agent):
     This base historian will cache all received messages to a local database
     before publishing it to the historian.  This allows recovery for unexpected
     happenings before the successful writing of data to the historian.
+
+    The backup database uses write-ahead logging with the given synchronous
+    level.  New values are committed at most every backup_commit_interval
+    seconds (0 commits after every batch); successful publishes always
+    commit.
+
+    When backup_storage_limit_gb is set and the values waiting to be
+    published outgrow it, the oldest are evicted according to
+    backup_overflow_policy: drop-oldest deletes them while
+    downsample-oldest first thins them to every other sample of each
+    topic.  Space freed is returned to the file system incrementally.
+
+    With publish_workers greater than 1 the processing thread only stores
+    incoming values and hands disjoint batches of the backup to that many
+    publishing threads, which call publish_to_historian concurrently.
+    Values reported handled are tracked per batch.  publish_to_historian
+    must then be safe to call from several threads; historian_setup still
+    runs once, in the processing thread.
     '''
 
     def __init__(self,
                  retry_period=300.0,
                  submit_size_limit=1000,
                  max_time_publishing=30,
+                 backup_commit_interval=0,
+                 backup_synchronous='NORMAL',
+                 backup_storage_limit_gb=None,
+                 backup_overflow_policy='drop-oldest',
+                 publish_workers=1,
                  **kwargs):
         super(BaseHistorianAgent, self).__init__(**kwargs)
+        if backup_overflow_policy not in BACKUP_OVERFLOW_POLICIES:
+            raise ValueError('backup_overflow_policy must be one of {}'.format(
+                ', '.join(BACKUP_OVERFLOW_POLICIES)))
         self._started = False
         self._retry_period = retry_period
         self._submit_size_limit = submit_size_limit
         self._max_time_publishing = timedelta(seconds=max_time_publishing)
+        self._backup_commit_interval = timedelta(seconds=backup_commit_interval)
+        self._backup_synchronous = backup_synchronous
+        self._backup_storage_limit = (
+            None if backup_storage_limit_gb is None else
+            int(backup_storage_limit_gb * 1024 ** 3))
+        self._backup_overflow_policy = backup_overflow_policy
+        self._last_backup_commit = datetime.min
+        # Maintained by the processing thread for get_backup_stats.
+        self._backlog = 0
+        self._backup_bytes = 0
+        self._backup_file_bytes = 0
+        self._evicted = 0
+        self._published = 0
+        self._drained = deque()
+        self._publish_workers = max(int(publish_workers), 1)
+        self._publish_queue = Queue()
+        # Values handled by the batch a publishing thread is working on.
+        self._handling = thread_local()
         self._successful_published = set()
         self._meta_data = defaultdict(dict)
+        # Backup topic ids by topic prefix and point name
+        self._point_ids = defaultdict(dict)
 
         self._event_queue = Queue()
-        self._process_thread = Thread(target = self._process_loop)
+        if self._publish_workers > 1:
+            self._process_thread = Thread(target=self._parallel_process_loop)
+        else:
+            self._process_thread = Thread(target = self._process_loop)
         self._process_thread.daemon = True  # Don't wait on thread to exit.
         self._process_thread.start()
         # The topic cache is only meant as a local lookup and should not be
@@ -308,12 +464,9 @@ class BaseHistorianAgent(Agent):
         _log.debug("Queuing {topic} from {source} for publish".format(topic=topic,
                                                                       source=source))
         
-        for key, value in values.iteritems():
-            point_topic = device + '/' + key
-            self._event_queue.put({'source': source,
-                                   'topic': point_topic,
-                                   'readings': [(timestamp,value)],
-                                   'meta': meta.get(key,{})})
+        self._event_queue.put(ScrapeRecord(source, timestamp, device,
+                                           values.keys(), values.values(),
+                                           meta))
 
     def capture_actuator_data(self, topic, headers, message, match):
         '''Capture actuation data and submit it to be published by a historian.
@@ -409,7 +562,8 @@ class BaseHistorianAgent(Agent):
                 
                 if not self._any_sucessfull_publishes():
                     break
-                self._cleanup_successful_publishes()
+                self._cleanup_successful_publishes(to_publish_list)
+                self.topics_published(to_publish_list.topics())
 
                 now = datetime.utcnow()
                 if now - start_time > self._max_time_publishing:
@@ -417,6 +571,86 @@ class BaseHistorianAgent(Agent):
                     break
         _log.debug("Finished processing")
 
+    def _parallel_process_loop(self):
+        '''
+        Process loop storing values and dispatching batches to publishing
+        threads, used when there is more than one.  Only this thread uses
+        the backup database; results come back through the event queue.
+        '''
+
+        _log.debug("Starting parallel process loop.")
+        self._setup_backup_db()
+        self.historian_setup()
+
+        for _ in range(self._publish_workers):
+            worker = Thread(target=self._publish_worker)
+            worker.daemon = True
+            worker.start()
+
+        in_flight = 0
+        # Batches are read after the last value dispatched, in (ts, id)
+        # order, until none are in flight.
+        after = None
+        paused = False
+
+        while True:
+            if in_flight:
+                block, timeout = True, None
+            elif paused or not self._backlog or not self._started:
+                block, timeout = True, self._retry_period
+            else:
+                block, timeout = False, None
+            try:
+                items = [self._event_queue.get(block, timeout)]
+            except Empty:
+                items = []
+                paused = False
+            while True:
+                try:
+                    items.append(self._event_queue.get_nowait())
+                except Empty:
+                    break
+
+            new_to_publish = []
+            for item in items:
+                if not isinstance(item, _PublishResult):
+                    new_to_publish.append(item)
+                    continue
+                in_flight -= 1
+                if item.handled:
+                    self._successful_published = item.handled
+                    self._cleanup_successful_publishes(item.batch)
+                    self.topics_published(item.batch.topics())
+                else:
+                    # Wait for new values or the retry period, as the
+                    # single threaded loop does.
+                    paused = True
+            if new_to_publish:
+                paused = False
+            self._backup_new_to_publish(new_to_publish)
+
+            if not in_flight:
+                after = None
+            while (not paused and self._started and
+                   in_flight < self._publish_workers):
+                batch = self._get_outstanding_to_publish(after)
+                if not batch:
+                    break
+                after = batch.last()
+                self._publish_queue.put(batch)
+                in_flight += 1
+
+    def _publish_worker(self):
+        while True:
+            batch = self._publish_queue.get()
+            handled = self._handling.values = set()
+            try:
+                self.publish_to_historian(batch)
+            except Exception:
+                _log.exception("An unhandled exception occured while "
+                               "publishing to the historian.")
+            self._event_queue.put(_PublishResult(batch, handled))
+
     def _setup_backup_db(self):
         ''' Creates a backup database for the historian if doesn't exist.'''
 
@@ -426,10 +660,18 @@ class BaseHistorianAgent(Agent):
 
         c = self._connection.cursor()
         c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='outstanding';")
+        new_db = c.fetchone() is None
+        if new_db:
+            # The vacuum mode of a new database only takes effect if it is
+            # set before the first table is created or WAL is enabled.
+            self._connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
 
-        if c.fetchone() is None:
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        self._connection.execute(
+            'PRAGMA synchronous = {}'.format(self._backup_synchronous))
+
+        if new_db:
             _log.debug("Configuring backup BD for the first time.")
-            self._connection.execute('''PRAGMA auto_vacuum = FULL''')
             self._connection.execute('''CREATE TABLE outstanding
                                         (id INTEGER PRIMARY KEY,
                                          ts timestamp NOT NULL,
@@ -437,6 +679,17 @@ class BaseHistorianAgent(Agent):
                                          topic_id INTEGER NOT NULL,
                                          value_string TEXT NOT NULL,
                                          UNIQUE(ts, topic_id, source))''')
+        else:
+            c.execute('PRAGMA auto_vacuum')
+            if c.fetchone()[0] != 2:
+                # Vacuuming every delete made each cleanup slower as the
+                # backlog grew.  The mode only changes on a VACUUM.
+                _log.info('Converting backup DB to incremental vacuum.')
+                self._connection.commit()
+                self._connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                self._connection.execute('VACUUM')
+            c.execute('SELECT COUNT(*) FROM outstanding')
+            self._backlog = c.fetchone()[0]
 
         c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='metadata';")
 
@@ -468,97 +721,250 @@ class BaseHistorianAgent(Agent):
         c.close()
 
         self._connection.commit()
+        self._update_backup_size()
 
-    def _get_outstanding_to_publish(self):
+    def _get_outstanding_to_publish(self, after=None):
         _log.debug("Getting oldest outstanding to publish.")
         c = self._connection.cursor()
-        c.execute('select * from outstanding order by ts limit ?', (self._submit_size_limit,))
-
-        results = []
-        for row in c:
-            _id = row[0]
-            timestamp = row[1]
-            source = row[2]
-            topic_id = row[3]
-            value = jsonapi.loads(row[4])
-            meta = self._meta_data[(source, topic_id)].copy()
-            results.append({'_id':_id,
-                            'timestamp': timestamp.replace(tzinfo=pytz.UTC),
-                            'source': source,
-                            'topic': self._backup_cache[topic_id],
-                            'value': value,
-                            'meta': meta})
-
+        if after is None:
+            c.execute('select * from outstanding order by ts, id limit ?',
+                      (self._submit_size_limit,))
+        else:
+            ts, _id = after
+            c.execute('''select * from outstanding
+                         where ts > ? or (ts = ? and id > ?)
+                         order by ts, id limit ?''',
+                      (ts, ts, _id, self._submit_size_limit))
+        rows = c.fetchall()
         c.close()
+        if after is None and len(rows) < self._submit_size_limit:
+            # The whole backlog was read; correct the running count.
+            self._backlog = len(rows)
 
-        return results
+        return PublishList(rows, self._backup_cache, self._meta_data)
 
-    def _cleanup_successful_publishes(self):
+    def _cleanup_successful_publishes(self, to_publish_list):
         _log.debug("Cleaning up successfully published values.")
         c = self._connection.cursor()
 
         if None in self._successful_published:
-            c.execute('''DELETE FROM outstanding
-                        WHERE ROWID IN
-                        (SELECT ROWID FROM outstanding
-                          ORDER BY ts LIMIT ?)''', (self._submit_size_limit,))
+            ids = to_publish_list.ids()
         else:
-            temp = list(self._successful_published)
-            temp.sort()
-            c.executemany('''DELETE FROM outstanding
-                            WHERE id = ?''',
-                            ((_id,) for _id in
-                             self._successful_published))
+            ids = self._successful_published
+        # Ids of a batch are mostly consecutive, so delete them by range.
+        c.executemany('''DELETE FROM outstanding
+                        WHERE id BETWEEN ? AND ?''', _id_ranges(ids))
+        deleted = c.rowcount
+        c.execute('PRAGMA incremental_vacuum({})'.format(BACKUP_VACUUM_PAGES))
+        c.fetchall()
+        c.close()
 
         self._connection.commit()
 
         self._successful_published = set()
+        self._backlog = max(self._backlog - deleted, 0)
+        self._published += deleted
+        now = time.time()
+        self._drained.append((now, deleted))
+        while self._drained[0][0] < now - BACKUP_RATE_WINDOW:
+            self._drained.popleft()
+        self._update_backup_size()
+
+    def _update_backup_size(self):
+        c = self._connection.cursor()
+        c.execute('PRAGMA page_size')
+        page_size = c.fetchone()[0]
+        c.execute('PRAGMA page_count')
+        page_count = c.fetchone()[0]
+        c.execute('PRAGMA freelist_count')
+        free_count = c.fetchone()[0]
+        c.close()
+        self._backup_file_bytes = page_count * page_size
+        self._backup_bytes = (page_count - free_count) * page_size
+
+    def _enforce_backup_limit(self):
+        '''Evict the oldest values until the backup fits its limit.'''
+        limit = self._backup_storage_limit
+        evicted = self._evicted
+        c = self._connection.cursor()
+        while self._backup_bytes > limit and self._backlog:
+            # Estimate the rows to remove from the average row size.
+            excess = self._backup_bytes - limit
+            count = max(self._backlog * excess // self._backup_bytes + 1,
+                        self._submit_size_limit)
+            deleted = 0
+            if self._backup_overflow_policy == 'downsample-oldest':
+                deleted = self._downsample_oldest(c, count * 2)
+            if not deleted:
+                c.execute('''DELETE FROM outstanding
+                             WHERE id IN
+                             (SELECT id FROM outstanding
+                              ORDER BY ts LIMIT ?)''', (count,))
+                deleted = c.rowcount
+            if deleted <= 0:
+                break
+            self._backlog = max(self._backlog - deleted, 0)
+            self._evicted += deleted
+            self._update_backup_size()
+        _log.warning('Backup cache over its storage limit; {} oldest values '
+                     'evicted.'.format(self._evicted - evicted))
+        c.execute('PRAGMA incremental_vacuum')
+        c.fetchall()
+        c.close()
+        self._connection.commit()
+        self._last_backup_commit = datetime.utcnow()
+        self._update_backup_size()
+
+    def _downsample_oldest(self, c, count):
+        '''Delete every other value of each topic among the count oldest.'''
+        c.execute('''SELECT id, topic_id, source FROM outstanding
+                     ORDER BY ts LIMIT ?''', (count,))
+        keep = {}
+        ids = []
+        for _id, topic_id, source in c.fetchall():
+            key = (topic_id, source)
+            if keep.get(key, True):
+                keep[key] = False
+            else:
+                keep[key] = True
+                ids.append(_id)
+        # Every other scrape is dropped, so the ids mostly form ranges.
+        c.executemany('''DELETE FROM outstanding
+                         WHERE id BETWEEN ? AND ?''', _id_ranges(ids))
+        return max(c.rowcount, 0) if ids else 0
+
+    @RPC.export
+    def get_backup_stats(self):
+        '''Return the state of the backup cache.
+
+        backlog is the number of values waiting to be published, bytes
+        the space they use and file_bytes the size of the file.
+        drain_rate is the values published per second over the last
+        minute.
+        '''
+        now = time.time()
+        drained = sum(count for ts, count in list(self._drained)
+                      if ts >= now - BACKUP_RATE_WINDOW)
+        return {'backlog': self._backlog,
+                'bytes': self._backup_bytes,
+                'file_bytes': self._backup_file_bytes,
+                'limit_bytes': self._backup_storage_limit,
+                'overflow_policy': self._backup_overflow_policy,
+                'published': self._published,
+                'evicted': self._evicted,
+                'drain_rate': float(drained) / BACKUP_RATE_WINDOW}
 
     def _any_sucessfull_publishes(self):
         return bool(self._successful_published)
 
     def _backup_new_to_publish(self, new_publish_list):
         _log.debug("Backing up unpublished values.")
+        if not new_publish_list:
+            return
         c = self._connection.cursor()
+        backup_cache = self._backup_cache
+        meta_data = self._meta_data
+        meta_rows = []
+        value_rows = []
+        dumps = jsonapi.dumps
 
         for item in new_publish_list:
+            if isinstance(item, ScrapeRecord):
+                self._backup_record(c, item, meta_rows, value_rows)
+                continue
             source = item['source']
             topic = item['topic']
             meta = item.get('meta', {})
             values = item['readings']
 
-            topic_id = self._backup_cache.get(topic)
+            topic_id = backup_cache.get(topic)
 
             if topic_id is None:
-                c.execute('''INSERT INTO topics values (?,?)''', (None, topic))
-                c.execute('''SELECT last_insert_rowid()''')
-                row = c.fetchone()
-                topic_id = row[0]
-                self._backup_cache[topic_id] = topic
-                self._backup_cache[topic] = topic_id
+                topic_id = self._backup_topic(c, topic)
 
+            # Only write metadata which differs from what is stored.
+            current = meta_data[(source, topic_id)]
             for name, value in meta.iteritems():
-                c.execute('''INSERT OR REPLACE INTO metadata values(?, ?, ?, ?)''',
-                            (source,topic_id,name,value))
-                self._meta_data[(source,topic_id)][name] = value
-
+                if current.get(name) != value:
+                    current[name] = value
+                    meta_rows.append((source, topic_id, name, value))
 
-            
             for timestamp, value in values:
-                c.execute('''INSERT OR REPLACE INTO outstanding values(NULL, ?, ?, ?, ?)''',
-                          (timestamp,source,topic_id,jsonapi.dumps(value)))
+                value_rows.append((timestamp, source, topic_id, dumps(value)))
+
+        if meta_rows:
+            c.executemany('''INSERT OR REPLACE INTO metadata values(?, ?, ?, ?)''',
+                          meta_rows)
+        # Insert new values first so rowcount counts only added rows,
+        # then overwrite the values of any that were already stored.
+        c.executemany('''INSERT OR IGNORE INTO outstanding values(NULL, ?, ?, ?, ?)''',
+                      value_rows)
+        inserted = max(c.rowcount, 0)
+        if inserted < len(value_rows):
+            c.executemany('''UPDATE outstanding SET value_string = ?
+                             WHERE ts = ? AND source = ? AND topic_id = ?''',
+                          ((row[3], row[0], row[1], row[2])
+                           for row in value_rows))
+        self._backlog += inserted
+        c.close()
 
-        self._connection.commit()
+        now = datetime.utcnow()
+        if now - self._last_backup_commit >= self._backup_commit_interval:
+            self._connection.commit()
+            self._last_backup_commit = now
+
+        if self._backup_storage_limit is not None:
+            self._update_backup_size()
+            if self._backup_bytes > self._backup_storage_limit:
+                self._enforce_backup_limit()
+
+    def _backup_topic(self, c, topic):
+        '''Add topic to the backup database and return its id.'''
+        topic_id = self._backup_cache.get(topic)
+        if topic_id is None:
+            c.execute('''INSERT INTO topics values (?,?)''', (None, topic))
+            topic_id = c.lastrowid
+            self._backup_cache[topic_id] = topic
+            self._backup_cache[topic] = topic_id
+        return topic_id
+
+    def _backup_record(self, c, record, meta_rows, value_rows):
+        '''Append the backup rows of a ScrapeRecord to the row lists.'''
+        source = record.source
+        timestamp = record.timestamp
+        point_ids = self._point_ids[record.prefix]
+        point_meta = record.meta
+        meta_data = self._meta_data
+        dumps = jsonapi.dumps
+        for name, value in izip(record.names, record.values):
+            topic_id = point_ids.get(name)
+            if topic_id is None:
+                topic_id = self._backup_topic(c, record.prefix + '/' + name)
+                point_ids[name] = topic_id
+            meta = point_meta.get(name)
+            if meta:
+                current = meta_data[(source, topic_id)]
+                for key, meta_value in meta.iteritems():
+                    if current.get(key) != meta_value:
+                        current[key] = meta_value
+                        meta_rows.append((source, topic_id, key, meta_value))
+            value_rows.append((timestamp, source, topic_id, dumps(value)))
+
+    def _handled(self):
+        return getattr(self._handling, 'values', self._successful_published)
 
     def report_handled(self, record):
-        if isinstance(record, list):
+        handled = self._handled()
+        if isinstance(record, PublishList):
+            handled.update(record.ids())
+        elif isinstance(record, list):
             for x in record:
-                self._successful_published.add(x['_id'])
+                handled.add(x['_id'])
         else:
-            self._successful_published.add(record['_id'])
+            handled.add(record['_id'])
 
     def report_all_handled(self):
-        self._successful_published.add(None)
+        self._handled().add(None)
 
     @abstractmethod
     def publish_to_historian(self, to_publish_list):
@@ -568,6 +974,86 @@ class BaseHistorianAgent(Agent):
         '''Optional setup routine, run in the processing thread before
            main processing loop starts.'''
 
+    def topics_published(self, topics):
+        '''Called in the processing thread with the topics of a batch of
+           which at least part was successfully published.'''
+
+
+class QueryCache(object):
+    '''Least recently used cache of query results invalidated by topic.
+
+    The cache is bounded both by the number of results and by the total
+    number of values they hold.  Lookups return a generation to pass back
+    to put() so that results read before an invalidation of their topic,
+    by another thread, are not stored.
+    '''
+
+    def __init__(self, max_entries=256, max_values=100000):
+        self.max_entries = max_entries
+        self.max_values = max_values
+        self.hits = self.misses = self.invalidations = self.evictions = 0
+        self._entries = OrderedDict()
+        self._keys = defaultdict(set)
+        self._values = 0
+        self._generation = 0
+        self._invalidated = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        '''Return the cached results for key, or None, and the generation.'''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None, self._generation
+            self._entries[key] = entry
+            self.hits += 1
+            return _copy_results(entry[0]), self._generation
+
+    def put(self, key, results, generation):
+        '''Store results for key, where key[0] is the topic.'''
+        size = len(results['values'])
+        if not self.max_entries or size > self.max_values:
+            return
+        topic = key[0]
+        with self._lock:
+            if self._invalidated.get(topic, 0) > generation:
+                return
+            self._discard(key)
+            self._entries[key] = (_copy_results(results), size)
+            self._keys[topic].add(key)
+            self._values += size
+            while (len(self._entries) > self.max_entries or
+                   self._values > self.max_values):
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, topics):
+        with self._lock:
+            self._generation += 1
+            for topic in topics:
+                self._invalidated[topic] = self._generation
+                keys = self._keys.pop(topic, None)
+                if keys:
+                    self.invalidations += len(keys)
+                    for key in keys:
+                        self._values -= self._entries.pop(key)[1]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+                'entries': len(self._entries), 'values': self._values}
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._values -= entry[1]
+            keys = self._keys[key[0]]
+            keys.discard(key)
+            if not keys:
+                del self._keys[key[0]]
+
 
 class BaseQueryHistorianAgent(Agent):
     '''This is the base agent for query historian Agents.
@@ -576,8 +1062,19 @@ class BaseQueryHistorianAgent(Agent):
     Event processing in publish_to_historian and setup in historian_setup
     both happen in the same thread separate from the main thread. This is
     to allow blocking while processing events.
+
+    Results of query may be cached, up to query_cache_size results
+    holding at most query_cache_values values, until
+    invalidate_query_cache is called for their topic.  The cache is off
+    by default, as it is only correct for historians that invalidate it
+    when new data is stored; BaseHistorian does so and enables it.
     '''
 
+    def __init__(self, query_cache_size=0, query_cache_values=100000,
+                 **kwargs):
+        super(BaseQueryHistorianAgent, self).__init__(**kwargs)
+        self._query_cache = QueryCache(query_cache_size, query_cache_values)
+
     @RPC.export
     def query(self, topic=None, start=None, end=None, skip=0,
               count=None, order="FIRST_TO_LAST"):
@@ -586,29 +1083,104 @@ class BaseQueryHistorianAgent(Agent):
         if topic is None:
             raise TypeError('"Topic" required')
 
-        if start is not None:
-            try:
-                start = parse(start)
-            except TypeError:
-                start = time_parser.parse(start)
-
-        if end is not None:
-            try:
-                end = parse(end)
-            except TypeError:
-                end = time_parser.parse(end)
+        start = _parse_query_time(start)
+        end = _parse_query_time(end)
 
         _log.debug("In base query")
 
         if start:
             _log.debug("start={}".format(start))
 
+        key = (topic, start, end, skip, count, order)
+        results, generation = self._query_cache.get(key)
+        if results is not None:
+            return results
+
         results = self.query_historian(topic, start, end, skip, count, order)
         metadata = results.get("metadata")
         if metadata is None:
             results['metadata'] = {}
+        self._query_cache.put(key, results, generation)
+        return results
+
+    @RPC.export
+    def get_query_cache_stats(self):
+        '''Return the hit, miss, invalidation and eviction counts and the
+        current size of the query cache.'''
+        return self._query_cache.stats()
+
+    def invalidate_query_cache(self, topics):
+        '''Drop cached results of topics.'''
+        self._query_cache.invalidate(topics)
+
+    @RPC.export
+    def query_page(self, topic=None, start=None, end=None, page_size=1000,
+                   token=None, order="FIRST_TO_LAST"):
+        """Return one page of a range query and a token for the next.
+
+        The result is the same as for query with an extra "next" entry.
+        Passing it back as token returns the following page; it is None
+        once the range is exhausted.  Pages are keyed by timestamp rather
+        than offset so that each one is an index range scan no matter how
+        deep into the range it lies.
+        """
+        if page_size is None or page_size < 1:
+            raise ValueError('page_size must be a positive integer')
+        if token is not None:
+            if order == "LAST_TO_FIRST":
+                end = token
+            else:
+                start = token
+        results = self.query(topic, start, end, 0, page_size + 1, order)
+        values = results['values']
+        if len(values) > page_size:
+            del values[page_size:]
+            results['next'] = values[-1][0]
+        else:
+            results['next'] = None
         return results
 
+    @RPC.export
+    def query_multi(self, topics=None, start=None, end=None, agg=None,
+                    interval=None):
+        """Query many topics at once, optionally aggregated.
+
+        Without agg the raw samples are returned.  Otherwise agg is one of
+        avg, min, max, sum, count or last and samples are aggregated over
+        the whole range or, when interval is given, over buckets of that
+        many seconds aligned to the epoch.  Samples are selected with
+        start <= ts < end.
+
+        The result maps each topic to parallel arrays:
+        {topic: {"timestamps": [...], "values": [...]}, ...}
+        """
+        if not topics:
+            raise TypeError('"topics" required')
+        if isinstance(topics, basestring):
+            topics = [topics]
+        if agg is not None and agg not in QUERY_AGGREGATES:
+            raise ValueError('agg must be one of {}'.format(
+                ', '.join(QUERY_AGGREGATES)))
+        if interval is not None:
+            if agg is None:
+                raise ValueError('interval requires agg')
+            interval = int(interval)
+            if interval < 1:
+                raise ValueError('interval must be a positive number of seconds')
+        start = _parse_query_time(start)
+        end = _parse_query_time(end)
+        return self.query_historian_multi(topics, start, end, agg, interval)
+
+    def query_historian_multi(self, topics, start=None, end=None, agg=None,
+                              interval=None):
+        """Return the query_multi result for already validated arguments.
+
+        Historians able to query many topics in one pass should override
+        this.
+        """
+        raise NotImplementedError(
+            '{} does not support query_multi'.format(type(self).__name__))
+
     @RPC.export
     def get_topic_list(self):
         return self.query_topic_list()
@@ -627,7 +1199,97 @@ class BaseQueryHistorianAgent(Agent):
         """
 
 class BaseHistorian(BaseHistorianAgent, BaseQueryHistorianAgent):
-    pass
+    '''Historian storing and querying values.
+
+    Query results are cached until values of their topic are published,
+    unless query_cache_size is 0.
+    '''
+
+    def __init__(self, query_cache_size=256, **kwargs):
+        super(BaseHistorian, self).__init__(query_cache_size=query_cache_size,
+                                            **kwargs)
+
+    def topics_published(self, topics):
+        self.invalidate_query_cache(topics)
+
+
+class Uploader(object):
+    '''Long running threads making HTTP requests for a historian.
+
+    Requests are made through session, a requests.Session keeping up to
+    workers connections alive.  map() calls a function for each of a list
+    of items from the threads, workers at a time, and returns the results
+    in order.  A call that raises results in None.
+    '''
+
+    def __init__(self, workers=4):
+        self.workers = max(int(workers), 1)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._pending = Queue()
+        self._threads = []
+        self._lock = Lock()
+
+    def map(self, func, items):
+        items = list(items)
+        if len(items) <= 1 or self.workers == 1:
+            return [self._call(func, item) for item in items]
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        done = Queue()
+        for index, item in enumerate(items):
+            self._pending.put((func, item, index, done))
+        results = [None] * len(items)
+        for _ in items:
+            index, result = done.get()
+            results[index] = result
+        return results
+
+    def _work(self):
+        while True:
+            func, item, index, done = self._pending.get()
+            done.put((index, self._call(func, item)))
+
+    def _call(self, func, item):
+        try:
+            return func(item)
+        except Exception:
+            _log.exception('unhandled exception in upload')
+            return None
+
+
+def _id_ranges(ids):
+    '''Return the (first, last) ranges of consecutive ids.'''
+    ranges = []
+    for _id in sorted(ids):
+        if ranges and ranges[-1][1] == _id - 1:
+            ranges[-1][1] = _id
+        else:
+            ranges.append([_id, _id])
+    return ranges
+
+
+def _copy_results(results):
+    # Callers such as query_page modify the values list in place.
+    copy = dict(results)
+    copy['values'] = list(results['values'])
+    return copy
+
+
+def _parse_query_time(value):
+    if value is None:
+        return None
+    try:
+        return parse(value)
+    except TypeError:
+        return time_parser.parse(value)
 
 #The following code is
 #Copyright (c) 2011, 2012, Regents of the University of California
@@ -72,6 +72,7 @@ import traceback
 import gevent
 import gevent.event
 from zmq import curve_keypair
+from zmq.utils import jsonapi
 
 from .agent import utils
 from .vip.agent import Agent as BaseAgent, RPC
@@ -133,6 +134,15 @@ class ControlService(BaseAgent):
     def shutdown(self):
         self._aip.shutdown()
 
+    @RPC.export
+    def metrics(self, peer, operation='get'):
+        '''Perform a metrics operation on peer (the router if empty).
+
+        Peers only accept operations other than get from the control
+        service.
+        '''
+        return self.vip.metrics.query(peer, operation).get(timeout=30)
+
     @RPC.export
     def stop_platform(self):
         # XXX: Restrict call as it kills the process
@@ -470,6 +480,46 @@ def send_agent(opts):
         connection.call('start_agent', uuid)
         _stdout.write('Agent {} started as {}\n'.format(wheel, uuid))
 
+def show_stats(opts):
+    for peer in opts.peer or ['']:
+        name = peer or 'router'
+        result = opts.connection.call('metrics', peer, opts.operation)
+        if opts.operation != 'get':
+            _stdout.write('{}: metrics {}\n'.format(
+                name, 'enabled' if result else 'disabled'))
+        elif result is None:
+            _stdout.write('{}: metrics disabled\n'.format(name))
+        elif opts.json:
+            _stdout.write('{}: {}\n'.format(name, jsonapi.dumps(result)))
+        else:
+            _print_stats(name, result)
+
+def _print_stats(name, stats):
+    _stdout.write('{}: {:.1f} seconds collected\n'.format(
+        name, stats['elapsed']))
+    counters = stats['counters']
+    if counters:
+        width = max(7, max(len(key) for key in counters))
+        fmt = '  {:{}} {:>10} {:>12}\n'
+        _stdout.write(fmt.format('COUNTER', width, 'MESSAGES', 'BYTES'))
+        for key in sorted(counters):
+            counter = counters[key]
+            _stdout.write(fmt.format(
+                key, width, counter['messages'], counter['bytes']))
+    latency = stats['latency']
+    if latency:
+        width = max(7, max(len(key) for key in latency))
+        fmt = '  {:{}} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9}\n'
+        _stdout.write(fmt.format('LATENCY', width, 'COUNT', 'MEAN ms',
+                                 'P50 ms', 'P90 ms', 'P99 ms', 'MAX ms'))
+        for key in sorted(latency):
+            summary = latency[key]
+            if not summary['count']:
+                continue
+            _stdout.write(fmt.format(key, width, summary['count'], *[
+                '{:.3f}'.format(summary[field] * 1000)
+                for field in ('mean', 'p50', 'p90', 'p99', 'max')]))
+
 def print_keypair(opts):
     public, secret = curve_keypair()
     _stdout.write('public: %s\nsecret: %s\n' % (
@@ -707,6 +757,21 @@ def main(argv=sys.argv):
     send.add_argument('wheel', nargs='+', help='agent package to send')
     send.set_defaults(func=send_agent)
 
+    stats = add_parser('stats',
+        help='show VIP message metrics of the router or agents')
+    stats.add_argument('peer', nargs='*',
+        help='VIP identity of agent to query (default: the router)')
+    stats_ops = stats.add_mutually_exclusive_group()
+    stats_ops.add_argument('--enable', action='store_const', const='enable',
+        dest='operation', help='start collecting metrics')
+    stats_ops.add_argument('--disable', action='store_const', const='disable',
+        dest='operation', help='stop collecting metrics')
+    stats_ops.add_argument('--reset', action='store_const', const='reset',
+        dest='operation', help='clear collected metrics')
+    stats.add_argument('--json', action='store_true',
+        help='print raw metrics as JSON')
+    stats.set_defaults(func=show_stats, operation='get', json=False)
+
     keypair = add_parser('keypair',
         help='generate CurveMQ keys for encrypting VIP connections')
     keypair.set_defaults(func=print_keypair)
@@ -278,6 +278,10 @@ class Dispatcher(object):
         except ValueError as exc:
             return self.serialize(json_error(
                 None, PARSE_ERROR, 'invalid JSON', detail=str(exc)))
+        return self.dispatch_object(message, context)
+
+    def dispatch_object(self, message, context=None):
+        '''Dispatch a deserialized message and return a response or None.'''
         if isinstance(message, list):
             dispatch = self._dispatch_one
             with self.batch(message) as batch:
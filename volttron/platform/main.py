@@ -81,6 +81,7 @@ from . import config
 from . import vip
 from .vip.agent import Agent, Core
 from .vip.agent.compat import CompatPubSub
+from .vip.metrics import Collector
 from .vip.router import *
 from .vip.socket import encode_key, Address
 from .auth import AuthService
@@ -247,9 +248,10 @@ class Router(BaseRouter):
 
     def __init__(self, local_address, addresses=(),
                  context=None, secretkey=None, default_user_id=None,
-                 monitor=False):
+                 monitor=False, batch_size=64, metrics=False):
         super(Router, self).__init__(
-            context=context, default_user_id=default_user_id)
+            context=context, default_user_id=default_user_id,
+            batch_size=batch_size, metrics=metrics)
         self.local_address = Address(local_address)
         self.addresses = addresses = [Address(addr) for addr in addresses]
         self._secretkey = secretkey
@@ -286,6 +288,12 @@ class Router(BaseRouter):
             address.bind(sock)
             _log.debug('Additional VIP router bound to %s' % address)
 
+    def observer(self):
+        # Avoid formatting frames when debug messages would be dropped.
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return None
+        return super(Router, self).observer()
+
     def issue(self, topic, frames, extra=None):
         log = self.logger.debug
         formatter = FramesFormatter(frames)
@@ -319,6 +327,36 @@ class Router(BaseRouter):
             frames[6:] = [b'', jsonapi.dumps(value)]
             frames[3] = b''
             return frames
+        elif subsystem == b'metrics':
+            try:
+                op = bytes(frames[6])
+            except IndexError:
+                op = b'get'
+            if op == b'get':
+                value = self.metrics and self.metrics.snapshot()
+            elif (bytes(frames[0]) != b'control' or
+                  user_id != self.default_user_id):
+                frames[6:] = [b'error', b'permission denied: ' + op]
+                frames[3] = b''
+                return frames
+            elif op == b'enable':
+                if self.metrics is None:
+                    self.metrics = Collector()
+                value = True
+            elif op == b'disable':
+                self.metrics = None
+                value = False
+            elif op == b'reset':
+                if self.metrics is not None:
+                    self.metrics = Collector()
+                value = self.metrics is not None
+            else:
+                frames[6:] = [b'error', b'unknown operation: ' + op]
+                frames[3] = b''
+                return frames
+            frames[6:] = [b'', jsonapi.dumps(value)]
+            frames[3] = b''
+            return frames
 
 
 class PubSubService(Agent):
@@ -404,6 +442,15 @@ def main(argv=sys.argv):
     agents.add_argument(
         '--vip-local-address', metavar='ZMQADDR',
         help='ZeroMQ URL to bind for local agent VIP connections')
+    agents.add_argument(
+        '--zmq-io-threads', metavar='COUNT', type=int,
+        help='number of ZeroMQ I/O threads used for VIP connections')
+    agents.add_argument(
+        '--router-batch-size', metavar='COUNT', type=int,
+        help='maximum waiting VIP messages routed per router wake-up')
+    agents.add_argument(
+        '--metrics', action='store_true',
+        help='collect VIP message metrics in the router and agents')
 
     # XXX: re-implement control options
     #on
@@ -471,6 +518,9 @@ def main(argv=sys.argv):
         subscribe_address=ipc + 'subscribe',
         vip_address=[],
         vip_local_address=ipc + 'vip.socket',
+        zmq_io_threads=1,
+        router_batch_size=64,
+        metrics=False,
         #allow_root=False,
         #allow_users=None,
         #allow_groups=None,
@@ -496,6 +546,9 @@ def main(argv=sys.argv):
     opts.subscribe_address = config.expandall(opts.subscribe_address)
     opts.vip_address = [config.expandall(addr) for addr in opts.vip_address]
     opts.vip_local_address = config.expandall(opts.vip_local_address)
+    if opts.metrics:
+        # Inherited by the service agents and launched agents
+        os.environ['VOLTTRON_METRICS'] = '1'
     if getattr(opts, 'show_config', False):
         for name, value in sorted(vars(opts).iteritems()):
             print(name, repr(value))
@@ -590,15 +643,19 @@ def main(argv=sys.argv):
         secretkey = key[40:]
 
     # The following line doesn't appear to do anything, but it creates
-    # a context common to the green and non-green zmq modules.
-    zmq.Context.instance()   # DO NOT REMOVE LINE!!
+    # a context common to the green and non-green zmq modules. Extra
+    # ZeroMQ I/O threads move framing and encryption off a single core.
+    zmq.Context.instance(
+        io_threads=max(1, opts.zmq_io_threads))   # DO NOT REMOVE LINE!!
 
     # Main loops
     def router(stop):
         try:
             Router(opts.vip_local_address, opts.vip_address,
                    secretkey=secretkey, default_user_id=b'vip.service',
-                   monitor=opts.monitor).run()
+                   monitor=opts.monitor,
+                   batch_size=opts.router_batch_size,
+                   metrics=opts.metrics).run()
         except Exception:
             _log.exception('Unhandled exception in router loop')
         finally:
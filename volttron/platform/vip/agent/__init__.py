@@ -64,14 +64,19 @@ from .subsystems import *
 
 
 class Agent(object):
+    # Receive add/drop notices about every peer, as agents did before
+    # peerlist subscriptions, rather than only about peers of interest.
+    legacy_peer_notices = False
+
     class Subsystems(object):
         def __init__(self, owner, core):
-            self.peerlist = PeerList(core)
+            self.peerlist = PeerList(core, owner.legacy_peer_notices)
             self.ping = Ping(core)
             self.rpc = RPC(core, owner)
             self.hello = Hello(core)
             self.pubsub = PubSub(core, self.rpc, self.peerlist, owner)
             self.channel = Channel(core)
+            self.metrics = Metrics(core)
 
     def __init__(self, identity=None, address=None, context=None):
         self.core = Core(
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+'''Payload codecs used to encode RPC and pubsub messages.
+
+JSON is used with any peer that has not advertised support for another
+codec; a compact MessagePack codec is preferred otherwise. Peers
+advertise the codecs they support in the hello exchange and the first
+codec in preference order supported by both sides is used for messages
+sent to that peer. Incoming messages are decoded with whichever codec
+matches the leading byte of the payload.
+
+Both codecs accept the JSON types plus datetime, which is sent as an
+ISO 8601 string, so whether a message can be sent does not depend on
+the codec negotiated by the peers receiving it.
+'''
+
+from __future__ import absolute_import
+
+import datetime
+
+from zmq.utils import jsonapi
+
+import msgpack
+
+
+__all__ = ['Codec', 'JSONCodec', 'MsgPackCodec', 'JSON', 'CODECS',
+           'detect', 'names', 'PeerCodecs']
+
+
+def _default(obj):
+    '''Encode the values JSON lacks a representation for.'''
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    raise TypeError('%r is not serializable' % (obj,))
+
+
+class Codec(object):
+    '''Abstract base class for payload codecs.'''
+
+    name = None
+
+    def dumps(self, obj):
+        '''Encode obj and return the payload as a string.'''
+        raise NotImplementedError()
+
+    def loads(self, data):
+        '''Decode data and return the Python object.
+
+        ValueError is raised if data cannot be decoded.
+        '''
+        raise NotImplementedError()
+
+    def detect(self, data):
+        '''Return True if data appears to be encoded by this codec.'''
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self.name)
+
+
+class JSONCodec(Codec):
+    name = b'json'
+
+    def dumps(self, obj):
+        return jsonapi.dumps(obj, default=_default)
+
+    def loads(self, data):
+        return jsonapi.loads(data)
+
+    def detect(self, data):
+        return data[:1] in (b'{', b'[', b' ', b'\t', b'\r', b'\n')
+
+
+class MsgPackCodec(Codec):
+    '''Binary codec using MessagePack.
+
+    Strings are decoded as unicode and tuples as lists, as they are with
+    JSON, so handlers see the same types regardless of the codec used.
+    Values MessagePack cannot represent but JSON can, such as integers
+    beyond 64 bits, are sent as JSON, which the receiver detects.
+    '''
+
+    name = b'msgpack'
+
+    def __init__(self):
+        self._unpack_kwargs = {}
+        if msgpack.version >= (0, 5, 2):
+            self._unpack_kwargs['raw'] = False
+        else:
+            self._unpack_kwargs['encoding'] = 'utf-8'
+
+    def _default(self, obj):
+        if isinstance(obj, (int, long)):
+            raise OverflowError('%r is too large' % (obj,))
+        return _default(obj)
+
+    def dumps(self, obj):
+        try:
+            return msgpack.packb(obj, default=self._default,
+                                 use_bin_type=False)
+        except (OverflowError, ValueError):
+            return JSON.dumps(obj)
+
+    def loads(self, data):
+        try:
+            return msgpack.unpackb(bytes(data), **self._unpack_kwargs)
+        except ValueError:
+            raise
+        except Exception as exc:   # pylint: disable=broad-except
+            raise ValueError(str(exc))
+
+    def detect(self, data):
+        # JSON-RPC messages are always maps or arrays.
+        first = data[:1]
+        return bool(first) and (
+            b'\x80' <= first <= b'\x9f' or first in b'\xdc\xdd\xde\xdf')
+
+
+JSON = JSONCodec()
+
+# Available codecs in order of preference.
+CODECS = [MsgPackCodec(), JSON]
+
+_BY_NAME = {codec.name: codec for codec in CODECS}
+
+
+def names():
+    '''Return the names of available codecs in order of preference.'''
+    return [codec.name for codec in CODECS]
+
+
+def detect(data):
+    '''Return the codec able to decode data, defaulting to JSON.'''
+    for codec in CODECS:
+        if codec.detect(data):
+            return codec
+    return JSON
+
+
+class PeerCodecs(object):
+    '''Track the codec negotiated with each peer.
+
+    Peers default to JSON until negotiation completes. The negotiate
+    callback, if given, is called with the peer identity the first time
+    an unknown peer is looked up and should initiate a hello exchange
+    which eventually calls update() with the peer's advertised codecs.
+    The onupdate callback, if set, is called with the peer identity
+    after each update() so that the peer's departure can be watched for,
+    and ondiscard after the peer is forgotten with discard().
+    '''
+
+    def __init__(self, negotiate=None):
+        self._negotiate = negotiate
+        self._codecs = {}
+        self.onupdate = None
+        self.ondiscard = None
+
+    def get(self, peer):
+        try:
+            return self._codecs[peer]
+        except KeyError:
+            pass
+        # Use JSON until the peer answers; don't ask again meanwhile.
+        self._codecs[peer] = JSON
+        if self._negotiate is not None and len(CODECS) > 1:
+            self._negotiate(peer)
+        return JSON
+
+    def update(self, peer, advertised):
+        '''Select the preferred codec from those advertised by peer.'''
+        advertised = set(advertised)
+        for codec in CODECS:
+            if codec.name in advertised:
+                break
+        else:
+            codec = JSON
+        self._codecs[peer] = codec
+        if self.onupdate is not None:
+            self.onupdate(peer)
+        return codec
+
+    def discard(self, peer):
+        if (self._codecs.pop(peer, None) is not None and
+                self.ondiscard is not None):
+            self.ondiscard(peer)
@@ -72,11 +72,13 @@ from zmq import green as zmq
 from zmq.green import ZMQError, EAGAIN
 from zmq.utils.monitor import recv_monitor_message
 
+from . import codecs
 from .decorators import annotate, annotations, dualmethod
 from .dispatch import Signal
-from .errors import VIPError
+from .errors import VIPError, Unreachable
 from .. import green as vip
 from .. import router
+from ..metrics import frames_size
 from .... import platform
 
 
@@ -404,6 +406,9 @@ class Core(BasicCore):
         self.identity = identity
         self.socket = None
         self.subsystems = {'error': self.handle_error}
+        self.codecs = codecs.PeerCodecs(self._negotiate_codec)
+        # A metrics.Collector while the metrics subsystem is enabled
+        self.metrics = None
         self.__connected = False
 
     @property
@@ -421,11 +426,27 @@ class Core(BasicCore):
     def handle_error(self, message):
         if len(message.args) < 4:
             _log.debug('unhandled VIP error %s', message)
-        elif self.onviperror:
-            args = [bytes(arg) for arg in message.args]
-            error = VIPError.from_errno(*args)
+            return
+        args = [bytes(arg) for arg in message.args]
+        error = VIPError.from_errno(*args)
+        if isinstance(error, Unreachable):
+            # Peer may come back running different software.
+            self.codecs.discard(error.peer)
+        if self.onviperror:
             self.onviperror.send(self, error=error, message=message)
 
+    def _negotiate_codec(self, peer):
+        '''Advertise supported codecs to peer in a hello request.
+
+        The Hello subsystem records the codecs listed in the welcome
+        reply. Peers which do not understand codec negotiation reply
+        without a list and continue to receive JSON.
+        '''
+        if self.greenlet is None or not peer:
+            return
+        self.spawn(self.socket.send_vip, peer, b'hello',
+                   [b'hello'] + codecs.names(), msg_id=b'codecs')
+
     def loop(self):
         # pre-setup
         self.socket = vip.Socket(self.context)
@@ -438,8 +459,8 @@ class Core(BasicCore):
         def hello():
             state.ident = ident = b'connect.hello.%d' % state.count
             state.count += 1
-            self.spawn(self.socket.send_vip,
-                       b'', b'hello', [b'hello'], msg_id=ident)
+            self.spawn(self.socket.send_vip, b'', b'hello',
+                       [b'hello'] + codecs.names(), msg_id=ident)
 
         def monitor():
             # Call socket.monitor() directly rather than use
@@ -503,7 +524,17 @@ class Core(BasicCore):
                     message.subsystem = b'error'
                     sock.send_vip_object(message, copy=False)
                 else:
+                    metrics = self.metrics
+                    if metrics is None:
+                        handle(message)
+                        continue
+                    # Handlers may reuse the message for a response.
+                    metrics.count((b'in', subsystem, bytes(message.peer)),
+                                  frames_size(message.args))
+                    start = time.time()
                     handle(message)
+                    metrics.observe((b'handler', subsystem),
+                                    time.time() - start)
 
         yield gevent.spawn(vip_loop)
         # pre-stop
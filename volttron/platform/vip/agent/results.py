@@ -57,13 +57,16 @@
 
 from __future__ import absolute_import
 
+import heapq
 import random
+import time
 import weakref
 
+import gevent
 from gevent.event import AsyncResult
 
 
-__all__ = ['counter', 'ResultsDictionary']
+__all__ = ['counter', 'OutstandingResults', 'ResultsDictionary']
 
 
 def counter(start=None, minimum=0, maximum=2**64-1):
@@ -85,3 +88,96 @@ class ResultsDictionary(weakref.WeakValueDictionary):
         result.ident = ident = '%s.%s' % (next(self._counter), hash(result))
         self[ident] = result
         return result
+
+
+class OutstandingResults(weakref.WeakValueDictionary):
+    '''Weak dictionary of pending results keyed by integer identifier.
+
+    Identifiers are allocated consecutively so that a group of results
+    created together can be referred to by its first identifier and
+    count (see range_id() and range_idents()). The maximum identifier
+    defaults to 2**53-1 so identifiers remain exact in JSON decoders
+    that use doubles.
+
+    Results may be given a timeout, in seconds, after which they are
+    removed from the dictionary and fail with gevent.Timeout. Expired
+    results are evicted by a single timer scheduled for the earliest
+    deadline.
+    '''
+
+    def __init__(self, start=None, maximum=2**53-1):
+        weakref.WeakValueDictionary.__init__(self)
+        self._maximum = maximum
+        self._next = random.randint(0, maximum) if start is None else start
+        self._deadlines = []
+        self._timer = None
+
+    def allocate(self, count=1, timeout=None):
+        '''Return a list of count new results with consecutive idents.'''
+        ident = self._next
+        if ident + count > self._maximum:
+            ident = 0
+        self._next = ident + count
+        results = []
+        for ident in xrange(ident, ident + count):
+            result = AsyncResult()
+            result.ident = ident
+            self[ident] = result
+            results.append(result)
+        if timeout is not None and results:
+            deadline = time.time() + timeout
+            deadlines = self._deadlines
+            earliest = deadlines[0][0] if deadlines else None
+            for result in results:
+                heapq.heappush(deadlines, (deadline, result.ident, timeout))
+            if earliest is None or deadline < earliest:
+                self._schedule()
+        return results
+
+    def next(self, timeout=None):
+        return self.allocate(1, timeout)[0]
+
+    def range_id(self, results):
+        '''Return a message ID describing results from allocate().'''
+        if len(results) == 1:
+            return b'%d' % results[0].ident
+        return b'%d+%d' % (results[0].ident, len(results))
+
+    def range_idents(self, msg_id):
+        '''Return the idents described by a range_id() message ID.
+
+        The message ID comes from a peer, so the range is limited to the
+        number of outstanding results, which is the most it can match.
+        '''
+        first, _, count = bytes(msg_id).partition(b'+')
+        try:
+            first, count = int(first), int(count or 1)
+        except ValueError:
+            return []
+        if not 0 <= first <= self._maximum:
+            return []
+        return range(first, first + max(0, min(count, len(self))))
+
+    def expire(self, now=None):
+        '''Fail and remove results whose deadline has passed.'''
+        if now is None:
+            now = time.time()
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][0] <= now:
+            _, ident, timeout = heapq.heappop(deadlines)
+            result = self.pop(ident, None)
+            if result is not None and not result.ready():
+                result.set_exception(gevent.Timeout(timeout))
+
+    def _schedule(self):
+        if self._timer is not None:
+            self._timer.kill(block=False)
+            self._timer = None
+        if self._deadlines:
+            delay = max(0, self._deadlines[0][0] - time.time())
+            self._timer = gevent.spawn_later(delay, self._expire_timer)
+
+    def _expire_timer(self):
+        self._timer = None
+        self.expire()
+        self._schedule()
@@ -59,10 +59,12 @@ from __future__ import absolute_import
 
 from .channel import Channel
 from .hello import Hello
+from .metrics import Metrics
 from .peerlist import PeerList
 from .ping import Ping
 from .pubsub import PubSub
 from .rpc import RPC
 
 
-__all__ = ['PeerList', 'Ping', 'RPC', 'Hello', 'PubSub', 'Channel']
+__all__ = ['PeerList', 'Ping', 'RPC', 'Hello', 'PubSub', 'Channel',
+           'Metrics']
@@ -61,6 +61,7 @@ import logging
 import weakref
 
 from .base import SubsystemBase
+from .. import codecs
 from ..errors import VIPError
 from ..results import ResultsDictionary
 
@@ -91,17 +92,28 @@ class Hello(SubsystemBase):
         except IndexError:
             _log.error('missing hello subsystem operation')
             return
+        core = self.core()
         if op == b'hello':
-            socket = self.core().socket
+            # Any arguments following the operation are codec names.
+            if len(message.args) > 1:
+                core.codecs.update(bytes(message.peer),
+                                   [bytes(arg) for arg in message.args[1:]])
+            socket = core.socket
             message.user = b''
             message.args = [b'welcome', b'1.0', socket.identity, message.peer]
+            message.args.extend(codecs.names())
             socket.send_vip_object(message, copy=False)
         elif op == b'welcome':
+            args = [bytes(arg) for arg in message.args[1:]]
+            if bytes(message.id) == b'codecs':
+                # Reply to codec negotiation; an empty list means JSON.
+                core.codecs.update(bytes(message.peer), args[3:])
+                return
             try:
                 result = self._results.pop(bytes(message.id))
             except KeyError:
                 return
-            result.set([bytes(arg) for arg in message.args[1:]])
+            result.set(args[:3])
         else:
             _log.error('unknown hello subsystem operation')
 
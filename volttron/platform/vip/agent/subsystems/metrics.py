@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+from __future__ import absolute_import
+
+import logging
+import os
+import weakref
+
+from zmq.utils import jsonapi
+
+from .base import SubsystemBase
+from ..results import ResultsDictionary
+from ...metrics import Collector
+
+
+__all__ = ['Metrics']
+
+
+_log = logging.getLogger(__name__)
+
+
+class Metrics(SubsystemBase):
+    '''Collect VIP message metrics and query those of peers.
+
+    While enabled, the core counts messages and bytes received per
+    subsystem and peer and records handler latencies; other subsystems
+    may add their own counters. Collection starts disabled unless the
+    VOLTTRON_METRICS environment variable is set. Peers, including the
+    router (peer b''), answer b'get', b'enable', b'disable' and b'reset'
+    operations with a JSON encoded result. Operations other than b'get'
+    are only accepted from the control service.
+    '''
+
+    def __init__(self, core):
+        self.core = weakref.ref(core)
+        self._results = ResultsDictionary()
+        core.register('metrics', self._handle_subsystem, self._handle_error)
+        if os.environ.get('VOLTTRON_METRICS'):
+            self.enable()
+
+    @property
+    def enabled(self):
+        return self.core().metrics is not None
+
+    def enable(self):
+        core = self.core()
+        if core.metrics is None:
+            core.metrics = Collector()
+        return True
+
+    def disable(self):
+        self.core().metrics = None
+        return False
+
+    def reset(self):
+        core = self.core()
+        if core.metrics is not None:
+            core.metrics = Collector()
+        return core.metrics is not None
+
+    def snapshot(self):
+        '''Return the local metrics or None if disabled.'''
+        metrics = self.core().metrics
+        return None if metrics is None else metrics.snapshot()
+
+    def query(self, peer=b'', op=b'get'):
+        '''Perform op on peer and return an AsyncResult for its result.'''
+        socket = self.core().socket
+        result = next(self._results)
+        socket.send_vip(peer, b'metrics', [op], msg_id=result.ident)
+        return result
+
+    __call__ = query
+
+    def _handle_subsystem(self, message):
+        try:
+            op = bytes(message.args[0])
+        except IndexError:
+            _log.error('missing metrics subsystem operation')
+            return
+        if op in (b'', b'error'):
+            try:
+                result = self._results.pop(bytes(message.id))
+            except KeyError:
+                return
+            try:
+                value = bytes(message.args[1])
+            except IndexError:
+                value = b'null' if not op else b'missing error message'
+            if op:
+                result.set_exception(ValueError(value))
+            else:
+                result.set(jsonapi.loads(value))
+            return
+        handler = {b'get': self.snapshot, b'enable': self.enable,
+                   b'disable': self.disable, b'reset': self.reset}.get(op)
+        if handler is None:
+            message.args = [b'error', b'unknown operation: ' + op]
+        elif op != b'get' and bytes(message.peer) != b'control':
+            message.args = [b'error', b'permission denied: ' + op]
+        else:
+            message.args = [b'', jsonapi.dumps(handler())]
+        message.user = b''
+        self.core().socket.send_vip_object(message, copy=False)
+
+    def _handle_error(self, sender, message, error, **kwargs):
+        try:
+            result = self._results.pop(bytes(message.id))
+        except KeyError:
+            return
+        result.set_exception(error)
@@ -72,10 +72,28 @@ _log = logging.getLogger(__name__)
 
 
 class PeerList(SubsystemBase):
-    def __init__(self, core):
+    '''Query the router for peers and receive peer add/drop notices.
+
+    Only notices about watched peers, or all peers after watch() with no
+    arguments, are received, along with those for peers tracked by other
+    subsystems, and the onadd and ondrop signals are sent for those.
+    With legacy set the router instead sends notices about every peer,
+    until watch() or unwatch() is first called.
+    '''
+
+    def __init__(self, core, legacy=False):
         self.core = weakref.ref(core)
         self._results = ResultsDictionary()
+        self._subscribed = not legacy
+        self._watching = set()
+        self._watch_all = False
+        # Maps peers other subsystems need notices about, once
+        # subscribed, to the set of those subsystems.
+        self._tracking = {}
         core.register('peerlist', self._handle_subsystem, self._handle_error)
+        core.onconnected.connect(self._connected)
+        core.codecs.onupdate = lambda peer: self.track(peer, 'codecs')
+        core.codecs.ondiscard = lambda peer: self.untrack(peer, 'codecs')
         self.onadd = Signal()
         self.ondrop = Signal()
 
@@ -87,6 +105,85 @@ class PeerList(SubsystemBase):
 
     __call__ = list
 
+    def watch(self, *peers):
+        '''Request add/drop notices for peers or all peers if none given.'''
+        if not self._subscribed:
+            self._subscribed = True
+            self._watch_all = not peers
+            self._watching.update(peers)
+            self._resubscribe()
+            return
+        if not peers:
+            self._watch_all = True
+        else:
+            peers = [peer for peer in peers if peer not in self._watching]
+            if not peers:
+                return
+            self._watching.update(peers)
+        self._send(b'subscribe', peers)
+
+    def unwatch(self, *peers):
+        '''Stop notices for peers or all peers if none given.'''
+        if not peers or not self._subscribed:
+            self._subscribed = True
+            self._watch_all = False
+            if peers:
+                self._watching.difference_update(peers)
+            else:
+                self._watching.clear()
+            self._resubscribe()
+            return
+        peers = [peer for peer in peers if peer in self._watching]
+        if not peers:
+            return
+        self._watching.difference_update(peers)
+        peers = [peer for peer in peers if peer not in self._tracking]
+        if peers and not self._watch_all:
+            self._send(b'unsubscribe', peers)
+
+    def track(self, peer, owner):
+        '''Receive notices about peer, on behalf of owner, even when it
+        is not watched.'''
+        owners = self._tracking.setdefault(peer, set())
+        if owners:
+            owners.add(owner)
+            return
+        owners.add(owner)
+        if self._subscribed and not self._watch_all and (
+                peer not in self._watching):
+            self._send(b'subscribe', [peer])
+
+    def untrack(self, peer, owner):
+        owners = self._tracking.get(peer)
+        if not owners or owner not in owners:
+            return
+        owners.discard(owner)
+        if owners:
+            return
+        del self._tracking[peer]
+        if self._subscribed and not self._watch_all and (
+                peer not in self._watching):
+            self._send(b'unsubscribe', [peer])
+
+    def _send(self, op, peers):
+        core = self.core()
+        if core.connected:
+            core.socket.send_vip(b'', b'peerlist', [op] + list(peers))
+
+    def _resubscribe(self):
+        # Replace the router's view of our subscriptions, which also
+        # opts out of the legacy broadcast of all notices.
+        self._send(b'unsubscribe', [])
+        if self._watch_all:
+            self._send(b'subscribe', [])
+        elif self._watching or self._tracking:
+            self._send(b'subscribe',
+                       self._watching.union(self._tracking))
+
+    def _connected(self, sender, **kwargs):
+        if self._subscribed:
+            self._resubscribe()
+
     def _handle_subsystem(self, message):
         try:
             op = bytes(message.args[0])
@@ -94,12 +191,16 @@ class PeerList(SubsystemBase):
             _log.error('missing peerlist subsystem operation')
             return
         if op in [b'add', b'drop']:
-            try:
-                peer = bytes(message.args[1])
-            except IndexError:
+            # Notices may be coalesced to list several peers.
+            peers = [bytes(arg) for arg in message.args[1:]]
+            if not peers:
                 _log.error('missing peerlist identity in %s operation', op)
                 return
-            getattr(self, 'on' + op).send(self, peer=peer)
+            signal = getattr(self, 'on' + op)
+            for peer in peers:
+                if op == b'drop':
+                    self.core().codecs.discard(peer)
+                signal.send(self, peer=peer)
         elif op == b'listing':
             try:
                 result = self._results.pop(bytes(message.id))
@@ -58,21 +58,22 @@
 from __future__ import absolute_import
 
 from base64 import b64encode, b64decode
+import hashlib
 import inspect
 import random
+import time
 import weakref
 
-from zmq import green as zmq
-from zmq import SNDMORE
-from zmq.utils import jsonapi
+import gevent
 
 from .base import SubsystemBase
 from ..decorators import annotate, annotations, dualmethod, spawn
-from ..errors import Unreachable
+from ..errors import Unreachable, VIPError
+from .rpc import RPC
 from .... import jsonrpc
 
 
-__all__ = ['PubSub']
+__all__ = ['PubSub', 'SubscriptionIndex']
 
 
 def encode_peer(peer):
@@ -86,21 +87,170 @@ def decode_peer(peer):
     return peer
 
 
+def _utf8(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+def subscriptions_digest(items):
+    '''Return a digest of an iterable of (bus, prefix) subscriptions.
+
+    Used by peers to determine whether their subscriptions are already
+    known without sending them all.
+    '''
+    sha = hashlib.sha1()
+    for bus, prefix in sorted((_utf8(bus), _utf8(prefix))
+                              for bus, prefix in items):
+        sha.update(b'%s\x00%s\n' % (bus, prefix))
+    return sha.hexdigest()
+
+
+class SubscriptionIndex(object):
+    '''Prefix index of peer subscriptions for a single bus.
+
+    Subscription prefixes are stored in a trie keyed by topic segment
+    (split on '/'). The final, possibly partial, segment of each prefix
+    is kept in a per-node table so the plain str.startswith() semantics
+    of prefix matching are preserved while the cost of matching a topic
+    depends on the topic depth rather than the number of subscriptions.
+    Results of match() are cached per topic until the next change.
+    '''
+
+    CACHE_SIZE = 4096
+
+    def __init__(self):
+        self._prefixes = {}
+        self._root = {}
+        self._cache = {}
+
+    @staticmethod
+    def _split(prefix):
+        parts = prefix.split('/')
+        return parts[:-1], parts[-1]
+
+    def _node(self, path, create=False):
+        node = self._root
+        for segment in path:
+            try:
+                node = node[segment]
+            except KeyError:
+                if not create:
+                    return None
+                node[segment] = child = {}
+                node = child
+        return node
+
+    def add(self, prefix, peer):
+        try:
+            subscribers = self._prefixes[prefix]
+        except KeyError:
+            path, partial = self._split(prefix)
+            node = self._node(path, True)
+            partials = node.setdefault(None, {})
+            self._prefixes[prefix] = partials[partial] = subscribers = set()
+        if peer not in subscribers:
+            subscribers.add(peer)
+            self._cache.clear()
+        return subscribers
+
+    def discard(self, prefix, peer):
+        try:
+            subscribers = self._prefixes[prefix]
+        except KeyError:
+            return
+        if peer in subscribers:
+            subscribers.discard(peer)
+            self._cache.clear()
+        if not subscribers:
+            self.remove(prefix)
+
+    def remove(self, prefix):
+        subscribers = self._prefixes.pop(prefix)
+        path, partial = self._split(prefix)
+        nodes = [self._root]
+        for segment in path:
+            nodes.append(nodes[-1][segment])
+        del nodes[-1][None][partial]
+        if not nodes[-1][None]:
+            del nodes[-1][None]
+        # Prune empty branches back toward the root.
+        for i in xrange(len(path), 0, -1):
+            if nodes[i]:
+                break
+            del nodes[i - 1][path[i - 1]]
+        self._cache.clear()
+        return subscribers
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def match(self, topic):
+        '''Return the set of peers subscribed to a prefix of topic.'''
+        try:
+            return self._cache[topic]
+        except KeyError:
+            pass
+        subscribers = set()
+        node = self._root
+        for segment in topic.split('/'):
+            partials = node.get(None)
+            if partials:
+                if len(partials) <= len(segment) + 1:
+                    for partial, peers in partials.iteritems():
+                        if segment.startswith(partial):
+                            subscribers |= peers
+                else:
+                    for i in xrange(len(segment) + 1):
+                        peers = partials.get(segment[:i])
+                        if peers:
+                            subscribers |= peers
+            node = node.get(segment)
+            if node is None:
+                break
+        subscribers = frozenset(subscribers)
+        cache = self._cache
+        if len(cache) >= self.CACHE_SIZE:
+            cache.clear()
+        cache[topic] = subscribers
+        return subscribers
+
+    def __contains__(self, prefix):
+        return prefix in self._prefixes
+
+    def __getitem__(self, prefix):
+        return self._prefixes[prefix]
+
+    def __len__(self):
+        return len(self._prefixes)
+
+    def __iter__(self):
+        return iter(self._prefixes)
+
+    def iteritems(self):
+        return self._prefixes.iteritems()
+
+    def items(self):
+        return self._prefixes.items()
+
+
 class PubSub(SubsystemBase):
     def __init__(self, core, rpc_subsys, peerlist_subsys, owner):
         self.core = weakref.ref(core)
         self.rpc = weakref.ref(rpc_subsys)
         self.peerlist = weakref.ref(peerlist_subsys)
         self._peer_subscriptions = {}
+        # Maps subscribing peer to set of (bus, prefix) subscriptions
+        self._peer_topics = {}
         self._my_subscriptions = {}
 
         def setup(sender, **kwargs):
             # pylint: disable=unused-argument
             rpc_subsys.export(self._peer_sync, 'pubsub.sync')
+            rpc_subsys.export(self._peer_sync_digest, 'pubsub.sync_digest')
             rpc_subsys.export(self._peer_subscribe, 'pubsub.subscribe')
             rpc_subsys.export(self._peer_unsubscribe, 'pubsub.unsubscribe')
             rpc_subsys.export(self._peer_list, 'pubsub.list')
             rpc_subsys.export(self._peer_publish, 'pubsub.publish')
+            rpc_subsys.export(self._peer_publish_batch, 'pubsub.publish_batch')
             rpc_subsys.export(self._peer_push, 'pubsub.push')
             core.onconnected.connect(self._connected)
             core.onviperror.connect(self._viperror)
@@ -116,7 +266,7 @@ class PubSub(SubsystemBase):
         core.onsetup.connect(setup, self)
 
     def add_bus(self, name):
-        self._peer_subscriptions.setdefault(name, {})
+        self._peer_subscriptions.setdefault(name, SubscriptionIndex())
 
     def remove_bus(self, name):
         del self._peer_subscriptions[name]
@@ -131,6 +281,9 @@ class PubSub(SubsystemBase):
             self._peer_drop(self, error.peer)
 
     def _peer_add(self, sender, peer, **kwargs):
+        # Only peers we subscribe with need to hear from us again.
+        if peer not in self._my_subscriptions:
+            return
         # Delay sync by some random amount to prevent reply storm.
         delay = random.random()
         self.core().spawn_later(delay, self.synchronize, peer)
@@ -138,63 +291,74 @@ class PubSub(SubsystemBase):
     def _peer_drop(self, sender, peer, **kwargs):
         self._sync(peer, {})
 
+    def _update_watch(self, peer):
+        '''Track add/drop notices only for peers we share topics with.'''
+        if peer in self._my_subscriptions or peer in self._peer_topics:
+            self.peerlist().track(peer, 'pubsub')
+        else:
+            self.peerlist().untrack(peer, 'pubsub')
+
     def _sync(self, peer, items):
         items = {(bus, prefix) for bus, topics in items.iteritems()
                  for prefix in topics}
-        remove = []
-        for bus, subscriptions in self._peer_subscriptions.iteritems():
-            for prefix, subscribers in subscriptions.iteritems():
-                item = bus, prefix
-                try:
-                    items.remove(item)
-                except KeyError:
-                    subscribers.discard(peer)
-                    if not subscribers:
-                        remove.append(item)
-                else:
-                    subscribers.add(peer)
-        for bus, prefix in remove:
-            subscriptions = self._peer_subscriptions[bus]
-            assert not subscriptions.pop(prefix)
-        for bus, prefix in items:
+        current = self._peer_topics.get(peer, set())
+        for bus, prefix in current - items:
+            self._drop_peer_subscription(peer, bus, prefix)
+        for bus, prefix in items - current:
             self._add_peer_subscription(peer, bus, prefix)
+        self._update_watch(peer)
 
+    @RPC.nonblocking
     def _peer_sync(self, items):
         peer = bytes(self.rpc().context.vip_message.peer)
         assert isinstance(items, dict)
         self._sync(peer, items)
 
+    @RPC.nonblocking
+    def _peer_sync_digest(self, digest):
+        '''Return True if digest matches the calling peer's subscriptions.'''
+        peer = bytes(self.rpc().context.vip_message.peer)
+        return digest == subscriptions_digest(self._peer_topics.get(peer, ()))
+
     def _add_peer_subscription(self, peer, bus, prefix):
-        subscriptions = self._peer_subscriptions[bus]
+        self._peer_subscriptions[bus].add(prefix, peer)
         try:
-            subscribers = subscriptions[prefix]
+            topics = self._peer_topics[peer]
         except KeyError:
-            subscriptions[prefix] = subscribers = set()
-        subscribers.add(peer)
+            self._peer_topics[peer] = topics = set()
+            self.peerlist().track(peer, 'pubsub')
+        topics.add((bus, prefix))
+
+    def _drop_peer_subscription(self, peer, bus, prefix):
+        self._peer_subscriptions[bus].discard(prefix, peer)
+        topics = self._peer_topics.get(peer)
+        if topics is not None:
+            topics.discard((bus, prefix))
+            if not topics:
+                del self._peer_topics[peer]
 
+    @RPC.nonblocking
     def _peer_subscribe(self, prefix, bus=''):
         peer = bytes(self.rpc().context.vip_message.peer)
         for prefix in prefix if isinstance(prefix, list) else [prefix]:
             self._add_peer_subscription(peer, bus, prefix)
 
+    @RPC.nonblocking
     def _peer_unsubscribe(self, prefix, bus=''):
         peer = bytes(self.rpc().context.vip_message.peer)
         subscriptions = self._peer_subscriptions[bus]
         if prefix is None:
-            remove = []
-            for topic, subscribers in subscriptions.iteritems():
-                subscribers.discard(peer)
-                if not subscribers:
-                    remove.append(topic)
-            for topic in remove:
-                del subscriptions[topic]
+            remove = [topic for topic_bus, topic in
+                      self._peer_topics.get(peer, ()) if topic_bus == bus]
         else:
-            for prefix in prefix if isinstance(prefix, list) else [prefix]:
-                subscribers = subscriptions[prefix]
-                subscribers.discard(peer)
-                if not subscribers:
-                    del subscriptions[prefix]
-
+            remove = prefix if isinstance(prefix, list) else [prefix]
+            for prefix in remove:
+                if prefix not in subscriptions:
+                    raise KeyError(prefix)
+        for prefix in remove:
+            self._drop_peer_subscription(peer, bus, prefix)
+
+    @RPC.nonblocking
     def _peer_list(self, prefix='', bus='', subscribed=True, reverse=False):
         peer = bytes(self.rpc().context.vip_message.peer)
         if bus is None:
@@ -218,23 +382,46 @@ class PubSub(SubsystemBase):
         peer = bytes(self.rpc().context.vip_message.peer)
         self._distribute(peer, topic, headers, message, bus)
 
+    def _peer_publish_batch(self, items, bus=''):
+        peer = bytes(self.rpc().context.vip_message.peer)
+        return self._distribute_batch(peer, items, bus)
+
+    def _distribute_batch(self, peer, items, bus=''):
+        distribute = self._distribute
+        return [distribute(peer, topic, headers, message, bus)
+                for topic, headers, message in items]
+
     def _distribute(self, peer, topic, headers, message=None, bus=''):
-        subscriptions = self._peer_subscriptions[bus]
-        subscribers = set()
-        for prefix, subscription in subscriptions.iteritems():
-            if subscription and topic.startswith(prefix):
-                subscribers |= subscription
+        metrics = self.core().metrics
+        if metrics is not None:
+            start = time.time()
+        subscribers = self._peer_subscriptions[bus].match(topic)
         if subscribers:
+            core = self.core()
             sender = encode_peer(peer)
-            json_msg = jsonapi.dumps(jsonrpc.json_method(
+            request = jsonrpc.json_method(
                 None, 'pubsub.push',
-                [sender, bus, topic, headers, message], None))
-            frames = [zmq.Frame(b''), zmq.Frame(b''),
-                      zmq.Frame(b'RPC'), zmq.Frame(json_msg)]
-            socket = self.core().socket
+                [sender, bus, topic, headers, message], None)
+            # Group subscribers by negotiated codec, then serialize once
+            # per codec and send the same frames to every subscriber.
+            peer_codecs = core.codecs
+            by_codec = {}
             for subscriber in subscribers:
-                socket.send(subscriber, flags=SNDMORE)
-                socket.send_multipart(frames, copy=False)
+                by_codec.setdefault(
+                    peer_codecs.get(subscriber), []).append(subscriber)
+            # Encode for every codec before sending so that a message
+            # one codec rejects reaches no subscriber rather than some.
+            payloads = [(peers, codec.dumps(request))
+                        for codec, peers in by_codec.iteritems()]
+            for peers, payload in payloads:
+                core.socket.send_vip_fanout(
+                    peers, b'RPC', [payload], copy=False)
+        if metrics is not None:
+            metrics.count((b'pubsub', bus, b'publish', peer))
+            metrics.count((b'pubsub', bus, b'deliver'),
+                          messages=len(subscribers))
+            metrics.observe((b'pubsub', bus, b'distribute'),
+                            time.time() - start)
         return len(subscribers)
 
     def _peer_push(self, sender, bus, topic, headers, message):
@@ -259,14 +446,33 @@ class PubSub(SubsystemBase):
     def synchronize(self, peer):
         '''Unsubscribe from stale/forgotten/unsolicited subscriptions.'''
         if peer is None:
-            items = [(peer, {bus: subscriptions.keys()
+            items = [(name, {bus: subscriptions.keys()
                              for bus, subscriptions in buses.iteritems()})
-                     for peer, buses in self._my_subscriptions.iteritems()]
+                     for name, buses in self._my_subscriptions.iteritems()]
         else:
             buses = self._my_subscriptions.get(peer) or {}
             items = [(peer, {bus: subscriptions.keys()
                              for bus, subscriptions in buses.iteritems()})]
         for (peer, subscriptions) in items:
+            self.core().spawn(self._synchronize_peer, peer, subscriptions)
+
+    def _synchronize_peer(self, peer, subscriptions):
+        '''Send subscriptions to peer unless it already has them.
+
+        A digest is sent first so that reconnecting does not require
+        resending every subscription. Peers which do not support
+        digests receive the full list.
+        '''
+        digest = subscriptions_digest(
+            (bus, prefix) for bus, prefixes in subscriptions.iteritems()
+            for prefix in prefixes)
+        try:
+            in_sync = self.rpc().call(
+                peer, 'pubsub.sync_digest', digest).get(timeout=30)
+        except (jsonrpc.Error, jsonrpc.RemoteError, VIPError,
+                gevent.Timeout):
+            in_sync = False
+        if not in_sync:
             self.rpc().notify(peer, 'pubsub.sync', subscriptions)
 
     def list(self, peer, prefix='', bus='', subscribed=True, reverse=False):
@@ -280,6 +486,7 @@ class PubSub(SubsystemBase):
             buses = self._my_subscriptions[peer]
         except KeyError:
             self._my_subscriptions[peer] = buses = {}
+            self.peerlist().track(peer, 'pubsub')
         try:
             subscriptions = buses[bus]
         except KeyError:
@@ -352,6 +559,7 @@ class PubSub(SubsystemBase):
                 del buses[bus]
         if not buses:
             del self._my_subscriptions[peer]
+            self._update_watch(peer)
         return topics
 
     def unsubscribe(self, peer, prefix, callback, bus=''):
@@ -364,6 +572,22 @@ class PubSub(SubsystemBase):
         topics = self.drop_subscription(peer, prefix, callback, bus)
         return self.rpc().call(peer, 'pubsub.unsubscribe', topics, bus=bus)
 
+    def publish_batch(self, peer, items, bus=''):
+        '''Publish several messages to a peer in a single request.
+
+        items is a sequence of (topic, headers, message) tuples. All
+        items are published on bus at peer, or by self if peer is None.
+        The result is a list of the number of subscribers each message
+        was delivered to, in the order given.
+        '''
+        items = [(topic, {} if headers is None else headers, message)
+                 for topic, headers, message in items]
+        if peer is None:
+            return self._distribute_batch(
+                self.core().socket.identity, items, bus)
+        return self.rpc().call(
+            peer, 'pubsub.publish_batch', items=items, bus=bus)
+
     def publish(self, peer, topic, headers=None, message=None, bus=''):
         '''Publish a message to a given topic via a peer.
 
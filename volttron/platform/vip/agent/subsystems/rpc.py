@@ -57,25 +57,28 @@
 
 from __future__ import absolute_import
 
+from collections import deque
+import errno
 import inspect
 import logging
 import os
 import sys
+import time
 import traceback
 import weakref
 
+import gevent
 import gevent.local
-from gevent.event import AsyncResult
-from zmq.utils import jsonapi
 
 from .base import SubsystemBase
+from .. import codecs
 from ..errors import VIPError
-from ..results import counter, ResultsDictionary
-from ..decorators import annotate, annotations, dualmethod, spawn
+from ..results import OutstandingResults
+from ..decorators import annotate, annotations, dualmethod
 from .... import jsonrpc
 
 
-__all__ = ['RPC']
+__all__ = ['RPC', 'DispatchPool']
 
 
 _ROOT_PACKAGE_PATH = os.path.dirname(
@@ -83,38 +86,61 @@ _ROOT_PACKAGE_PATH = os.path.dirname(
 
 _log = logging.getLogger(__name__)
 
+_AGAIN = (bytes(errno.EAGAIN), os.strerror(errno.EAGAIN))
+
 
 class Dispatcher(jsonrpc.Dispatcher):
-    def __init__(self, methods, local):
+    def __init__(self, methods, local, results=None):
         super(Dispatcher, self).__init__()
         self.methods = methods
         self.local = local
-        self._results = ResultsDictionary()
+        self._results = OutstandingResults() if results is None else results
 
-    def serialize(self, json_obj):
-        return jsonapi.dumps(json_obj)
+    def serialize(self, json_obj, codec=None):
+        # Responses are encoded with the codec of the request, which is
+        # recorded in the handling greenlet by deserialize().
+        if codec is None:
+            codec = getattr(self.local, 'codec', codecs.JSON)
+        return codec.dumps(json_obj)
 
     def deserialize(self, json_string):
-        return jsonapi.loads(json_string)
+        self.local.codec = codec = codecs.detect(json_string)
+        return codec.loads(json_string)
 
-    def batch_call(self, requests):
+    def batch_call(self, requests, codec=None, timeout=None):
+        # pylint: disable=arguments-differ
+        requests = list(requests)
+        results = self._results.allocate(
+            sum(1 for request in requests if not request[0]), timeout)
+        pending = iter(results)
         methods = []
-        results = []
         for notify, method, args, kwargs in requests:
-            if notify:
-                ident = None
-            else:
-                result = next(self._results)
-                ident = result.ident
-                results.append(result)
-            methods.append((ident, method, args, kwargs))
-        return super(Dispatcher, self).batch_call(methods), results
+            ident = None if notify else next(pending).ident
+            methods.append(jsonrpc.json_method(ident, method, args, kwargs))
+        return self.serialize(methods, codec), results
 
-    def call(self, method, args=None, kwargs=None):
+    def call(self, method, args=None, kwargs=None, codec=None, timeout=None):
         # pylint: disable=arguments-differ
-        result = next(self._results)
-        return super(Dispatcher, self).call(
-            result.ident, method, args, kwargs), result
+        result = self._results.next(timeout)
+        return self.serialize(jsonrpc.json_method(
+            result.ident, method, args or (), kwargs or {}), codec), result
+
+    def call_many(self, calls, codec=None, timeout=None):
+        '''Serialize each (method, args, kwargs) call separately.
+
+        Returns a list of requests and a list of results, one per call.
+        '''
+        calls = list(calls)
+        results = self._results.allocate(len(calls), timeout)
+        requests = [self.serialize(jsonrpc.json_method(
+                        result.ident, method, args or (), kwargs or {}), codec)
+                    for result, (method, args, kwargs) in zip(results, calls)]
+        return requests, results
+
+    def notify(self, method, args=None, kwargs=None, codec=None):
+        # pylint: disable=arguments-differ
+        return self.serialize(jsonrpc.json_method(
+            None, method, args or (), kwargs or {}), codec)
 
     def result(self, response, ident, value, context=None):
         try:
@@ -204,14 +230,80 @@ class Dispatcher(jsonrpc.Dispatcher):
         return response
 
 
+class DispatchPool(object):
+    '''Bounded pool of greenlets servicing a queue of calls.
+
+    Up to size worker greenlets are started on demand and exit when the
+    queue is empty, so a burst of messages is handled by a few long
+    running greenlets rather than one greenlet per message. At most
+    depth calls may wait in the queue; submit() returns False when the
+    queue is full.
+    '''
+
+    def __init__(self, size=32, depth=1024):
+        self.size = size
+        self.depth = depth
+        self._queue = deque()
+        self._workers = set()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def busy(self):
+        '''Return True if calls are queued or being run.'''
+        return bool(self._queue or self._workers)
+
+    def in_worker(self):
+        '''Return True if called from one of the pool's workers.'''
+        return gevent.getcurrent() in self._workers
+
+    def submit(self, func, *args):
+        queue = self._queue
+        if len(queue) >= self.depth:
+            return False
+        queue.append((func, args))
+        if len(self._workers) < self.size:
+            self._workers.add(gevent.spawn(self._work))
+        return True
+
+    def _work(self):
+        queue = self._queue
+        try:
+            while queue:
+                func, args = queue.popleft()
+                try:
+                    func(*args)
+                except Exception:   # pylint: disable=broad-except
+                    _log.exception('unhandled exception in dispatch pool')
+        finally:
+            self._workers.discard(gevent.getcurrent())
+
+
 class RPC(SubsystemBase):
-    def __init__(self, core, owner):
+    '''Subsystem for JSON-RPC calls to and from peers.
+
+    Incoming requests are handled by a DispatchPool of pool_size
+    workers. When more than queue_depth messages are waiting, the
+    sender receives an Again VIP error. Responses, and requests whose
+    methods are all marked with RPC.nonblocking, are handled inline in
+    the VIP loop while the pool is idle.
+
+    Requests from a peer that a pool worker is waiting on for a result,
+    including the agent itself, may be callbacks the worker needs. They
+    are run in their own greenlet rather than queued behind it, so that
+    handlers calling back into their own agent cannot deadlock the
+    pool.
+    '''
+
+    def __init__(self, core, owner, pool_size=32, queue_depth=1024):
         self.core = weakref.ref(core)
         self.context = None
+        self.pool = DispatchPool(pool_size, queue_depth)
         self._exports = {}
         self._dispatcher = None
-        self._counter = counter()
-        self._outstanding = weakref.WeakValueDictionary()
+        self._results = OutstandingResults()
+        # Maps peer to the number of results pool workers are awaiting
+        self._awaited = {}
         core.register('RPC', self._handle_subsystem, self._handle_error)
 
         def export(member):   # pylint: disable=redefined-outer-name
@@ -222,25 +314,83 @@ class RPC(SubsystemBase):
         def setup(sender, **kwargs):
             # pylint: disable=unused-argument
             self.context = gevent.local.local()
-            self._dispatcher = Dispatcher(self._exports, self.context)
+            self._dispatcher = Dispatcher(
+                self._exports, self.context, self._results)
         core.onsetup.connect(setup, self)
 
-    @spawn
     def _handle_subsystem(self, message):
-        dispatch = self._dispatcher.dispatch
-        responses = [response for response in (
-            dispatch(bytes(msg), message) for msg in message.args) if response]
+        requests = []
+        inline = True
+        for frame in message.args:
+            data = bytes(frame)
+            codec = codecs.detect(data)
+            try:
+                request = codec.loads(data)
+            except ValueError:
+                # Let the dispatcher report the parse error.
+                codec, request = None, data
+            else:
+                inline = inline and self._is_inline(request)
+            requests.append((codec, request))
+        if inline:
+            self._dispatch(message, requests)
+        elif self._awaited.get(bytes(message.peer)):
+            gevent.spawn(self._dispatch, message, requests)
+        elif not self.pool.submit(self._dispatch, message, requests):
+            _log.debug('RPC dispatch queue full; rejecting message from %r',
+                       bytes(message.peer))
+            message.user = b''
+            message.args = list(_AGAIN) + [self.core().identity, b'RPC']
+            message.subsystem = b'error'
+            self.core().socket.send_vip_object(message, copy=False)
+
+    def _is_inline(self, request):
+        if isinstance(request, list):
+            return all(self._is_inline(item) for item in request)
+        try:
+            name = request['method']
+        except (KeyError, TypeError):
+            # Responses only resolve results and never block.
+            return True
+        # Queued requests are handled first to preserve ordering.
+        method = self._exports.get(name)
+        return (method is not None and not self.pool.busy() and
+                'nonblocking' in annotations(method, set, 'rpc.flags'))
+
+    def _dispatch(self, message, requests):
+        dispatcher = self._dispatcher
+        context = self.context
+        metrics = self.core().metrics
+        if metrics is not None:
+            start = time.time()
+        responses = []
+        # Results awaited by this greenlet, mapped to their peer
+        context.awaiting = awaiting = {}
+        try:
+            for codec, request in requests:
+                if codec is None:
+                    response = dispatcher.dispatch(request, message)
+                else:
+                    context.codec = codec
+                    response = dispatcher.dispatch_object(request, message)
+                if response:
+                    responses.append(response)
+        finally:
+            del context.awaiting
+            while awaiting:
+                self._release(awaiting.popitem()[1])
+        if metrics is not None:
+            metrics.observe((b'RPC', b'dispatch'), time.time() - start)
         if responses:
             message.user = ''
             message.args = responses
             self.core().socket.send_vip_object(message, copy=False)
 
     def _handle_error(self, sender, message, error, **kwargs):
-        result = self._outstanding.pop(bytes(message.id), None)
-        if isinstance(result, AsyncResult):
-            result.set_exception(error)
-        elif result:
-            for result in result:
+        results = self._results
+        for ident in results.range_idents(message.id):
+            result = results.pop(ident, None)
+            if result is not None:
                 result.set_exception(error)
 
     @dualmethod
@@ -259,29 +409,83 @@ class RPC(SubsystemBase):
             return method
         return decorate
 
-    def batch(self, peer, requests):
-        request, results = self._dispatcher.batch_call(requests)
-        if results:
-            items = weakref.WeakSet(results)
-            ident = '%s.%s' % (next(self._counter), id(items))
-            for result in results:
-                result._weak_set = items   # pylint: disable=protected-access
-            self._outstanding[ident] = items
+    @staticmethod
+    def nonblocking(method):
+        '''Mark an exported method as safe to run in the VIP loop.
+
+        Non-blocking methods skip the dispatch pool. They must not wait
+        on RPC results, sockets or other greenlets.
+        '''
+        annotate(method, set, 'rpc.flags', 'nonblocking')
+        return method
+
+    def _await(self, peer, results):
+        '''Note results a pool worker will wait on from peer.
+
+        The count is released when a result is set or, for results
+        still outstanding, when the worker finishes dispatching the
+        request that made the call, since it can no longer be waiting.
+        '''
+        if not results or not self.pool.in_worker():
+            return
+        awaiting = self.context.awaiting
+        awaited = self._awaited
+        peer = bytes(peer)
+        awaited[peer] = awaited.get(peer, 0) + len(results)
+
+        def done(result):
+            if awaiting.pop(result, None) is not None:
+                self._release(peer)
+        for result in results:
+            awaiting[result] = peer
+            result.rawlink(done)
+
+    def _release(self, peer):
+        awaited = self._awaited
+        count = awaited.get(peer, 0) - 1
+        if count > 0:
+            awaited[peer] = count
         else:
-            ident = b''
+            awaited.pop(peer, None)
+
+    def batch(self, peer, requests, timeout=None):
+        request, results = self._dispatcher.batch_call(
+            requests, self.core().codecs.get(peer), timeout)
+        self._await(peer, results)
+        ident = self._results.range_id(results) if results else b''
         if request:
             self.core().socket.send_vip(peer, 'RPC', [request], msg_id=ident)
         return results or None
 
     def call(self, peer, method, *args, **kwargs):
-        request, result = self._dispatcher.call(method, args, kwargs)
-        ident = '%s.%s' % (next(self._counter), hash(result))
-        self._outstanding[ident] = result
-        self.core().socket.send_vip(peer, 'RPC', [request], msg_id=ident)
+        request, result = self._dispatcher.call(
+            method, args, kwargs, self.core().codecs.get(peer))
+        self._await(peer, [result])
+        self.core().socket.send_vip(
+            peer, 'RPC', [request], msg_id=bytes(result.ident))
         return result
 
+    def call_many(self, peer, calls, timeout=None):
+        '''Pipeline several calls to peer in a single VIP message.
+
+        calls is an iterable of (method, args, kwargs) tuples. Each call
+        is sent as a separate frame of one message, the peer executes
+        them in order and returns all responses in one message. Returns
+        a list of AsyncResult objects in the same order as calls.
+        Results not received within timeout seconds fail with
+        gevent.Timeout and are forgotten.
+        '''
+        requests, results = self._dispatcher.call_many(
+            calls, self.core().codecs.get(peer), timeout)
+        self._await(peer, results)
+        if requests:
+            self.core().socket.send_vip(peer, 'RPC', requests,
+                                        msg_id=self._results.range_id(results))
+        return results
+
     __call__ = call
 
     def notify(self, peer, method, *args, **kwargs):
-        request = self._dispatcher.notify(method, args, kwargs)
+        request = self._dispatcher.notify(
+            method, args, kwargs, self.core().codecs.get(peer))
         self.core().socket.send_vip(peer, 'RPC', [request])
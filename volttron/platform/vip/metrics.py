@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+'''Lightweight message counters and latency histograms.
+
+Collection is opt-in: components hold a Collector only while metrics
+are enabled and otherwise skip instrumentation with a single None
+check. Keys are tuples of strings, such as (b'in', subsystem, peer),
+which are joined with '/' in snapshots.
+'''
+
+from __future__ import absolute_import
+
+import time
+
+
+__all__ = ['Histogram', 'Collector', 'frames_size']
+
+
+class Histogram(object):
+    '''Log-linear histogram of durations in the style of HdrHistogram.
+
+    Values are recorded in whole microseconds. Each power of two is
+    split into SUB_BUCKETS linear buckets, bounding the relative error
+    of reported percentiles to 1/SUB_BUCKETS while keeping recording to
+    a few integer operations. Buckets are stored sparsely.
+    '''
+
+    SUB_BUCKETS = 16
+    _SHIFT = 4   # log2(SUB_BUCKETS)
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, seconds):
+        value = int(seconds * 1000000)
+        if value < 0:
+            value = 0
+        if value < self.SUB_BUCKETS:
+            index = value
+        else:
+            shift = value.bit_length() - self._SHIFT - 1
+            index = ((shift + 1) << self._SHIFT) + (value >> shift) - \
+                self.SUB_BUCKETS
+        buckets = self.buckets
+        buckets[index] = buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def _upper(self, index):
+        '''Return the largest value, in microseconds, of a bucket.'''
+        if index < self.SUB_BUCKETS:
+            return index
+        shift = (index >> self._SHIFT) - 1
+        base = (index & (self.SUB_BUCKETS - 1)) + self.SUB_BUCKETS
+        return ((base + 1) << shift) - 1
+
+    def percentile(self, percent):
+        '''Return the value in seconds at or below which percent fall.'''
+        if not self.count:
+            return None
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= threshold:
+                return min(self._upper(index), self.max) / 1000000.0
+        return self.max / 1000000.0
+
+    def summary(self):
+        '''Return a JSON serializable summary in seconds.'''
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'min': self.min / 1000000.0,
+            'max': self.max / 1000000.0,
+            'mean': self.total / 1000000.0 / self.count,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+        }
+
+
+class Collector(object):
+    '''Per-key message and byte counters and latency histograms.'''
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, key, nbytes=0, messages=1):
+        try:
+            counter = self.counters[key]
+        except KeyError:
+            self.counters[key] = counter = [0, 0]
+        counter[0] += messages
+        counter[1] += nbytes
+
+    def observe(self, key, seconds):
+        try:
+            histogram = self.histograms[key]
+        except KeyError:
+            self.histograms[key] = histogram = Histogram()
+        histogram.record(seconds)
+
+    def snapshot(self):
+        '''Return a JSON serializable view of all metrics.'''
+        return {
+            'started': self.started,
+            'elapsed': time.time() - self.started,
+            'counters': {_join(key): {'messages': messages, 'bytes': nbytes}
+                         for key, (messages, nbytes)
+                         in self.counters.items()},
+            'latency': {_join(key): histogram.summary()
+                        for key, histogram in self.histograms.items()},
+        }
+
+
+def _join(key):
+    '''Join key parts with '/', escaping binary peer identities.'''
+    parts = []
+    for part in key:
+        if isinstance(part, bytes):
+            try:
+                text = part.decode('utf-8')
+            except UnicodeDecodeError:
+                text = None
+            # Router assigned identities begin with a NUL byte.
+            if text is None or u'\x00' in text:
+                text = part.encode('string_escape')
+            part = text
+        parts.append(part)
+    return u'/'.join(parts)
+
+
+def frames_size(frames):
+    '''Return the total size in bytes of a sequence of frames.'''
+    return sum(len(frame) for frame in frames)
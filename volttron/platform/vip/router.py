@@ -59,9 +59,12 @@
 from __future__ import absolute_import
 
 import os
+import time
 
 import zmq
-from zmq import Frame, NOBLOCK, ZMQError, EINVAL, EHOSTUNREACH
+from zmq import Frame, NOBLOCK, ZMQError, EAGAIN, EINVAL, EHOSTUNREACH
+
+from .metrics import Collector, frames_size
 
 
 __all__ = ['BaseRouter', 'OUTGOING', 'INCOMING', 'UNROUTABLE', 'ERROR']
@@ -93,33 +96,60 @@ class BaseRouter(object):
     setup authentication, etc, etc. The socket will be created by the
     start() method, which will then call the setup() method.  Once
     started, the socket may be polled for incoming messages and those
-    messages are handled/routed by calling the route() method.  During
-    routing, the issue() method, which may be implemented, will be
-    called to allow for debugging and logging. Custom subsystems may be
-    implemented in the handle_subsystem() method. The socket will be
-    closed when the stop() method is called.
+    messages are handled/routed by calling the route() or route_batch()
+    methods.  During routing, the issue() method, which may be
+    implemented, will be called to allow for debugging and logging,
+    unless observer() indicates nobody is listening. Custom subsystems
+    may be implemented in the handle_subsystem() method. The socket
+    will be closed when the stop() method is called.
+
+    If batch_size is greater than one, run() routes up to that many
+    waiting messages for each poll() wake-up. Batch statistics are kept
+    in the counters dictionary.
+
+    Peerlist add and drop notices are queued while routing and sent,
+    coalesced, at the end of each batch. Peers may subscribe to notices
+    about specific peers or all peers with the peerlist subscribe and
+    unsubscribe operations. Peers which never use those operations
+    receive notices about every peer, one per message, as before.
     '''
 
     _context_class = zmq.Context
     _socket_class = zmq.Socket
 
-    def __init__(self, context=None, default_user_id=None):
+    def __init__(self, context=None, default_user_id=None, batch_size=1,
+                 metrics=False):
         '''Initialize the object instance.
 
         If context is None (the default), the zmq global context will be
-        used for socket creation.
+        used for socket creation. If metrics is True, message counts and
+        batch latencies are collected in the metrics attribute, which
+        is otherwise None.
         '''
         self.context = context or self._context_class.instance()
         self.default_user_id = default_user_id
+        self.batch_size = max(1, batch_size)
+        self.counters = {'batches': 0, 'messages': 0,
+                         'last_batch': 0, 'max_batch': 0}
+        self.metrics = Collector() if metrics else None
         self.socket = None
         self._peers = set()
+        # Pending peerlist notices as (op, peer) tuples
+        self._peer_events = []
+        # Peers which have used peerlist (un)subscribe operations
+        self._peerlist_aware = set()
+        # Peers subscribed to notices for all peers
+        self._watch_all = set()
+        # Maps peer to set of subscribers and subscriber to set of peers
+        self._watchers = {}
+        self._watching = {}
 
     def run(self):
         '''Main router loop.'''
         self.start()
         try:
             while self.poll():
-                self.route()
+                self.route_batch()
         finally:
             self.stop()
 
@@ -179,6 +209,17 @@ class BaseRouter(object):
     def issue(self, topic, frames, extra=None):
         pass
 
+    def observer(self):
+        '''Return the issue() method or None if it should not be called.
+
+        Returns None if issue() is not implemented, so routing skips it
+        entirely. Subclasses may extend this to disable issue() while it
+        would have no effect, such as when debug logging is disabled.
+        '''
+        if getattr(self.issue, 'im_func', None) is BaseRouter.issue.im_func:
+            return None
+        return self.issue
+
     if zmq.zmq_version_info() >= (4, 1, 0):
         def lookup_user_id(self, sender, recipient, auth_token):
             '''Find and return a user identifier.
@@ -206,28 +247,103 @@ class BaseRouter(object):
             return self.default_user_id
 
     def _distribute(self, *parts):
+        self._send_peers(self._peers, *parts)
+
+    def _send_peers(self, peers, *parts):
         drop = set()
         empty = Frame(b'')
         frames = [empty, empty, Frame(b'VIP1'), empty, empty]
         frames.extend(Frame(f) for f in parts)
-        for peer in self._peers:
+        issue = self.observer()
+        for peer in peers:
             frames[0] = peer
-            drop.update(self._send(frames))
+            drop.update(self._send(frames, issue))
         for peer in drop:
             self._drop_peer(peer)
 
     def _add_peer(self, peer):
         if peer in self._peers:
             return
-        self._distribute(b'peerlist', b'add', peer)
         self._peers.add(peer)
+        self._peer_events.append((b'add', peer))
 
     def _drop_peer(self, peer):
         try:
             self._peers.remove(peer)
         except KeyError:
             return
-        self._distribute(b'peerlist', b'drop', peer)
+        self._unwatch(peer, None)
+        self._peerlist_aware.discard(peer)
+        self._peer_events.append((b'drop', peer))
+
+    def _watch(self, subscriber, peers):
+        '''Subscribe to notices about peers (all peers if empty).'''
+        self._peerlist_aware.add(subscriber)
+        if not peers:
+            self._watch_all.add(subscriber)
+            return
+        watching = self._watching.setdefault(subscriber, set())
+        for peer in peers:
+            watching.add(peer)
+            self._watchers.setdefault(peer, set()).add(subscriber)
+
+    def _unwatch(self, subscriber, peers):
+        '''Unsubscribe from notices about peers (all peers if empty).'''
+        watching = self._watching.get(subscriber, set())
+        if not peers:
+            self._watch_all.discard(subscriber)
+            peers = list(watching)
+        for peer in peers:
+            watching.discard(peer)
+            watchers = self._watchers.get(peer)
+            if watchers is not None:
+                watchers.discard(subscriber)
+                if not watchers:
+                    del self._watchers[peer]
+        if not watching:
+            self._watching.pop(subscriber, None)
+
+    def _flush_peer_events(self):
+        '''Send queued peerlist notices to interested peers.
+
+        An add followed by a drop of the same peer within one batch
+        cancels out. Peers using peerlist subscriptions receive one
+        message per operation listing every affected peer; other peers
+        receive one message per affected peer.
+        '''
+        while self._peer_events:
+            events, self._peer_events = self._peer_events, []
+            pending = []
+            # Maps peer to the index in pending of its latest add
+            added = {}
+            for op, peer in events:
+                if op == b'drop' and peer in added:
+                    pending[added.pop(peer)] = None
+                    continue
+                if op == b'add':
+                    added[peer] = len(pending)
+                pending.append((op, peer))
+            legacy = self._peers - self._peerlist_aware
+            everyone = legacy | self._watch_all
+            notices = {}
+            for op, peer in filter(None, pending):
+                recipients = everyone | self._watchers.get(peer, set())
+                recipients.discard(peer)
+                for recipient in recipients:
+                    notices.setdefault(recipient, {}).setdefault(
+                        op, []).append(peer)
+            for recipient, ops in notices.iteritems():
+                if recipient not in self._peers:
+                    continue
+                for op in (b'drop', b'add'):
+                    peers = ops.get(op)
+                    if not peers:
+                        continue
+                    if recipient in legacy:
+                        for peer in peers:
+                            self._send_peers([recipient], b'peerlist', op, peer)
+                    else:
+                        self._send_peers([recipient], b'peerlist', op, *peers)
 
     def route(self):
         '''Route one message and return.
@@ -238,25 +354,77 @@ class BaseRouter(object):
         handle_subsystem() for processing. Messages destined for other
         entities are routed appropriately.
         '''
-        socket = self.socket
-        issue = self.issue
         # Expecting incoming frames:
         #   [SENDER, RECIPIENT, PROTO, USER_ID, MSG_ID, SUBSYS, ...]
-        frames = socket.recv_multipart(copy=False)
-        issue(INCOMING, frames)
+        self._route(self.socket.recv_multipart(copy=False), self.observer())
+        self._flush_peer_events()
+
+    def route_batch(self, limit=None):
+        '''Route waiting messages and return the number routed.
+
+        Messages are read without blocking until none are waiting or
+        limit (batch_size, by default) messages have been routed. The
+        observer is looked up once for the entire batch.
+        '''
+        return self._drain(self._route, limit)
+
+    def _drain(self, handler, limit=None):
+        '''Call handler(frames, issue) for up to limit waiting messages.'''
+        if limit is None:
+            limit = self.batch_size
+        recv = self.socket.recv_multipart
+        issue = self.observer()
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.time()
+        count = 0
+        while count < limit:
+            try:
+                frames = recv(flags=NOBLOCK, copy=False)
+            except ZMQError as exc:
+                if exc.errno != EAGAIN:
+                    raise
+                break
+            count += 1
+            if metrics is not None and len(frames) > 5:
+                metrics.count((b'route', frames[5].bytes, frames[0].bytes),
+                              frames_size(frames))
+            handler(frames, issue)
+        if count:
+            counters = self.counters
+            counters['batches'] += 1
+            counters['messages'] += count
+            counters['last_batch'] = count
+            if count > counters['max_batch']:
+                counters['max_batch'] = count
+            if metrics is not None:
+                metrics.observe((b'batch',), time.time() - start)
+        self._flush_peer_events()
+        return count
+
+    def _route(self, frames, issue):
+        '''Process and route the frames of a single message.
+
+        issue is the value returned from observer().
+        '''
+        socket = self.socket
+        if issue:
+            issue(INCOMING, frames)
         if len(frames) < 6:
             # Cannot route if there are insufficient frames, such as
             # might happen with a router probe.
             if len(frames) == 2 and frames[0] and not frames[1]:
-                issue(UNROUTABLE, frames, 'router probe')
+                if issue:
+                    issue(UNROUTABLE, frames, 'router probe')
                 self._add_peer(frames[0].bytes)
-            else:
+            elif issue:
                 issue(UNROUTABLE, frames, 'too few frames')
             return
         sender, recipient, proto, auth_token, msg_id = frames[:5]
         if proto.bytes != b'VIP1':
             # Peer is not talking a protocol we understand
-            issue(UNROUTABLE, frames, 'bad VIP signature')
+            if issue:
+                issue(UNROUTABLE, frames, 'bad VIP signature')
             return
         user_id = self.lookup_user_id(sender, recipient, auth_token)
         if user_id is None:
@@ -278,10 +446,18 @@ class BaseRouter(object):
                     op = frames[6].bytes
                 except IndexError:
                     op = None
+                args = [frame.bytes for frame in frames[7:]]
                 frames = [sender, recipient, proto, b'', msg_id, subsystem]
                 if op == b'list':
                     frames.append(b'listing')
                     frames.extend(self._peers)
+                elif op in (b'subscribe', b'unsubscribe'):
+                    if op == b'subscribe':
+                        self._watch(sender.bytes, args)
+                    else:
+                        self._unwatch(sender.bytes, args)
+                        self._peerlist_aware.add(sender.bytes)
+                    return
                 else:
                     error = (b'unknown' if op else b'missing') + b' operation'
                     frames.extend([b'error', error])
@@ -292,7 +468,8 @@ class BaseRouter(object):
                 if response is None:
                     # Handler does not know of the subsystem
                     errnum, errmsg = error = _INVALID_SUBSYSTEM
-                    issue(ERROR, frames, error)
+                    if issue:
+                        issue(ERROR, frames, error)
                     frames = [sender, recipient, proto, b'', msg_id,
                               b'error', errnum, errmsg, b'', subsystem]
                 elif not response:
@@ -303,11 +480,10 @@ class BaseRouter(object):
         else:
             # Route all other requests to the recipient
             frames[:4] = [recipient, sender, proto, user_id]
-        for peer in self._send(frames):
+        for peer in self._send(frames, issue):
             self._drop_peer(peer)
 
-    def _send(self, frames):
-        issue = self.issue
+    def _send(self, frames, issue):
         socket = self.socket
         drop = []
         recipient, sender = frames[:2]
@@ -316,7 +492,8 @@ class BaseRouter(object):
         try:
             # Try sending the message to its recipient
             socket.send_multipart(frames, flags=NOBLOCK, copy=False)
-            issue(OUTGOING, frames)
+            if issue:
+                issue(OUTGOING, frames)
         except ZMQError as exc:
             try:
                 errnum, errmsg = error = _ROUTE_ERRORS[exc.errno]
@@ -324,7 +501,8 @@ class BaseRouter(object):
                 error = None
             if error is None:
                 raise
-            issue(ERROR, frames, error)
+            if issue:
+                issue(ERROR, frames, error)
             if exc.errno == EHOSTUNREACH:
                 drop.append(bytes(recipient))
             if exc.errno != EHOSTUNREACH or sender is not frames[0]:
@@ -334,7 +512,8 @@ class BaseRouter(object):
                           b'error', errnum, errmsg, recipient, subsystem]
                 try:
                     socket.send_multipart(frames, flags=NOBLOCK, copy=False)
-                    issue(OUTGOING, frames)
+                    if issue:
+                        issue(OUTGOING, frames)
                 except ZMQError as exc:
                     try:
                         errnum, errmsg = error = _ROUTE_ERRORS[exc.errno]
@@ -342,7 +521,8 @@ class BaseRouter(object):
                         error = None
                     if error is None:
                         raise
-                    issue(ERROR, frames, error)
+                    if issue:
+                        issue(ERROR, frames, error)
                     if exc.errno == EHOSTUNREACH:
                         drop.append(bytes(sender))
         return drop
@@ -77,7 +77,7 @@ import urlparse
 import uuid
 
 from zmq import (SNDMORE, RCVMORE, NOBLOCK, POLLOUT, DEALER, ROUTER,
-                 curve_keypair)
+                 Frame, curve_keypair)
 from zmq.error import Again
 from zmq.utils import z85
 
@@ -419,6 +419,38 @@ class _Socket(object):
                         else self.send_multipart)
                 send(args, flags=flags, copy=copy, track=track)
 
+    def send_vip_fanout(self, peers, subsystem, args=None, msg_id=b'',
+                        user=b'', via=None, flags=0, copy=True, track=False):
+        '''Send the same VIP message to each peer in peers.
+
+        The frames following PEER are built once and reused for every
+        peer. If copy is False, they are wrapped in zmq.Frame objects
+        which are re-sent without copying the payload. The send lock is
+        held for the entire fan-out so that messages from other
+        greenlets cannot be interleaved. Returns the number of peers
+        the message was sent to.
+        '''
+        frames = [user or b'', msg_id or b'', subsystem]
+        if args:
+            frames.extend([args] if isinstance(args, basestring) else args)
+        if not copy:
+            frames = [frame if isinstance(frame, Frame) else Frame(frame)
+                      for frame in frames]
+        count = 0
+        with self._sending(flags) as flags:
+            if self._send_state > 0:
+                raise ProtocolError('previous send operation is not complete')
+            for peer in peers:
+                if self._send_state == -1:
+                    if via is None:
+                        raise ValueError("missing 'via' argument "
+                                         "required by ROUTER sockets")
+                    self.send(via, flags=flags|SNDMORE, copy=copy, track=track)
+                self.send(peer, flags=flags|SNDMORE, copy=copy, track=track)
+                self.send_multipart(frames, flags=flags, copy=copy, track=track)
+                count += 1
+        return count
+
     def send_vip_dict(self, dct, flags=0, copy=True, track=False):
         '''Send VIP message from a dictionary.'''
         msg_id = dct.pop('id', b'')
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from volttron.platform.agent.base_historian import (
+    BaseHistorianAgent, BaseQueryHistorianAgent, QueryCache, Uploader,
+    _id_ranges)
+
+
+class IdRangesTests(unittest.TestCase):
+    def test_ranges(self):
+        self.assertEqual(_id_ranges([]), [])
+        self.assertEqual(_id_ranges([7]), [[7, 7]])
+        self.assertEqual(_id_ranges({5, 1, 2, 3, 9, 10}),
+                         [[1, 3], [5, 5], [9, 10]])
+
+
+class BackupTests(unittest.TestCase):
+    '''Tests of the backup cache, run without an agent or platform.'''
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def historian(self, limit=None, policy='drop-oldest'):
+        historian = BaseHistorianAgent.__new__(BaseHistorianAgent)
+        historian._submit_size_limit = 1000
+        historian._backup_commit_interval = timedelta(0)
+        historian._backup_synchronous = 'NORMAL'
+        historian._backup_storage_limit = limit
+        historian._backup_overflow_policy = policy
+        historian._last_backup_commit = datetime.min
+        historian._backlog = historian._evicted = historian._published = 0
+        historian._backup_bytes = historian._backup_file_bytes = 0
+        historian._drained = deque()
+        historian._successful_published = set()
+        historian._meta_data = defaultdict(dict)
+        historian._backup_cache = {}
+        historian._setup_backup_db()
+        return historian
+
+    def items(self, count, start, value=0, topics=1):
+        return [{'source': 'scrape', 'topic': 'device/point%d' % topic,
+                 'readings': [(start + timedelta(seconds=n), value)]}
+                for n in range(count) for topic in range(topics)]
+
+    def count(self, historian):
+        return historian._connection.execute(
+            'SELECT COUNT(*) FROM outstanding').fetchone()[0]
+
+    def test_backlog_counts_new_values(self):
+        historian = self.historian()
+        start = datetime(2015, 1, 1)
+        historian._backup_new_to_publish(self.items(10, start))
+        self.assertEqual(historian.get_backup_stats()['backlog'], 10)
+
+        # Values sent again replace the stored ones without adding rows.
+        historian._backup_new_to_publish(self.items(15, start, value=1))
+        self.assertEqual(historian.get_backup_stats()['backlog'], 15)
+        self.assertEqual(self.count(historian), 15)
+        batch = historian._get_outstanding_to_publish()
+        self.assertEqual([row['value'] for row in batch], [1] * 15)
+
+    def test_backlog_after_publish(self):
+        historian = self.historian()
+        historian._backup_new_to_publish(self.items(10, datetime(2015, 1, 1)))
+        batch = historian._get_outstanding_to_publish()
+        historian._successful_published = set(batch.ids()[:4])
+        historian._cleanup_successful_publishes(batch)
+        stats = historian.get_backup_stats()
+        self.assertEqual(stats['backlog'], 6)
+        self.assertEqual(stats['published'], 4)
+        self.assertEqual(self.count(historian), 6)
+
+    def test_backlog_seeded_from_existing_db(self):
+        historian = self.historian()
+        historian._backup_new_to_publish(self.items(7, datetime(2015, 1, 1)))
+        historian._connection.close()
+        self.assertEqual(self.historian()._backlog, 7)
+
+    def test_limit_drops_oldest(self):
+        historian = self.historian(limit=0)
+        start = datetime(2015, 1, 1)
+        historian._backup_new_to_publish(self.items(10, start))
+        stats = historian.get_backup_stats()
+        self.assertEqual(stats['backlog'], self.count(historian))
+        self.assertEqual(stats['evicted'], 10)
+        self.assertEqual(stats['backlog'], 0)
+
+    def test_downsample_oldest(self):
+        historian = self.historian()
+        start = datetime(2015, 1, 1)
+        historian._backup_new_to_publish(self.items(10, start, topics=3))
+        c = historian._connection.cursor()
+        self.assertEqual(historian._downsample_oldest(c, 12), 6)
+        rows = c.execute('''SELECT ts, topic_id FROM outstanding
+                            ORDER BY ts, topic_id''').fetchall()
+        # Every other value of each topic among the 12 oldest is gone.
+        seconds = sorted(set((ts - start).seconds for ts, _ in rows))
+        self.assertEqual(seconds, [0, 2, 4, 5, 6, 7, 8, 9])
+        self.assertEqual(len(rows), 24)
+        self.assertEqual(historian._downsample_oldest(c, 0), 0)
+
+    def test_limit_downsamples_oldest(self):
+        historian = self.historian(policy='downsample-oldest')
+        historian._backup_new_to_publish(
+            self.items(2000, datetime(2015, 1, 1)))
+        historian._update_backup_size()
+        historian._backup_storage_limit = historian._backup_bytes // 2
+        historian._enforce_backup_limit()
+        stats = historian.get_backup_stats()
+        self.assertTrue(stats['evicted'] > 0)
+        self.assertEqual(stats['backlog'], self.count(historian))
+        self.assertEqual(stats['backlog'], 2000 - stats['evicted'])
+
+
+class QueryCacheTests(unittest.TestCase):
+    def results(self, *values):
+        return {'values': [[n, value] for n, value in enumerate(values)],
+                'metadata': {}}
+
+    def test_hit_returns_copy(self):
+        cache = QueryCache()
+        results, generation = cache.get(('a', 1))
+        self.assertIsNone(results)
+        cache.put(('a', 1), self.results(1, 2), generation)
+        results, _ = cache.get(('a', 1))
+        self.assertEqual(results, self.results(1, 2))
+        results['values'].append([2, 3])
+        self.assertEqual(cache.get(('a', 1))[0], self.results(1, 2))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+    def test_invalidate(self):
+        cache = QueryCache()
+        cache.put(('a', 1), self.results(1), 0)
+        cache.put(('a', 2), self.results(1), 0)
+        cache.put(('b', 1), self.results(1), 0)
+        cache.invalidate(['a'])
+        self.assertIsNone(cache.get(('a', 1))[0])
+        self.assertIsNotNone(cache.get(('b', 1))[0])
+        self.assertEqual(cache.stats()['invalidations'], 2)
+        self.assertEqual(cache.stats()['values'], 1)
+
+    def test_stale_put_ignored(self):
+        cache = QueryCache()
+        _, generation = cache.get(('a', 1))
+        cache.invalidate(['a'])
+        cache.put(('a', 1), self.results(1), generation)
+        self.assertIsNone(cache.get(('a', 1))[0])
+
+    def test_bounds(self):
+        cache = QueryCache(max_entries=2, max_values=3)
+        cache.put(('a', 1), self.results(1), 0)
+        cache.put(('b', 1), self.results(1), 0)
+        cache.get(('a', 1))
+        cache.put(('c', 1), self.results(1), 0)
+        # The least recently used entry is evicted.
+        self.assertIsNone(cache.get(('b', 1))[0])
+        cache.put(('d', 1), self.results(1, 2, 3), 0)
+        self.assertEqual(cache.stats()['entries'], 1)
+        cache.put(('e', 1), self.results(1, 2, 3, 4), 0)
+        self.assertIsNone(cache.get(('e', 1))[0])
+
+    def test_disabled(self):
+        cache = QueryCache(max_entries=0)
+        cache.put(('a', 1), self.results(1), 0)
+        self.assertIsNone(cache.get(('a', 1))[0])
+
+
+class QueryTests(unittest.TestCase):
+    '''Tests of the query RPC methods over a list of values.
+
+    Like the SQL historians, query_historian excludes start and end.
+    '''
+
+    def historian(self, query_cache_size=0):
+        historian = BaseQueryHistorianAgent.__new__(BaseQueryHistorianAgent)
+        historian._query_cache = QueryCache(query_cache_size)
+        historian.queries = []
+        values = [[datetime(2015, 1, 1, 0, 0, n).isoformat(), n]
+                  for n in range(10)]
+
+        def query_historian(topic, start=None, end=None, skip=0,
+                            count=None, order=None):
+            historian.queries.append((topic, start, end, count))
+            selected = [value for value in values
+                        if (start is None or value[0] > start.isoformat())
+                        and (end is None or value[0] < end.isoformat())]
+            if order == 'LAST_TO_FIRST':
+                selected.reverse()
+            return {'values': selected[skip:][:count]}
+        historian.query_historian = query_historian
+        return historian
+
+    def test_cache_off_by_default(self):
+        historian = self.historian()
+        historian.query('a')
+        historian.query('a')
+        self.assertEqual(len(historian.queries), 2)
+
+    def test_cached_until_invalidated(self):
+        historian = self.historian(query_cache_size=16)
+        self.assertEqual(historian.query('a'), historian.query('a'))
+        self.assertEqual(len(historian.queries), 1)
+        historian.invalidate_query_cache(['a'])
+        historian.query('a')
+        self.assertEqual(len(historian.queries), 2)
+
+    def test_query_page(self):
+        historian = self.historian()
+        pages = []
+        token = None
+        while True:
+            page = historian.query_page('a', page_size=4, token=token)
+            pages.append([value for _, value in page['values']])
+            token = page['next']
+            if token is None:
+                break
+        self.assertEqual(pages, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+    def test_query_multi_validation(self):
+        historian = self.historian()
+        self.assertRaises(TypeError, historian.query_multi)
+        self.assertRaises(ValueError, historian.query_multi, 'a', agg='mean')
+        self.assertRaises(ValueError, historian.query_multi, 'a',
+                          interval=60)
+        self.assertRaises(NotImplementedError, historian.query_multi, 'a')
+
+
+class UploaderTests(unittest.TestCase):
+    def test_results_in_order(self):
+        uploader = Uploader(workers=3)
+        self.assertEqual(uploader.map(lambda n: n * 2, range(10)),
+                         [n * 2 for n in range(10)])
+        self.assertEqual(uploader.map(lambda n: n, []), [])
+
+    def test_exception_is_none(self):
+        uploader = Uploader(workers=2)
+
+        def upload(n):
+            if n == 1:
+                raise ValueError(n)
+            return True
+        self.assertEqual(uploader.map(upload, range(3)), [True, None, True])
+
+    def test_threads_reused(self):
+        uploader = Uploader(workers=2)
+        threads = set()
+
+        def upload(n):
+            threads.add(threading.current_thread())
+            return n
+        for _ in range(5):
+            uploader.map(upload, range(4))
+        self.assertEqual(len(uploader._threads), 2)
+        self.assertTrue(threads <= set(uploader._threads))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+from datetime import datetime
+import unittest
+
+from volttron.platform.vip.agent import codecs
+from volttron.platform.vip.agent.codecs import JSON, MsgPackCodec, PeerCodecs
+
+
+MSGPACK = MsgPackCodec()
+
+REQUEST = {'jsonrpc': '2.0', 'id': 1, 'method': 'pubsub.push',
+           'params': ['sender', '', u'devices/caf\xe9', {'a': [1, 2.5]},
+                      [True, None, 'x']]}
+
+
+class CodecTests(unittest.TestCase):
+    def test_round_trip(self):
+        for codec in codecs.CODECS:
+            self.assertEqual(codec.loads(codec.dumps(REQUEST)), REQUEST)
+
+    def test_same_types(self):
+        message = {'tuple': (1, 2), 'str': 'abc'}
+        decoded = [codec.loads(codec.dumps(message))
+                   for codec in (JSON, MSGPACK)]
+        self.assertEqual(decoded[0], decoded[1])
+        for value in decoded:
+            self.assertIsInstance(value['str'], unicode)
+            self.assertIsInstance(value['tuple'], list)
+
+    def test_datetime(self):
+        when = datetime(2015, 6, 1, 12, 30, 5, 250)
+        for codec in (JSON, MSGPACK):
+            self.assertEqual(codec.loads(codec.dumps([when])),
+                             [when.isoformat()])
+
+    def test_unserializable(self):
+        for codec in (JSON, MSGPACK):
+            self.assertRaises(TypeError, codec.dumps, [object()])
+
+    def test_big_integer_sent_as_json(self):
+        payload = MSGPACK.dumps([2**70])
+        self.assertIs(codecs.detect(payload), JSON)
+        self.assertEqual(codecs.detect(payload).loads(payload), [2**70])
+
+    def test_detect(self):
+        self.assertIs(codecs.detect(JSON.dumps(REQUEST)), JSON)
+        self.assertIsInstance(codecs.detect(MSGPACK.dumps(REQUEST)),
+                              MsgPackCodec)
+        self.assertIsInstance(codecs.detect(MSGPACK.dumps([1])),
+                              MsgPackCodec)
+        self.assertIs(codecs.detect(b''), JSON)
+
+    def test_bad_msgpack(self):
+        self.assertRaises(ValueError, MSGPACK.loads, b'\x92\x01')
+
+
+class PeerCodecsTests(unittest.TestCase):
+    def test_json_until_negotiated(self):
+        asked = []
+        peers = PeerCodecs(asked.append)
+        self.assertIs(peers.get('peer'), JSON)
+        self.assertIs(peers.get('peer'), JSON)
+        self.assertEqual(asked, ['peer'])
+
+    def test_update_prefers_first_common(self):
+        updated = []
+        peers = PeerCodecs()
+        peers.onupdate = updated.append
+        self.assertEqual(peers.update('a', ['json', 'msgpack']).name,
+                         'msgpack')
+        self.assertIs(peers.update('b', ['json']), JSON)
+        self.assertIs(peers.update('c', ['unknown']), JSON)
+        self.assertEqual(peers.get('a').name, 'msgpack')
+        self.assertEqual(updated, ['a', 'b', 'c'])
+
+    def test_discard(self):
+        discarded = []
+        peers = PeerCodecs()
+        peers.ondiscard = discarded.append
+        peers.update('a', ['msgpack'])
+        peers.discard('a')
+        peers.discard('a')
+        self.assertEqual(discarded, ['a'])
+        self.assertIs(peers.get('a'), JSON)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+import random
+import unittest
+
+from zmq.utils import jsonapi
+
+from volttron.platform.vip.metrics import Collector, Histogram, frames_size
+from volttron.platform.vip.agent.subsystems.metrics import Metrics
+from volttron.platform.vip.socket import Message
+
+
+class HistogramTests(unittest.TestCase):
+    def test_empty(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.summary(), {'count': 0})
+        self.assertIsNone(histogram.percentile(50))
+
+    def test_small_values_exact(self):
+        histogram = Histogram()
+        for micros in range(16):
+            histogram.record(micros / 1000000.0)
+        self.assertEqual(histogram.percentile(50), 7 / 1000000.0)
+        self.assertEqual(histogram.percentile(100), 15 / 1000000.0)
+
+    def test_bucket_bounds(self):
+        histogram = Histogram()
+        for value in [16, 17, 31, 32, 33, 1000, 65535, 10**9]:
+            histogram.record(value / 1000000.0)
+            index = max(histogram.buckets)
+            upper = histogram._upper(index)
+            self.assertLessEqual(value, upper)
+            self.assertLessEqual(upper - value,
+                                 value / Histogram.SUB_BUCKETS)
+            histogram.buckets.clear()
+
+    def test_percentiles_within_error(self):
+        rand = random.Random(1)
+        values = [int(rand.lognormvariate(8, 2)) for _ in range(5000)]
+        histogram = Histogram()
+        for value in values:
+            histogram.record(value / 1000000.0)
+        values.sort()
+        for percent in (50, 90, 99, 99.9):
+            exact = values[int(len(values) * percent / 100.0 + 0.5) - 1]
+            reported = histogram.percentile(percent) * 1000000
+            self.assertGreaterEqual(reported, exact)
+            self.assertLessEqual(reported,
+                                 exact * (1 + 1.0 / Histogram.SUB_BUCKETS))
+
+    def test_summary(self):
+        histogram = Histogram()
+        for seconds in (0.001, 0.002, 0.003, -1):
+            histogram.record(seconds)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 4)
+        self.assertEqual(summary['min'], 0)
+        self.assertEqual(summary['max'], 0.003)
+        self.assertAlmostEqual(summary['mean'], 0.0015)
+
+
+class CollectorTests(unittest.TestCase):
+    def test_snapshot(self):
+        collector = Collector()
+        collector.count((b'in', b'RPC', b'agent'), 10)
+        collector.count((b'in', b'RPC', b'agent'), 5)
+        collector.count((b'pubsub', b'', b'deliver'), messages=3)
+        collector.count((b'in', b'RPC', b'\x00k\xff'), 1)
+        collector.observe((b'RPC', b'dispatch'), 0.5)
+        snapshot = jsonapi.loads(jsonapi.dumps(collector.snapshot()))
+        self.assertEqual(snapshot['counters'], {
+            'in/RPC/agent': {'messages': 2, 'bytes': 15},
+            'pubsub//deliver': {'messages': 3, 'bytes': 0},
+            'in/RPC/\\x00k\\xff': {'messages': 1, 'bytes': 1}})
+        self.assertEqual(snapshot['latency']['RPC/dispatch']['count'], 1)
+        self.assertGreaterEqual(snapshot['elapsed'], 0)
+
+    def test_frames_size(self):
+        self.assertEqual(frames_size([b'ab', b'', b'cde']), 5)
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def send_vip_object(self, message, **kwargs):
+        self.sent.append(message)
+
+
+class FakeCore(object):
+    metrics = None
+
+    def __init__(self):
+        self.socket = FakeSocket()
+
+    def register(self, name, handler, error_handler=None):
+        pass
+
+
+class MetricsSubsystemTests(unittest.TestCase):
+    def setUp(self):
+        self.core = FakeCore()
+        self.metrics = Metrics(self.core)
+
+    def request(self, peer, op):
+        self.metrics._handle_subsystem(Message(
+            peer=peer, user=b'user', id=b'1', subsystem=b'metrics',
+            args=[op]))
+        return self.core.socket.sent.pop().args
+
+    def test_get(self):
+        self.assertEqual(self.request(b'agent', b'get'), [b'', b'null'])
+        self.metrics.enable()
+        self.core.metrics.count((b'x',))
+        _, value = self.request(b'agent', b'get')
+        self.assertEqual(jsonapi.loads(value)['counters'],
+                         {'x': {'messages': 1, 'bytes': 0}})
+
+    def test_control_only(self):
+        for op in (b'enable', b'disable', b'reset'):
+            self.assertEqual(self.request(b'agent', op),
+                             [b'error', b'permission denied: ' + op])
+        self.assertFalse(self.metrics.enabled)
+        self.assertEqual(self.request(b'control', b'enable'),
+                         [b'', b'true'])
+        self.assertTrue(self.metrics.enabled)
+        self.core.metrics.count((b'x',))
+        self.request(b'control', b'reset')
+        self.assertEqual(self.core.metrics.counters, {})
+        self.assertEqual(self.request(b'control', b'disable'),
+                         [b'', b'false'])
+        self.assertIsNone(self.core.metrics)
+
+    def test_unknown(self):
+        self.assertEqual(self.request(b'control', b'bogus'),
+                         [b'error', b'unknown operation: bogus'])
+
+
+if __name__ == '__main__':
+    unittest.main()
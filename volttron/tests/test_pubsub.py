@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+import random
+import unittest
+
+from volttron.platform.vip.agent import codecs
+from volttron.platform.vip.agent.subsystems.pubsub import (
+    PubSub, SubscriptionIndex)
+
+
+class SubscriptionIndexTests(unittest.TestCase):
+    def test_prefix_semantics(self):
+        index = SubscriptionIndex()
+        for prefix, peer in [('', 'all'), ('devices', 'devices'),
+                             ('devices/', 'slash'), ('dev', 'dev'),
+                             ('devices/campus/b', 'b'),
+                             ('devices/campus/building1/', 'building1'),
+                             ('record', 'record')]:
+            index.add(prefix, peer)
+        self.assertEqual(index.match('devices/campus/building1/all'),
+                         {'all', 'devices', 'slash', 'dev', 'b', 'building1'})
+        self.assertEqual(index.match('devices/campus/building1'),
+                         {'all', 'devices', 'slash', 'dev', 'b'})
+        self.assertEqual(index.match('devicesx'), {'all', 'devices', 'dev'})
+        self.assertEqual(index.match('de'), {'all'})
+        self.assertEqual(index.match('records/x'), {'all', 'record'})
+
+    def test_matches_startswith(self):
+        rand = random.Random(1)
+        segments = ['', 'a', 'ab', 'abc', 'b', 'ba']
+        def topic():
+            return '/'.join(rand.choice(segments)
+                            for _ in xrange(rand.randint(1, 4)))
+        index = SubscriptionIndex()
+        prefixes = {}
+        for n in xrange(200):
+            prefix = topic()
+            if rand.random() < 0.5:
+                prefix = prefix[:rand.randint(0, len(prefix))]
+            peer = 'peer%d' % rand.randint(0, 9)
+            index.add(prefix, peer)
+            prefixes.setdefault(prefix, set()).add(peer)
+        for prefix in rand.sample(sorted(prefixes), 20):
+            for peer in list(prefixes[prefix]):
+                index.discard(prefix, peer)
+            del prefixes[prefix]
+        self.assertEqual(set(index), set(prefixes))
+        for n in xrange(500):
+            name = topic()
+            expected = set()
+            for prefix, peers in prefixes.iteritems():
+                if name.startswith(prefix):
+                    expected |= peers
+            self.assertEqual(index.match(name), expected, name)
+
+    def test_cache_invalidated(self):
+        index = SubscriptionIndex()
+        index.add('a/b', 'one')
+        self.assertEqual(index.match('a/b/c'), {'one'})
+        index.add('a/', 'two')
+        self.assertEqual(index.match('a/b/c'), {'one', 'two'})
+        index.discard('a/b', 'one')
+        self.assertEqual(index.match('a/b/c'), {'two'})
+        index.remove('a/')
+        self.assertEqual(index.match('a/b/c'), set())
+
+    def test_cache_bounded(self):
+        index = SubscriptionIndex()
+        index.add('', 'peer')
+        for n in xrange(SubscriptionIndex.CACHE_SIZE + 10):
+            index.match(str(n))
+        self.assertLessEqual(len(index._cache), SubscriptionIndex.CACHE_SIZE)
+
+    def test_discard_last_peer_prunes(self):
+        index = SubscriptionIndex()
+        index.add('a/b/c/d', 'one')
+        index.add('a/b/c/d', 'two')
+        index.add('a/x', 'one')
+        index.discard('a/b/c/d', 'one')
+        self.assertIn('a/b/c/d', index)
+        self.assertEqual(index['a/b/c/d'], {'two'})
+        index.discard('a/b/c/d', 'two')
+        self.assertNotIn('a/b/c/d', index)
+        self.assertEqual(index._root, {'a': {None: {'x': {'one'}}}})
+        index.discard('a/x', 'one')
+        self.assertEqual(index._root, {})
+        self.assertEqual(len(index), 0)
+
+    def test_discard_unknown(self):
+        index = SubscriptionIndex()
+        index.add('a', 'one')
+        index.discard('b', 'one')
+        index.discard('a', 'two')
+        self.assertEqual(index.items(), [('a', {'one'})])
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def send_vip_fanout(self, peers, subsystem, args=None, **kwargs):
+        self.sent.append((sorted(peers), subsystem, args))
+        return len(peers)
+
+
+class FakeSignal(object):
+    def connect(self, receiver, owner=None):
+        pass
+
+
+class FakeCore(object):
+    metrics = None
+
+    def __init__(self):
+        self.socket = FakeSocket()
+        self.codecs = codecs.PeerCodecs()
+        self.onsetup = FakeSignal()
+
+
+class FakeRPC(object):
+    pass
+
+
+class FakePeerList(object):
+    def track(self, peer, name):
+        pass
+
+    def untrack(self, peer, name):
+        pass
+
+
+class DistributeTests(unittest.TestCase):
+    def setUp(self):
+        self.core = FakeCore()
+        self.rpc = FakeRPC()
+        self.peerlist = FakePeerList()
+        self.pubsub = PubSub(self.core, self.rpc, self.peerlist, object())
+        self.pubsub.add_bus('')
+        for peer, prefix in [('a', 'devices'), ('b', 'devices/campus'),
+                             ('c', 'record')]:
+            self.pubsub._add_peer_subscription(peer, '', prefix)
+
+    def test_one_send_for_all_subscribers(self):
+        count = self.pubsub._distribute(
+            'publisher', 'devices/campus/all', {'Date': 'now'}, [1, 2])
+        self.assertEqual(count, 2)
+        [(peers, subsystem, [payload])] = self.core.socket.sent
+        self.assertEqual((peers, subsystem), (['a', 'b'], b'RPC'))
+        request = codecs.JSON.loads(bytes(payload))
+        self.assertEqual(request['method'], 'pubsub.push')
+        self.assertEqual(request['params'],
+                         ['publisher', '', 'devices/campus/all',
+                          {'Date': 'now'}, [1, 2]])
+
+    def test_one_send_per_codec(self):
+        self.core.codecs.update('b', ['msgpack', 'json'])
+        self.pubsub._distribute('publisher', 'devices/campus/all', {}, 1)
+        sent = dict((tuple(peers), payload)
+                    for peers, _, [payload] in self.core.socket.sent)
+        self.assertEqual(sorted(sent), [('a',), ('b',)])
+        self.assertIs(codecs.detect(bytes(sent[('a',)])), codecs.JSON)
+        msgpack = codecs.detect(bytes(sent[('b',)]))
+        self.assertEqual(msgpack.name, 'msgpack')
+        self.assertEqual(msgpack.loads(bytes(sent[('b',)]))['params'][-1], 1)
+
+    def test_unencodable_reaches_no_one(self):
+        self.core.codecs.update('b', ['msgpack', 'json'])
+        self.assertRaises(TypeError, self.pubsub._distribute,
+                          'publisher', 'devices/campus/all', {}, object())
+        self.assertEqual(self.core.socket.sent, [])
+
+    def test_no_subscribers(self):
+        self.assertEqual(self.pubsub._distribute('publisher', 'other', {}), 0)
+        self.assertEqual(self.core.socket.sent, [])
+
+    def test_batch(self):
+        counts = self.pubsub._distribute_batch(
+            'publisher', [('devices/x', {}, 1), ('record/y', {}, 2),
+                          ('other', {}, 3)])
+        self.assertEqual(counts, [1, 1, 0])
+        self.assertEqual([peers for peers, _, _ in self.core.socket.sent],
+                         [['a'], ['c']])
+
+
+if __name__ == '__main__':
+    unittest.main()
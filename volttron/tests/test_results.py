@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+import unittest
+
+import gevent
+
+from volttron.platform.vip.agent.results import OutstandingResults
+
+
+class OutstandingResultsTests(unittest.TestCase):
+    def test_consecutive_idents(self):
+        results = OutstandingResults(start=10)
+        group = results.allocate(3)
+        self.assertEqual([result.ident for result in group], [10, 11, 12])
+        self.assertEqual(results.next().ident, 13)
+        self.assertIs(results[11], group[1])
+
+    def test_wraps_before_maximum(self):
+        results = OutstandingResults(start=8, maximum=10)
+        self.assertEqual([r.ident for r in results.allocate(3)], [0, 1, 2])
+
+    def test_weak(self):
+        results = OutstandingResults(start=0)
+        results.allocate(2)
+        self.assertEqual(len(results), 0)
+
+    def test_range_id(self):
+        results = OutstandingResults(start=5)
+        self.assertEqual(results.range_id(results.allocate(1)), b'5')
+        self.assertEqual(results.range_id(results.allocate(3)), b'6+3')
+
+    def test_range_idents(self):
+        results = OutstandingResults(start=5)
+        group = results.allocate(3)
+        self.assertEqual(results.range_idents(b'5+3'), [5, 6, 7])
+        self.assertEqual(results.range_idents(b'6'), [6])
+        # Ranges are limited to the number of outstanding results.
+        self.assertEqual(results.range_idents(b'5+1000000000'), [5, 6, 7])
+        for msg_id in (b'', b'x', b'5+x', b'-1', b'%d' % 2**60):
+            self.assertEqual(results.range_idents(msg_id), [], msg_id)
+        self.assertEqual(results.range_idents(b'5+-3'), [])
+        del group
+
+    def test_expire(self):
+        results = OutstandingResults(start=0)
+        slow, = results.allocate(1, timeout=10)
+        fast = results.allocate(2, timeout=0.01)
+        gevent.sleep(0.05)
+        for result in fast:
+            self.assertRaises(gevent.Timeout, result.get, block=False)
+        self.assertNotIn(1, results)
+        self.assertFalse(slow.ready())
+        self.assertIn(0, results)
+        results.expire(results._deadlines[0][0])
+        self.assertRaises(gevent.Timeout, slow.get, block=False)
+        self.assertEqual(len(results), 0)
+
+    def test_set_result_not_expired(self):
+        results = OutstandingResults(start=0)
+        result = results.next(timeout=0.01)
+        results.pop(result.ident).set(1)
+        gevent.sleep(0.05)
+        self.assertEqual(result.get(block=False), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+import unittest
+
+import zmq
+
+from volttron.platform.vip.router import BaseRouter
+
+
+class Router(BaseRouter):
+    def setup(self):
+        self.socket.bind('inproc://router')
+
+
+class RouterTests(unittest.TestCase):
+    router_kwargs = {'batch_size': 4}
+
+    def setUp(self):
+        self.context = zmq.Context()
+        self.router = Router(self.context, **self.router_kwargs)
+        self.router.start()
+        self.peers = {}
+        for identity in (b'a', b'b'):
+            sock = self.peers[identity] = self.context.socket(zmq.DEALER)
+            sock.identity = identity
+            sock.connect('inproc://router')
+            self.send(identity, b'', b'ping')
+        self.assertTrue(self.router.poll(1000))
+        self.assertEqual(self.router.route_batch(), 2)
+        # Discard pongs and peerlist notices.
+        for sock in self.peers.values():
+            while sock.poll(10):
+                sock.recv_multipart()
+
+    def tearDown(self):
+        for sock in self.peers.values():
+            sock.close(linger=0)
+        self.router.stop(0)
+        self.context.term()
+
+    def send(self, sender, recipient, subsystem, *args):
+        self.peers[sender].send_multipart(
+            [recipient, b'VIP1', b'', b'', subsystem] + list(args))
+
+    def receive(self, identity):
+        sock = self.peers[identity]
+        received = []
+        while sock.poll(10):
+            received.append(sock.recv_multipart())
+        return received
+
+    def test_batch_limited(self):
+        for n in range(10):
+            self.send(b'a', b'b', b'RPC', b'%d' % n)
+        self.assertTrue(self.router.poll(1000))
+        self.assertEqual(self.router.route_batch(), 4)
+        self.assertEqual(self.router.route_batch(limit=100), 6)
+        self.assertEqual(self.router.route_batch(), 0)
+        counters = self.router.counters
+        self.assertEqual(counters['messages'], 12)
+        self.assertEqual(counters['last_batch'], 6)
+        self.assertEqual(counters['max_batch'], 6)
+        received = self.receive(b'b')
+        self.assertEqual([frames[-1] for frames in received],
+                         [b'%d' % n for n in range(10)])
+        self.assertEqual(received[0][:5], [b'a', b'VIP1', b'', b'', b'RPC'])
+
+    def test_batch_size_at_least_one(self):
+        self.assertEqual(Router(self.context, batch_size=0).batch_size, 1)
+
+    def test_unreachable_dropped(self):
+        self.send(b'a', b'c', b'RPC', b'x')
+        self.assertTrue(self.router.poll(1000))
+        self.assertEqual(self.router.route_batch(), 1)
+        [frames] = self.receive(b'a')
+        self.assertEqual(frames[4], b'error')
+        self.assertEqual(frames[-2:], [b'c', b'RPC'])
+
+
+class RouterMetricsTests(RouterTests):
+    router_kwargs = {'batch_size': 4, 'metrics': True}
+
+    def test_metrics(self):
+        self.send(b'a', b'b', b'RPC', b'12345')
+        self.send(b'b', b'a', b'pubsub')
+        self.assertTrue(self.router.poll(1000))
+        self.router.route_batch()
+        snapshot = self.router.metrics.snapshot()
+        self.assertEqual(snapshot['counters']['route/RPC/a'],
+                         {'messages': 1, 'bytes': 14})
+        self.assertEqual(snapshot['counters']['route/pubsub/b'],
+                         {'messages': 1, 'bytes': 12})
+        self.assertEqual(snapshot['counters']['route/ping/a']['messages'], 1)
+        self.assertEqual(snapshot['latency']['batch']['count'], 2)
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(Router(self.context).metrics)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+import unittest
+
+import gevent
+from gevent.event import Event
+
+from volttron.platform.vip.agent import codecs
+from volttron.platform.vip.agent.subsystems.rpc import DispatchPool, RPC
+from volttron.platform.vip.socket import Message
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def send_vip(self, peer, subsystem, args=None, msg_id=b'', **kwargs):
+        self.sent.append((peer, subsystem, args, msg_id))
+
+    def send_vip_object(self, message, **kwargs):
+        self.sent.append(message)
+
+
+class FakeSignal(object):
+    def __init__(self):
+        self.receivers = []
+
+    def connect(self, receiver, owner=None):
+        self.receivers.append(receiver)
+
+
+class FakeCore(object):
+    identity = b'agent'
+    metrics = None
+
+    def __init__(self):
+        self.socket = FakeSocket()
+        self.codecs = codecs.PeerCodecs(lambda peer: None)
+        self.onsetup = FakeSignal()
+
+    def register(self, name, handler, error_handler=None):
+        pass
+
+
+class Owner(object):
+    def __init__(self):
+        self.started = Event()
+        self.finish = Event()
+
+    @RPC.export
+    def ask(self, peer, timeout):
+        try:
+            return self.rpc.call(peer, 'answer').get(timeout=timeout)
+        except gevent.Timeout:
+            return 'timeout'
+
+    @RPC.export
+    def wait(self):
+        self.started.set()
+        self.finish.wait()
+
+
+class DispatchPoolTests(unittest.TestCase):
+    def test_workers_bounded(self):
+        pool = DispatchPool(size=2, depth=10)
+        running = []
+        release = Event()
+
+        def work(n):
+            running.append(n)
+            release.wait()
+        for n in range(5):
+            self.assertTrue(pool.submit(work, n))
+        gevent.sleep(0)
+        self.assertEqual(running, [0, 1])
+        self.assertTrue(pool.busy())
+        release.set()
+        gevent.sleep(0.01)
+        self.assertEqual(running, [0, 1, 2, 3, 4])
+        self.assertFalse(pool.busy())
+
+    def test_queue_depth(self):
+        pool = DispatchPool(size=1, depth=2)
+        self.assertTrue(pool.submit(lambda: None))
+        self.assertTrue(pool.submit(lambda: None))
+        self.assertFalse(pool.submit(lambda: None))
+        gevent.sleep(0.01)
+        self.assertEqual(len(pool), 0)
+
+    def test_exception_does_not_stop_worker(self):
+        pool = DispatchPool(size=1)
+        done = []
+
+        def fail():
+            raise ValueError('fail')
+        pool.submit(fail)
+        pool.submit(done.append, 1)
+        gevent.sleep(0.01)
+        self.assertEqual(done, [1])
+
+
+class AwaitedTests(unittest.TestCase):
+    def setUp(self):
+        self.core = FakeCore()
+        self.owner = Owner()
+        self.rpc = self.owner.rpc = RPC(self.core, self.owner)
+        for receiver in self.core.onsetup.receivers:
+            receiver(self)
+
+    def request(self, peer, method, *args):
+        data = codecs.JSON.dumps({'jsonrpc': '2.0', 'id': 1,
+                                  'method': method, 'params': list(args)})
+        return Message(peer=peer, user=b'', id=b'1', subsystem=b'RPC',
+                       args=[data])
+
+    def test_timeout_releases_peer(self):
+        self.rpc._handle_subsystem(self.request(b'peer', 'ask', 'peer', 0.01))
+        gevent.sleep(0)
+        self.assertEqual(self.rpc._awaited, {b'peer': 1})
+        gevent.sleep(0.05)
+        response = self.core.socket.sent[-1]
+        self.assertIn(b'timeout', bytes(response.args[0]))
+        self.assertEqual(self.rpc._awaited, {})
+
+        # Later requests from the peer are queued in the pool again.
+        self.rpc._handle_subsystem(self.request(b'peer', 'wait'))
+        self.assertTrue(self.owner.started.wait(1))
+        self.assertTrue(self.rpc.pool.busy())
+        self.owner.finish.set()
+        gevent.sleep(0.01)
+        self.assertFalse(self.rpc.pool.busy())
+
+    def test_result_releases_peer(self):
+        self.rpc._handle_subsystem(self.request(b'peer', 'ask', 'peer', 1))
+        gevent.sleep(0)
+        self.assertEqual(self.rpc._awaited, {b'peer': 1})
+        peer, _, _, ident = self.core.socket.sent[-1]
+        self.rpc._results[int(ident)].set(42)
+        gevent.sleep(0.01)
+        self.assertEqual(self.rpc._awaited, {})
+
+
+class CallManyTests(unittest.TestCase):
+    def setUp(self):
+        self.core = FakeCore()
+        self.rpc = RPC(self.core, Owner())
+        for receiver in self.core.onsetup.receivers:
+            receiver(self)
+
+    def response(self, peer, msg_id, *items):
+        args = [codecs.JSON.dumps(dict(item, jsonrpc='2.0'))
+                for item in items]
+        return Message(peer=peer, user=b'', id=msg_id, subsystem=b'RPC',
+                       args=args)
+
+    def test_one_message(self):
+        results = self.rpc.call_many(
+            b'peer', [('a', [1], {}), ('b', None, {'x': 2}), ('c', (), None)])
+        [(peer, subsystem, requests, msg_id)] = self.core.socket.sent
+        self.assertEqual((peer, subsystem), (b'peer', 'RPC'))
+        self.assertEqual(msg_id, b'%d+3' % results[0].ident)
+        requests = [codecs.JSON.loads(request) for request in requests]
+        self.assertEqual([(request['id'], request['method'])
+                          for request in requests],
+                         [(result.ident, name)
+                          for result, name in zip(results, 'abc')])
+        self.assertEqual(requests[1]['params'], {'x': 2})
+
+        self.rpc._handle_subsystem(self.response(
+            b'peer', msg_id,
+            {'id': results[0].ident, 'result': 1},
+            {'id': results[2].ident, 'result': 3},
+            {'id': results[1].ident,
+             'error': {'code': -32601, 'message': 'no method'}}))
+        self.assertEqual(results[0].get(block=False), 1)
+        self.assertEqual(results[2].get(block=False), 3)
+        self.assertRaises(Exception, results[1].get, block=False)
+
+    def test_empty(self):
+        self.assertEqual(self.rpc.call_many(b'peer', []), [])
+        self.assertEqual(self.core.socket.sent, [])
+
+    def test_error_fails_all(self):
+        results = self.rpc.call_many(b'peer', [('a', (), {})] * 3)
+        other = self.rpc.call(b'peer', 'a')
+        msg_id = self.core.socket.sent[0][3]
+        error = ValueError('unreachable')
+        self.rpc._handle_error(self, Message(id=msg_id), error)
+        for result in results:
+            self.assertRaises(ValueError, result.get, block=False)
+        self.assertFalse(other.ready())
+
+    def test_timeout(self):
+        results = self.rpc.call_many(b'peer', [('a', (), {})] * 2,
+                                     timeout=0.01)
+        gevent.sleep(0.05)
+        for result in results:
+            self.assertRaises(gevent.Timeout, result.get, block=False)
+        self.assertEqual(len(self.rpc._results), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+import unittest
+
+import gevent
+from zmq import green as zmq
+
+from volttron.platform.vip.green import Socket
+
+
+class FanoutTests(unittest.TestCase):
+    def setUp(self):
+        self.context = zmq.Context()
+        self.router = self.context.socket(zmq.ROUTER)
+        self.router.bind('inproc://fanout')
+        self.socket = Socket(self.context)
+        self.socket.identity = b'sender'
+        self.socket.connect('inproc://fanout')
+
+    def tearDown(self):
+        self.socket.close(linger=0)
+        self.router.close(linger=0)
+        self.context.term()
+
+    def receive(self, count):
+        with gevent.Timeout(2):
+            return [self.router.recv_multipart() for _ in range(count)]
+
+    def test_same_frames_to_each_peer(self):
+        for copy in (True, False):
+            count = self.socket.send_vip_fanout(
+                [b'a', b'b', b'c'], b'RPC', [b'payload'], msg_id=b'1',
+                copy=copy)
+            self.assertEqual(count, 3)
+            self.assertEqual(self.receive(3), [
+                [b'sender', peer, b'VIP1', b'', b'1', b'RPC', b'payload']
+                for peer in (b'a', b'b', b'c')])
+
+    def test_single_arg(self):
+        self.socket.send_vip_fanout([b'a'], b'RPC', b'payload')
+        self.assertEqual(self.receive(1), [
+            [b'sender', b'a', b'VIP1', b'', b'', b'RPC', b'payload']])
+
+    def test_no_peers(self):
+        self.assertEqual(
+            self.socket.send_vip_fanout([], b'RPC', [b'payload']), 0)
+
+    def test_not_interleaved(self):
+        gevent.spawn(self.socket.send_vip, b'other', b'RPC', [b'single'])
+        self.socket.send_vip_fanout([b'a', b'b'], b'RPC', [b'payload'])
+        gevent.sleep(0)
+        messages = self.receive(3)
+        self.assertIn([b'sender', b'other', b'VIP1', b'', b'', b'RPC',
+                       b'single'], messages)
+        for message in messages:
+            self.assertEqual(len(message), 7)
+
+    def test_router_requires_via(self):
+        router = Socket(self.context, zmq.ROUTER)
+        try:
+            with self.assertRaises(ValueError):
+                router.send_vip_fanout([b'a'], b'RPC', [b'payload'])
+        finally:
+            router.close(linger=0)
+
+
+if __name__ == '__main__':
+    unittest.main()